@@ -5,13 +5,20 @@ Created on Thu May 26 17:30:37 2022
 @author: svc_ccg
 """
 
+import concurrent.futures
 import contextlib
 import glob
+import hashlib
+import io
 import os
 import pathlib
+import pickle
 import re
+import socket
+import sqlite3
 import time
 import traceback
+import urllib.parse
 import h5py
 import numpy as np
 import pandas as pd
@@ -24,18 +31,108 @@ except ImportError:
 
 baseDir = pathlib.Path('//allen/programs/mindscope/workgroups/dynamicrouting/DynamicRoutingTask')
 
+# local cache of loaded DynRoutData objects
+behavDataCacheDir = pathlib.Path.home() / '.cache' / 'DynamicRoutingTask' / 'DynRoutData'
+behavDataCacheSize = 20e9 # bytes; least recently used sessions are removed above this
+behavDataLoaderVersion = 5 # increment when loadBehavData changes so cached sessions are reloaded
+
+# record of the behavior files already added to the training summary workbooks and manifest of all session files
+sessionIndexPath = os.path.join(baseDir,'DynamicRoutingSessionIndex.sqlite')
+sessionFileRegex = re.compile('(.*)_([0-9]{6})_([0-9]{8}_[0-9]{6})\\.hdf5$') # task name, mouse id, start time
+
+# columnar tables of sessions, blocks and trials for all mice; one partition of .npy column files per mouse
+cohortStoreDir = os.path.join(baseDir,'CohortStore')
+cohortTables = ('sessions','blocks','trials')
+
 
 class DynRoutData():
-    
+
+    # attributes set by each loader
+    # with lazy loading, a loader is run the first time one of its attributes is accessed,
+    # and the attributes it depends on are loaded in turn when the loader accesses them
+    behavDataLoaders = (('loadSessionInfo',('subjectName','rigName','computerName','taskVersion','startTime')),
+                        ('loadFrameTimes',('frameTimes','lastFrame')),
+                        ('loadTrialFrames',('endsWithNonCompletedTrial','trialEndFrame','trialEndTimes','nTrials','trialStartFrame','trialStartTimes','stimStartFrame','stimStartTimes')),
+                        ('loadBlockParams',('newBlockAutoRewards','newBlockGoTrials','newBlockNogoTrials','newBlockCatchTrials','autoRewardOnsetFrame')),
+                        ('loadTrialRepeats',('trialRepeat','incorrectTrialRepeats','incorrectTimeoutFrames')),
+                        ('loadQuiescentViolations',('quiescentFrames','quiescentViolationFrames','trialQuiescentViolations')),
+                        ('loadResponseWindow',('responseWindow','responseWindowTime')),
+                        ('loadTrialStim',('trialStim','trialBlock','blockTrial','blockStartTimes','blockFirstStimTimes','blockStimRewarded','rewardedStim')),
+                        ('loadResponses',('trialResponse','trialResponseFrame','responseTimes')),
+                        ('loadRewards',('rewardFrames','rewardTimes','rewardSize','trialRewarded','autoRewardScheduled','autoRewarded','rewardEarned')),
+                        ('loadLicks',('lickFrames','minLickInterval','lickTimes')),
+                        ('loadRunning',('runningSpeed',)),
+                        ('loadVisStimParams',('visContrast','trialVisContrast','gratingOri','trialGratingOri')),
+                        ('loadSoundParams',('soundVolume','trialSoundVolume')),
+                        ('loadOptoParams',('trialOptoOnsetFrame','trialOptoDur','trialOptoVoltage','trialGalvoX','trialGalvoY','optoParams',
+                                           'trialOptoParamsIndex','trialOptoLabel','trialOptoDevice','trialOptoDelay','trialOptoOnRamp','trialOptoOffRamp',
+                                           'trialOptoSinFreq','trialGalvoDwellTime','trialOptoItiOnsetFrame')),
+                        ('loadTrialTypes',('catchTrials','multimodalTrials','goTrials','nogoTrials','sameModalNogoTrials','otherModalGoTrials','otherModalNogoTrials',
+                                           'hitTrials','missTrials','falseAlarmTrials','correctRejectTrials','catchResponseTrials')),
+                        ('loadEngagedTrials',('engagedTrials',)),
+                        ('loadBlockPerformance',('catchResponseRate','hitRate','hitCount','falseAlarmRate','falseAlarmSameModal','falseAlarmOtherModalGo',
+                                                 'falseAlarmOtherModalNogo','dprimeSameModal','dprimeOtherModalGo','dprimeNonrewardedModal')))
+    behavDataAttrLoader = {attr: loader for loader,attrs in behavDataLoaders for attr in attrs}
+
     def __init__(self):
         self.frameRate = 60
-    
-    
-    def loadBehavData(self,filePath,h5pyFile=None,engagedThresh=None):
+
+
+    def __getattr__(self,name):
+        # only called for attributes that have not been set yet
+        loader = self.behavDataAttrLoader.get(name)
+        if loader is None or not self.__dict__.get('_lazyLoad',False) or loader in self._loadersRun:
+            raise AttributeError("'DynRoutData' object has no attribute '" + name + "'")
+        self._loadersRun.add(loader)
+        try:
+            getattr(self,loader)(self.getBehavDataFile())
+        except Exception:
+            # allow the loader to run (and raise its original error) again the next time
+            self._loadersRun.discard(loader)
+            raise
+        if len(self._loadersRun) == len(self.behavDataLoaders):
+            self.closeBehavDataFile()
+        if name not in self.__dict__:
+            # optional attributes (e.g. opto) are not set for every session
+            raise AttributeError("'DynRoutData' object has no attribute '" + name + "'")
+        return self.__dict__[name]
+
+
+    def __getstate__(self):
+        # an open h5py file can't be pickled; it is reopened if needed
+        state = self.__dict__.copy()
+        state.pop('_behavDataFile',None)
+        state.pop('_closeBehavDataFile',None)
+        return state
+
+
+    def getBehavDataFile(self):
+        if self.__dict__.get('_behavDataFile') is None:
+            self._behavDataFile = h5py.File(self.behavDataPath,'r')
+            self._closeBehavDataFile = True
+        return self._behavDataFile
+
+
+    def closeBehavDataFile(self):
+        # closes the file opened for lazy loading; attributes not loaded yet will reopen it when accessed
+        # a file passed to loadBehavData is left open for the caller to close
+        d = self.__dict__.pop('_behavDataFile',None)
+        if d is not None and self.__dict__.pop('_closeBehavDataFile',False):
+            d.close()
+
+
+    def loadBehavData(self,filePath,h5pyFile=None,engagedThresh=None,lazy=False):
 
         self.behavDataPath = filePath
         self.engagedThresh = engagedThresh
 
+        if lazy:
+            # read and derive each attribute the first time it is accessed
+            self._lazyLoad = True
+            self._loadersRun = set()
+            self._behavDataFile = h5pyFile if h5pyFile and isinstance(h5pyFile,h5py.File) else None
+            return
+
         if h5pyFile and isinstance(h5pyFile,h5py.File):
             # allow an already-open h5py File instance to be used,
             # but not closed by context block below
@@ -46,167 +143,230 @@ class DynRoutData():
             d = context.__enter__()
 
         with context:
-        
-            # self.subjectName = d['subjectName'][()]
-            self.subjectName = re.search('.*_([0-9]{6})_',os.path.basename(self.behavDataPath)).group(1)
-            self.rigName = d['rigName'].asstr()[()]
-            self.computerName = d['computerName'].asstr()[()] if 'computerName' in d and  d['computerName'].dtype=='O' else None
-            self.taskVersion = d['taskVersion'].asstr()[()] if 'taskVersion' in d else None
-            self.startTime = d['startTime'].asstr()[()]
-            
-            frameIntervals = d['frameIntervals'][:]
-            self.frameTimes = np.concatenate(([0],np.cumsum(frameIntervals)))
-            self.lastFrame =d['lastFrame'][()] if 'lastFrame' in d else None
-            if self.lastFrame is not None and self.lastFrame != frameIntervals.size:
-                print('\n',self.subjectName,self.startTime,'n frames',self.lastFrame,frameIntervals.size,'\n')
-            
-            self.endsWithNonCompletedTrial = d['trialStartFrame'].size > d['trialEndFrame'].size
-            self.trialEndFrame = d['trialEndFrame'][:]
-            self.trialEndTimes = self.frameTimes[self.trialEndFrame]
-            self.nTrials = self.trialEndFrame.size
-            self.trialStartFrame = d['trialStartFrame'][:self.nTrials]
-            self.trialStartTimes = self.frameTimes[self.trialStartFrame]
-            self.stimStartFrame = d['trialStimStartFrame'][:self.nTrials]
-            self.stimStartTimes = self.frameTimes[self.stimStartFrame]
-            
-            self.newBlockAutoRewards = d['newBlockAutoRewards'][()]
-            self.newBlockGoTrials = d['newBlockGoTrials'][()]
-            self.newBlockNogoTrials = d['newBlockNogoTrials'][()] if 'newBlockNogoTrials' in d else 0
-            self.newBlockCatchTrials = d['newBlockCatchTrials'][()] if 'newBlockCatchTrials' in d else 0
-            self.autoRewardOnsetFrame = d['autoRewardOnsetFrame'][()]
-            
-            self.trialRepeat = d['trialRepeat'][:self.nTrials]
-            self.incorrectTrialRepeats = d['incorrectTrialRepeats'][()]
-            self.incorrectTimeoutFrames = d['incorrectTimeoutFrames'][()]
-            
-            self.quiescentFrames = d['quiescentFrames'][()]
-            self.quiescentViolationFrames = d['quiescentViolationFrames'][:] if 'quiescentViolationFrames' in d.keys() else d['quiescentMoveFrames'][:]   
-            self.trialQuiescentViolations = [np.sum((self.quiescentViolationFrames >= start) & (self.quiescentViolationFrames <= end)) for start,end in zip(self.trialStartFrame,self.trialEndFrame)]
-            
-            self.responseWindow = d['responseWindow'][:]
-            self.responseWindowTime = np.array(self.responseWindow)/self.frameRate
-            
-            self.trialStim = d['trialStim'].asstr()[:self.nTrials]
-            self.trialBlock = d['trialBlock'][:self.nTrials]
-            self.blockTrial = np.concatenate([np.arange(np.sum(self.trialBlock==i)) for i in np.unique(self.trialBlock)])
-            self.blockStartTimes = self.trialStartTimes[[np.where(self.trialBlock==i)[0][0] for i in np.unique(self.trialBlock)]]
-            self.blockFirstStimTimes = self.stimStartTimes[[np.where(self.trialBlock==i)[0][0] for i in np.unique(self.trialBlock)]]
-            self.blockStimRewarded = d['blockStimRewarded'].asstr()[:]
-            self.rewardedStim = self.blockStimRewarded[self.trialBlock-1]
-            
-            self.rewardFrames = d['rewardFrames'][:]
-            self.rewardTimes = self.frameTimes[self.rewardFrames]
-            self.rewardSize = d['rewardSize'][:]
-            self.trialResponse = d['trialResponse'][:self.nTrials]
-            self.trialResponseFrame = d['trialResponseFrame'][:self.nTrials]
-            self.trialRewarded = d['trialRewarded'][:self.nTrials]
-            
-            if 'trialAutoRewardScheduled' in d:
-                self.autoRewardScheduled = d['trialAutoRewardScheduled'][:self.nTrials]
-                self.autoRewarded = d['trialAutoRewarded'][:self.nTrials]
-                if len(self.autoRewardScheduled) < self.nTrials:
-                    self.autoRewardScheduled = np.zeros(self.nTrials,dtype=bool)
-                    self.autoRewardScheduled[self.blockTrial < self.newBlockAutoRewards] = True
-                if len(self.autoRewarded) < self.nTrials:
-                    self.autoRewarded = self.autoRewardScheduled & np.in1d(self.stimStartFrame+self.autoRewardOnsetFrame,self.rewardFrames)
-            else:
-                self.autoRewardScheduled = d['trialAutoRewarded'][:self.nTrials]
+            for loader,_ in self.behavDataLoaders:
+                getattr(self,loader)(d)
+
+
+    def loadSessionInfo(self,d):
+        # self.subjectName = d['subjectName'][()]
+        self.subjectName = re.search('.*_([0-9]{6})_',os.path.basename(self.behavDataPath)).group(1)
+        self.rigName = d['rigName'].asstr()[()]
+        self.computerName = d['computerName'].asstr()[()] if 'computerName' in d and  d['computerName'].dtype=='O' else None
+        self.taskVersion = d['taskVersion'].asstr()[()] if 'taskVersion' in d else None
+        self.startTime = d['startTime'].asstr()[()]
+
+
+    def loadFrameTimes(self,d):
+        frameIntervals = d['frameIntervals'][:]
+        self.frameTimes = np.concatenate(([0],np.cumsum(frameIntervals)))
+        self.lastFrame =d['lastFrame'][()] if 'lastFrame' in d else None
+        if self.lastFrame is not None and self.lastFrame != frameIntervals.size:
+            print('\n',self.subjectName,self.startTime,'n frames',self.lastFrame,frameIntervals.size,'\n')
+
+
+    def loadTrialFrames(self,d):
+        self.endsWithNonCompletedTrial = d['trialStartFrame'].size > d['trialEndFrame'].size
+        self.trialEndFrame = d['trialEndFrame'][:]
+        self.trialEndTimes = self.frameTimes[self.trialEndFrame]
+        self.nTrials = self.trialEndFrame.size
+        self.trialStartFrame = d['trialStartFrame'][:self.nTrials]
+        self.trialStartTimes = self.frameTimes[self.trialStartFrame]
+        self.stimStartFrame = d['trialStimStartFrame'][:self.nTrials]
+        self.stimStartTimes = self.frameTimes[self.stimStartFrame]
+
+
+    def loadBlockParams(self,d):
+        self.newBlockAutoRewards = d['newBlockAutoRewards'][()]
+        self.newBlockGoTrials = d['newBlockGoTrials'][()]
+        self.newBlockNogoTrials = d['newBlockNogoTrials'][()] if 'newBlockNogoTrials' in d else 0
+        self.newBlockCatchTrials = d['newBlockCatchTrials'][()] if 'newBlockCatchTrials' in d else 0
+        self.autoRewardOnsetFrame = d['autoRewardOnsetFrame'][()]
+
+
+    def loadTrialRepeats(self,d):
+        self.trialRepeat = d['trialRepeat'][:self.nTrials]
+        self.incorrectTrialRepeats = d['incorrectTrialRepeats'][()]
+        self.incorrectTimeoutFrames = d['incorrectTimeoutFrames'][()]
+
+
+    def loadQuiescentViolations(self,d):
+        self.quiescentFrames = d['quiescentFrames'][()]
+        self.quiescentViolationFrames = d['quiescentViolationFrames'][:] if 'quiescentViolationFrames' in d.keys() else d['quiescentMoveFrames'][:]
+        self.trialQuiescentViolations = [np.sum((self.quiescentViolationFrames >= start) & (self.quiescentViolationFrames <= end)) for start,end in zip(self.trialStartFrame,self.trialEndFrame)]
+
+
+    def loadResponseWindow(self,d):
+        self.responseWindow = d['responseWindow'][:]
+        self.responseWindowTime = np.array(self.responseWindow)/self.frameRate
+
+
+    def loadTrialStim(self,d):
+        self.trialStim = d['trialStim'].asstr()[:self.nTrials]
+        self.trialBlock = d['trialBlock'][:self.nTrials]
+        self.blockTrial = np.concatenate([np.arange(np.sum(self.trialBlock==i)) for i in np.unique(self.trialBlock)])
+        self.blockStartTimes = self.trialStartTimes[[np.where(self.trialBlock==i)[0][0] for i in np.unique(self.trialBlock)]]
+        self.blockFirstStimTimes = self.stimStartTimes[[np.where(self.trialBlock==i)[0][0] for i in np.unique(self.trialBlock)]]
+        self.blockStimRewarded = d['blockStimRewarded'].asstr()[:]
+        self.rewardedStim = self.blockStimRewarded[self.trialBlock-1]
+
+
+    def getRecordedLickTimes(self,d):
+        # lick onset times relative to the first frame flip from threaded or hardware clocked lick input;
+        # None for sessions where licks were only polled once per frame
+        if 'lickTimes' in d and 'firstFrameTime' in d and d['lickTimes'].size > 0 and not np.isnan(d['firstFrameTime'][()]):
+            lickTimes = d['lickTimes'][:]
+            if 'lickFlipSampleCount' in d and d['lickFlipSampleCount'].size > 1:
+                # hardware clocked: interpolate between the lick input sample counts at each flip and the frame times,
+                # which corrects for drift between the sample clock and the frame clock
+                n = min(d['lickFlipSampleCount'].size,self.frameTimes.size)
+                flipTimes = d['lickFlipSampleCount'][:n] / d['lickSampleRate'][()]
+                frameTimes = self.frameTimes[:n]
+                t = np.interp(lickTimes,flipTimes,frameTimes)
+                t[lickTimes < flipTimes[0]] = (lickTimes - flipTimes[0] + frameTimes[0])[lickTimes < flipTimes[0]]
+                t[lickTimes > flipTimes[-1]] = (lickTimes - flipTimes[-1] + frameTimes[-1])[lickTimes > flipTimes[-1]]
+                return t
+            return lickTimes - d['firstFrameTime'][()]
+        else:
+            return None
+
+
+    def loadResponses(self,d):
+        self.trialResponse = d['trialResponse'][:self.nTrials]
+        self.trialResponseFrame = d['trialResponseFrame'][:self.nTrials]
+        responseFrame = self.trialResponseFrame[self.trialResponse].astype(int)
+        responseTimes = self.frameTimes[responseFrame]
+        lickTimes = self.getRecordedLickTimes(d)
+        if lickTimes is not None:
+            # use the onset of the lick detected at the response frame (it occurred within the preceding two frames)
+            i = np.searchsorted(lickTimes,responseTimes,side='right') - 1
+            lickTime = lickTimes[np.maximum(i,0)]
+            isDetectedLick = (i >= 0) & (lickTime > self.frameTimes[np.maximum(responseFrame-2,0)])
+            responseTimes = np.where(isDetectedLick,lickTime,responseTimes)
+        self.responseTimes = np.full(self.nTrials,np.nan)
+        self.responseTimes[self.trialResponse] = responseTimes - self.stimStartTimes[self.trialResponse]
+
+
+    def loadRewards(self,d):
+        self.rewardFrames = d['rewardFrames'][:]
+        self.rewardTimes = self.frameTimes[self.rewardFrames]
+        self.rewardSize = d['rewardSize'][:]
+        self.trialRewarded = d['trialRewarded'][:self.nTrials]
+
+        if 'trialAutoRewardScheduled' in d:
+            self.autoRewardScheduled = d['trialAutoRewardScheduled'][:self.nTrials]
+            self.autoRewarded = d['trialAutoRewarded'][:self.nTrials]
+            if len(self.autoRewardScheduled) < self.nTrials:
+                self.autoRewardScheduled = np.zeros(self.nTrials,dtype=bool)
+                self.autoRewardScheduled[self.blockTrial < self.newBlockAutoRewards] = True
+            if len(self.autoRewarded) < self.nTrials:
                 self.autoRewarded = self.autoRewardScheduled & np.in1d(self.stimStartFrame+self.autoRewardOnsetFrame,self.rewardFrames)
-            self.rewardEarned = self.trialRewarded & (~self.autoRewarded)
-            
-            
-            self.responseTimes = np.full(self.nTrials,np.nan)
-            self.responseTimes[self.trialResponse] = self.frameTimes[self.trialResponseFrame[self.trialResponse].astype(int)] - self.stimStartTimes[self.trialResponse]
-            
-            self.lickFrames = d['lickFrames'][:]
-            self.minLickInterval = 0.05
-            if len(self.lickFrames) > 0:
-                lickTimesDetected = self.frameTimes[self.lickFrames]
-                isLick = np.concatenate(([True], np.diff(lickTimesDetected) > self.minLickInterval))
-                self.lickTimes = lickTimesDetected[isLick]
-            else:
-                self.lickTimes = np.array([])
-            
-            if 'rotaryEncoder' in d and isinstance(d['rotaryEncoder'][()],bytes) and d['rotaryEncoder'].asstr()[()] == 'digital':
-                self.runningSpeed = np.concatenate(([np.nan],np.diff(d['rotaryEncoderCount'][:]) * ((2 * np.pi * d['wheelRadius'][()] * self.frameRate) / d['rotaryEncoderCountsPerRev'][()])))
-            else:
-                self.runningSpeed = None
-            
-            self.visContrast = d['visStimContrast'][()]
-            self.trialVisContrast = d['trialVisStimContrast'][:self.nTrials]
-            if 'gratingOri' in d:
-                self.gratingOri = {key: d['gratingOri'][key][()] for key in d['gratingOri']}
+        else:
+            self.autoRewardScheduled = d['trialAutoRewarded'][:self.nTrials]
+            self.autoRewarded = self.autoRewardScheduled & np.in1d(self.stimStartFrame+self.autoRewardOnsetFrame,self.rewardFrames)
+        self.rewardEarned = self.trialRewarded & (~self.autoRewarded)
+
+
+    def loadLicks(self,d):
+        self.lickFrames = d['lickFrames'][:]
+        self.minLickInterval = 0.05
+        lickTimesDetected = self.getRecordedLickTimes(d)
+        if lickTimesDetected is None and len(self.lickFrames) > 0:
+            lickTimesDetected = self.frameTimes[self.lickFrames]
+        if lickTimesDetected is not None:
+            isLick = np.concatenate(([True], np.diff(lickTimesDetected) > self.minLickInterval))
+            self.lickTimes = lickTimesDetected[isLick]
+        else:
+            self.lickTimes = np.array([])
+
+
+    def loadRunning(self,d):
+        if 'rotaryEncoder' in d and isinstance(d['rotaryEncoder'][()],bytes) and d['rotaryEncoder'].asstr()[()] == 'digital':
+            self.runningSpeed = np.concatenate(([np.nan],np.diff(d['rotaryEncoderCount'][:]) * ((2 * np.pi * d['wheelRadius'][()] * self.frameRate) / d['rotaryEncoderCountsPerRev'][()])))
+        else:
+            self.runningSpeed = None
+
+
+    def loadVisStimParams(self,d):
+        self.visContrast = d['visStimContrast'][()]
+        self.trialVisContrast = d['trialVisStimContrast'][:self.nTrials]
+        if 'gratingOri' in d:
+            self.gratingOri = {key: d['gratingOri'][key][()] for key in d['gratingOri']}
+        else:
+            self.gratingOri = {key: d['gratingOri_'+key][()] for key in ('vis1','vis2')}
+        self.trialGratingOri = d['trialGratingOri'][:self.nTrials]
+
+
+    def loadSoundParams(self,d):
+        self.soundVolume = d['soundVolume'][()]
+        self.trialSoundVolume = d['trialSoundVolume'][:self.nTrials]
+
+
+    def loadOptoParams(self,d):
+        if (('optoParams' in d and isinstance(d['optoParams'],h5py._hl.group.Group)) or
+            ('optoRegions' in d and len(d['optoRegions']) > 0) or
+            ('optoProb' in d and d['optoProb'][()] > 0) or
+            ('trialOptoOnsetFrame' in d and not np.all(np.isnan(d['trialOptoOnsetFrame'][:])))
+           ):
+            self.trialOptoOnsetFrame = d['trialOptoOnsetFrame'][:self.nTrials]
+            self.trialOptoDur = readDataset(d,'trialOptoDur',self.nTrials)
+            trialOptoVoltage = readDataset(d,'trialOptoVoltage',self.nTrials)
+            self.trialOptoVoltage = trialOptoVoltage[:,None] if len(trialOptoVoltage.shape) < 2 else trialOptoVoltage
+            if 'trialGalvoVoltage' in d:
+                trialGalvoVoltage = d['trialGalvoVoltage'][:self.nTrials]
+                if len(trialGalvoVoltage.shape) < 3:
+                    self.trialGalvoX = trialGalvoVoltage[:,0,None]
+                    self.trialGalvoY = trialGalvoVoltage[:,1,None]
+                else:
+                    self.trialGalvoX = trialGalvoVoltage[:,:,0]
+                    self.trialGalvoY = trialGalvoVoltage[:,:,1]
             else:
-                self.gratingOri = {key: d['gratingOri_'+key][()] for key in ('vis1','vis2')}
-            self.trialGratingOri = d['trialGratingOri'][:self.nTrials]
-            
-            self.soundVolume = d['soundVolume'][()]
-            self.trialSoundVolume = d['trialSoundVolume'][:self.nTrials]
-            
-            if (('optoParams' in d and isinstance(d['optoParams'],h5py._hl.group.Group)) or 
-                ('optoRegions' in d and len(d['optoRegions']) > 0) or
-                ('optoProb' in d and d['optoProb'][()] > 0) or
-                ('trialOptoOnsetFrame' in d and not np.all(np.isnan(d['trialOptoOnsetFrame'][:])))
-               ):
-                self.trialOptoOnsetFrame = d['trialOptoOnsetFrame'][:self.nTrials]
-                self.trialOptoDur = d['trialOptoDur'][:self.nTrials]
-                trialOptoVoltage = d['trialOptoVoltage'][:self.nTrials]
-                self.trialOptoVoltage = trialOptoVoltage[:,None] if len(trialOptoVoltage.shape) < 2 else trialOptoVoltage
-                if 'trialGalvoVoltage' in d:
-                    trialGalvoVoltage = d['trialGalvoVoltage'][:self.nTrials]
-                    if len(trialGalvoVoltage.shape) < 3:
-                        self.trialGalvoX = trialGalvoVoltage[:,0,None]
-                        self.trialGalvoY = trialGalvoVoltage[:,1,None]
+                self.trialGalvoX = readDataset(d,'trialGalvoX',self.nTrials)
+                self.trialGalvoY = readDataset(d,'trialGalvoY',self.nTrials)
+            self.optoParams = {}
+            if 'optoParams' in d and isinstance(d['optoParams'],h5py._hl.group.Group):
+                for key in d['optoParams'].keys():
+                    if key == 'label':
+                        self.optoParams[key] = d['optoParams'][key].asstr()[()]
+                    elif key == 'device':
+                        self.optoParams[key] = [val.strip('\'[]').split(',') for val in d['optoParams'][key].asstr()[()]]
                     else:
-                        self.trialGalvoX = trialGalvoVoltage[:,:,0]
-                        self.trialGalvoY = trialGalvoVoltage[:,:,1]
+                        self.optoParams[key] = readDataset(d['optoParams'],key)
+                self.trialOptoParamsIndex = d['trialOptoParamsIndex'][:self.nTrials]
+                self.trialOptoLabel = d['trialOptoLabel'].asstr()[:self.nTrials]
+                self.trialOptoDevice = [val.strip('\'[]').split(',') for val in d['trialOptoDevice'].asstr()[:self.nTrials]]
+                self.trialOptoDelay = readDataset(d,'trialOptoDelay',self.nTrials)
+                self.trialOptoOnRamp = readDataset(d,'trialOptoOnRamp',self.nTrials)
+                self.trialOptoOffRamp = readDataset(d,'trialOptoOffRamp',self.nTrials)
+                self.trialOptoSinFreq = readDataset(d,'trialOptoSinFreq',self.nTrials)
+                self.trialGalvoDwellTime = d['trialGalvoDwellTime'][:self.nTrials]
+            else:
+                optoVoltage = d['optoVoltage'][()]
+                self.optoParams['optoVoltage'] = np.array([[v] for v in optoVoltage])
+                galvoVoltage = d['galvoVoltage'][()]
+                self.optoParams['galvoX'] = np.array([[v[0]] for v in galvoVoltage])
+                self.optoParams['galvoY'] = np.array([[v[1]] for v in galvoVoltage])
+                bregmaX,bregmaY = TaskUtils.getBregmaGalvoCalibration(self.rigName).galvoToBregma(self.optoParams['galvoX'],self.optoParams['galvoY'])
+                self.optoParams['bregmaX'] = bregmaX
+                self.optoParams['bregmaY'] = bregmaY
+                if 'optoRegions' in d and len(d['optoRegions']) > 0:
+                    self.optoParams['label'] = d['optoRegions'].asstr()[()]
                 else:
-                    self.trialGalvoX = d['trialGalvoX'][:self.nTrials]
-                    self.trialGalvoY = d['trialGalvoY'][:self.nTrials]
-                self.optoParams = {}
-                if 'optoParams' in d and isinstance(d['optoParams'],h5py._hl.group.Group):
-                    for key in d['optoParams'].keys():
-                        if key == 'label':
-                            self.optoParams[key] = d['optoParams'][key].asstr()[()]
-                        elif key == 'device':
-                            self.optoParams[key] = [val.strip('\'[]').split(',') for val in d['optoParams'][key].asstr()[()]]
+                    self.optoParams['label'] = []
+                    for x,y in zip(bregmaX[:,0],bregmaY[:,0]):
+                        if np.isnan(x) or np.isnan(y):
+                            self.optoParams['label'].append('off brain')
+                        elif x < -2 and y < -2.5:
+                            self.optoParams['label'].append('V1')
                         else:
-                            self.optoParams[key] = d['optoParams'][key][()] 
-                    self.trialOptoParamsIndex = d['trialOptoParamsIndex'][:self.nTrials]
-                    self.trialOptoLabel = d['trialOptoLabel'].asstr()[:self.nTrials]
-                    self.trialOptoDevice = [val.strip('\'[]').split(',') for val in d['trialOptoDevice'].asstr()[:self.nTrials]]
-                    self.trialOptoDelay = d['trialOptoDelay'][:self.nTrials]
-                    self.trialOptoOnRamp = d['trialOptoOnRamp'][:self.nTrials]
-                    self.trialOptoOffRamp = d['trialOptoOffRamp'][:self.nTrials]
-                    self.trialOptoSinFreq = d['trialOptoSinFreq'][:self.nTrials]
-                    self.trialGalvoDwellTime = d['trialGalvoDwellTime'][:self.nTrials]
-                else:
-                    optoVoltage = d['optoVoltage'][()]
-                    self.optoParams['optoVoltage'] = np.array([[v] for v in optoVoltage])
-                    galvoVoltage = d['galvoVoltage'][()]
-                    self.optoParams['galvoX'] = np.array([[v[0]] for v in galvoVoltage])
-                    self.optoParams['galvoY'] = np.array([[v[1]] for v in galvoVoltage])
-                    calibrationData = TaskUtils.getBregmaGalvoCalibrationData(self.rigName)
-                    bregma = [TaskUtils.galvoToBregma(calibrationData,gv[0],gv[1]) for gv in galvoVoltage]
-                    self.optoParams['bregmaX'] = np.array([[b[0]] for b in bregma])
-                    self.optoParams['bregmaY'] = np.array([[b[1]] for b in bregma])
-                    if 'optoRegions' in d and len(d['optoRegions']) > 0:
-                        self.optoParams['label'] = d['optoRegions'].asstr()[()]
-                    else:
-                        self.optoParams['label'] = []
-                        for x,y in bregma:
-                            if np.isnan(x) or np.isnan(y):
-                                self.optoParams['label'].append('off brain')
-                            elif x < -2 and y < -2.5:
-                                self.optoParams['label'].append('V1')
-                            else:
-                                self.optoParams['label'].append('no label')
-                    self.trialOptoLabel = np.full(self.nTrials,'no opto',dtype=object)
-                    for lbl,ov,gv in zip(self.optoParams['label'],optoVoltage,galvoVoltage):
-                        self.trialOptoLabel[(trialOptoVoltage==ov) & np.all(trialGalvoVoltage==gv,axis=1)] = lbl
-                if 'trialOptoItiOnsetFrame' in d:
-                    self.trialOptoItiOnsetFrame = d['trialOptoItiOnsetFrame'][:self.nTrials]
-            
+                            self.optoParams['label'].append('no label')
+                self.trialOptoLabel = np.full(self.nTrials,'no opto',dtype=object)
+                for lbl,ov,gv in zip(self.optoParams['label'],optoVoltage,galvoVoltage):
+                    self.trialOptoLabel[(trialOptoVoltage==ov) & np.all(trialGalvoVoltage==gv,axis=1)] = lbl
+            if 'trialOptoItiOnsetFrame' in d:
+                self.trialOptoItiOnsetFrame = d['trialOptoItiOnsetFrame'][:self.nTrials]
+
+
+    def loadTrialTypes(self,d):
         self.catchTrials = self.trialStim == 'catch'
         self.multimodalTrials = np.array(['+' in stim for stim in self.trialStim])
         self.goTrials = (self.trialStim == self.rewardedStim) & (~self.autoRewardScheduled)
@@ -217,13 +377,15 @@ class DynRoutData():
         else:
             self.otherModalGoTrials = self.nogoTrials & np.in1d(self.trialStim,self.blockStimRewarded)
         self.otherModalNogoTrials = self.nogoTrials & ~self.sameModalNogoTrials & ~self.otherModalGoTrials
-        
+
         self.hitTrials = self.goTrials & self.trialResponse
         self.missTrials = self.goTrials & (~self.trialResponse)
         self.falseAlarmTrials = self.nogoTrials & self.trialResponse
         self.correctRejectTrials = self.nogoTrials & (~self.trialResponse)
         self.catchResponseTrials = self.catchTrials & self.trialResponse
-        
+
+
+    def loadEngagedTrials(self,d):
         self.engagedTrials = np.ones(self.nTrials,dtype=bool)
         if self.engagedThresh is not None:
             for i in range(self.nTrials):
@@ -231,7 +393,9 @@ class DynRoutData():
                 if r.size > self.engagedThresh:
                     if r[-self.engagedThresh:].sum() < 1:
                         self.engagedTrials[i] = False
-        
+
+
+    def loadBlockPerformance(self,d):
         self.catchResponseRate = []
         self.hitRate = []
         self.hitCount = []
@@ -258,6 +422,54 @@ class DynRoutData():
             self.dprimeOtherModalGo.append(calcDprime(self.hitRate[-1],self.falseAlarmOtherModalGo[-1],self.goTrials[blockTrials].sum(),otherModalGo.sum()))
             self.dprimeNonrewardedModal.append(calcDprime(self.falseAlarmOtherModalGo[-1],self.falseAlarmOtherModalNogo[-1],otherModalGo.sum(),otherModalNogo.sum()))
 # end DynRoutData
+
+
+def readDataset(d,key,n=None):
+    # read a dataset saved by TaskControl.saveParameters (first n items if n is not None)
+    # variable length sequences are returned as an object array of arrays, whether saved as
+    # a ragged group (flat values and offsets) or, in older files, a vlen dataset
+    obj = d[key]
+    if isinstance(obj,h5py.Group) and obj.attrs.get('layout') == 'ragged':
+        offsets = obj['offsets'][()] if n is None else obj['offsets'][:n+1]
+        values = obj['values'][offsets[0]:offsets[-1]]
+        data = np.empty(offsets.size-1,dtype=object)
+        for i,(start,stop) in enumerate(zip(offsets[:-1]-offsets[0],offsets[1:]-offsets[0])):
+            data[i] = values[start:stop]
+        return data
+    return obj[()] if n is None else obj[:n]
+
+
+class TrialSoundArrays():
+
+    # sound waveform of each trial, read from the session file when indexed
+    # newer files save each distinct waveform once (soundArrays group indexed by trialSoundArrayIndex);
+    # older files save one waveform per trial (trialSoundArray)
+
+    def __init__(self,filePath):
+        self.filePath = filePath
+        self.cache = {}
+        with h5py.File(filePath,'r') as d:
+            if 'trialSoundArrayIndex' in d and 'soundArrays' in d:
+                self.trialIndex = d['trialSoundArrayIndex'][:]
+            else:
+                self.trialIndex = None
+                self.nTrials = d['trialSoundArray'].shape[0] if 'trialSoundArray' in d else 0
+
+
+    def __len__(self):
+        return self.nTrials if self.trialIndex is None else self.trialIndex.size
+
+
+    def __getitem__(self,trial):
+        if self.trialIndex is None:
+            with h5py.File(self.filePath,'r') as d:
+                return d['trialSoundArray'][trial]
+        i = self.trialIndex[trial]
+        if i not in self.cache:
+            with h5py.File(self.filePath,'r') as d:
+                self.cache[i] = d['soundArrays'][str(i)][()]
+        return self.cache[i]
+# end TrialSoundArrays
     
 
 def calcDprime(hitRate,falseAlarmRate,goTrials,nogoTrials):
@@ -327,282 +539,834 @@ def getSessionsToPass(mouseId,df,sessions,stage,hitThresh=100,dprimeThresh=1.5):
     return sessionsToPass
 
 
-def getSessionData(mouseId,startTime):
+def getSessionFilePath(mouseId,startTime):
     if not isinstance(startTime,str):
         startTime = startTime.strftime('%Y%m%d_%H%M%S')
     fileName = 'DynamicRouting1_' + str(mouseId) + '_' + startTime + '.hdf5'
-    filePath = os.path.join(baseDir,'Data',str(mouseId),fileName)
+    return os.path.join(baseDir,'Data',str(mouseId),fileName)
+
+
+def getSessionData(mouseId,startTime,useCache=True):
+    filePath = getSessionFilePath(mouseId,startTime)
+    if useCache:
+        return loadBehavDataCached(filePath)
     obj = DynRoutData()
     obj.loadBehavData(filePath)
     return obj
 
+
+def getBehavDataCachePath(filePath,engagedThresh=None):
+    # cache key changes if the file is modified or the loader changes
+    st = os.stat(filePath)
+    key = repr((os.path.abspath(filePath),st.st_size,st.st_mtime_ns,behavDataLoaderVersion,engagedThresh))
+    return os.path.join(behavDataCacheDir,hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+
+def readBehavDataCache(filePath,engagedThresh=None):
+    # returns None if the session is not cached
+    cachePath = getBehavDataCachePath(filePath,engagedThresh)
+    if os.path.exists(cachePath):
+        try:
+            obj = DynRoutData()
+            with open(cachePath,'rb') as f:
+                obj.__dict__.update(pickle.load(f))
+            os.utime(cachePath) # mark as recently used
+            return obj
+        except Exception as err:
+            print('\nerror loading cached '+filePath+'\n')
+            print(repr(err))
+    return None
+
+
+def writeBehavDataCache(obj,engagedThresh=None):
+    filePath = str(obj.behavDataPath)
+    try:
+        cachePath = getBehavDataCachePath(filePath,engagedThresh)
+        os.makedirs(behavDataCacheDir,exist_ok=True)
+        tmpPath = cachePath + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpPath,'wb') as f:
+            pickle.dump(obj.__getstate__(),f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath,cachePath)
+        trimBehavDataCache()
+    except Exception as err:
+        print('\nerror caching '+filePath+'\n')
+        print(repr(err))
+
+
+def loadBehavDataCached(filePath,engagedThresh=None):
+    filePath = str(filePath)
+    obj = readBehavDataCache(filePath,engagedThresh)
+    if obj is None:
+        obj = DynRoutData()
+        obj.loadBehavData(filePath,engagedThresh=engagedThresh)
+        writeBehavDataCache(obj,engagedThresh)
+    return obj
+
+
+def readSessionFile(filePath,engagedThresh=None,useCache=False):
+    # returns the cached DynRoutData object if there is one, otherwise the file contents
+    if useCache:
+        obj = readBehavDataCache(filePath,engagedThresh)
+        if obj is not None:
+            return obj
+    with open(filePath,'rb') as f:
+        return f.read()
+
+
+def loadBehavDataFromBytes(filePath,data,engagedThresh=None):
+    obj = DynRoutData()
+    with h5py.File(io.BytesIO(data),'r') as d:
+        obj.loadBehavData(filePath,h5pyFile=d,engagedThresh=engagedThresh)
+    return obj
+
+
+def loadSessions(paths,workers=None,engagedThresh=None,useCache=False,skipErrors=False):
+    # files are read concurrently by a thread pool and parsed by a process pool; sessions are returned in start time order
+    # workers=1 loads in this process without starting a pool
+    # a file that fails to load raises unless skipErrors is True, in which case it is reported and left out
+    # (callers that index the returned list by position should not skip errors)
+    # on Windows, a script run from the command line that calls this needs an if __name__ == '__main__' guard
+    paths = [str(f) for f in paths]
+    if workers is None:
+        workers = min(32,len(paths))
+    exps = []
+    if workers < 2 or len(paths) < 2:
+        for f in paths:
+            try:
+                if useCache:
+                    obj = loadBehavDataCached(f,engagedThresh)
+                else:
+                    obj = DynRoutData()
+                    obj.loadBehavData(f,engagedThresh=engagedThresh)
+                exps.append(obj)
+            except Exception as err:
+                if not skipErrors:
+                    raise
+                print('\nerror loading '+f+'\n')
+                print(repr(err))
+        return sortExps(exps)
+
+    # at most twice as many files as there are processes are read or parsed at a time, so that only a bounded number of file contents are held in memory
+    nProcs = min(workers,os.cpu_count() or 1)
+    maxPending = 2 * nProcs
+    with concurrent.futures.ThreadPoolExecutor(min(workers,maxPending)) as ioExecutor, concurrent.futures.ProcessPoolExecutor(nProcs) as executor:
+        def handleError(f,err):
+            if not skipErrors:
+                ioExecutor.shutdown(cancel_futures=True)
+                executor.shutdown(cancel_futures=True)
+                raise err
+            print('\nerror loading '+f+'\n')
+            print(repr(err))
+        pathIter = iter(paths)
+        readFutures = {}
+        loadFutures = {}
+        def submitReads():
+            while len(readFutures) + len(loadFutures) < maxPending:
+                f = next(pathIter,None)
+                if f is None:
+                    break
+                readFutures[ioExecutor.submit(readSessionFile,f,engagedThresh,useCache)] = f
+        submitReads()
+        while readFutures or loadFutures:
+            done,_ = concurrent.futures.wait(list(readFutures) + list(loadFutures),return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in readFutures:
+                    f = readFutures.pop(future)
+                    try:
+                        data = future.result()
+                        if isinstance(data,DynRoutData):
+                            exps.append(data)
+                        else:
+                            loadFutures[executor.submit(loadBehavDataFromBytes,f,data,engagedThresh)] = f
+                    except Exception as err:
+                        handleError(f,err)
+                else:
+                    f = loadFutures.pop(future)
+                    try:
+                        obj = future.result()
+                        if useCache:
+                            writeBehavDataCache(obj,engagedThresh)
+                        exps.append(obj)
+                    except Exception as err:
+                        handleError(f,err)
+            submitReads()
+    return sortExps(exps)
+
+
+def trimBehavDataCache(maxSize=None):
+    if maxSize is None:
+        maxSize = behavDataCacheSize
+    cacheFiles = []
+    for f in glob.glob(os.path.join(behavDataCacheDir,'*.pkl')):
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            continue
+        cacheFiles.append((st.st_mtime,st.st_size,f))
+    totalSize = sum(size for _,size,_ in cacheFiles)
+    for _,size,f in sorted(cacheFiles):
+        if totalSize <= maxSize:
+            break
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+        totalSize -= size
+
   
-def updateTrainingSummary(mouseIds=None,replaceData=False):
-    excelPath = os.path.join(baseDir,'DynamicRoutingTraining.xlsx')
-    sheets = pd.read_excel(excelPath,sheet_name=None)
-    writer =  pd.ExcelWriter(excelPath,mode='a',engine='openpyxl',if_sheet_exists='replace',datetime_format='%Y%m%d_%H%M%S')
-    allMiceDf = sheets['all mice']
+def getCohortTables(obj):
+    # flatten a DynRoutData object into rows of the cohort tables
+    nBlocks = len(obj.blockStimRewarded)
+    sessionKeys = lambda n: {'mouse': np.full(n,int(obj.subjectName)),'session': np.full(n,obj.startTime)}
+    st = os.stat(obj.behavDataPath)
+    sessions = sessionKeys(1)
+    sessions.update({'filePath': np.array([str(obj.behavDataPath)]),
+                     'fileSize': np.array([st.st_size]),
+                     'fileModTime': np.array([st.st_mtime]),
+                     'rigName': np.array([obj.rigName]),
+                     'taskVersion': np.array([str(obj.taskVersion)]),
+                     'nTrials': np.array([obj.nTrials]),
+                     'nBlocks': np.array([nBlocks])})
+    blocks = sessionKeys(nBlocks)
+    blocks.update({'block': np.arange(1,nBlocks+1),
+                   'rewardedStim': np.array(obj.blockStimRewarded,dtype=str),
+                   'blockStartTime': np.array(obj.blockStartTimes,dtype=float),
+                   'nTrials': np.array([np.sum(obj.trialBlock==i) for i in range(1,nBlocks+1)])})
+    for key in ('hitCount','hitRate','falseAlarmRate','falseAlarmSameModal','falseAlarmOtherModalGo','falseAlarmOtherModalNogo',
+                'catchResponseRate','dprimeSameModal','dprimeOtherModalGo','dprimeNonrewardedModal'):
+        blocks[key] = np.array(getattr(obj,key),dtype=int if key=='hitCount' else float)
+    trials = sessionKeys(obj.nTrials)
+    trials.update({'block': obj.trialBlock.astype(int),
+                   'trial': np.arange(obj.nTrials),
+                   'blockTrial': obj.blockTrial.astype(int),
+                   'stim': np.array(obj.trialStim,dtype=str),
+                   'rewardedStim': np.array(obj.rewardedStim,dtype=str),
+                   'optoLabel': np.array(obj.trialOptoLabel,dtype=str) if hasattr(obj,'trialOptoLabel') else np.full(obj.nTrials,'no opto'),
+                   'stimStartTime': obj.stimStartTimes.astype(float),
+                   'response': obj.trialResponse.astype(bool),
+                   'responseTime': obj.responseTimes.astype(float),
+                   'rewarded': obj.trialRewarded.astype(bool),
+                   'autoRewardScheduled': obj.autoRewardScheduled.astype(bool),
+                   'autoRewarded': obj.autoRewarded.astype(bool),
+                   'repeat': obj.trialRepeat.astype(bool),
+                   'engaged': obj.engagedTrials,
+                   'quiescentViolations': np.array(obj.trialQuiescentViolations,dtype=int),
+                   'visContrast': obj.trialVisContrast.astype(float),
+                   'soundVolume': obj.trialSoundVolume.astype(float)})
+    for key in ('catch','multimodal','go','nogo','sameModalNogo','otherModalGo','otherModalNogo','hit','miss','falseAlarm','correctReject'):
+        trials[key] = getattr(obj,key+'Trials').astype(bool)
+    return {'sessions': sessions,'blocks': blocks,'trials': trials}
+
+
+def loadCohortPartition(table,mouseId,storeDir=None,columns=None,mmap=True):
+    if storeDir is None:
+        storeDir = cohortStoreDir
+    partitionDir = os.path.join(storeDir,table,str(mouseId))
+    if columns is None:
+        columns = [f[:-4] for f in sorted(os.listdir(partitionDir)) if f.endswith('.npy')]
+    return {col: np.load(os.path.join(partitionDir,col+'.npy'),mmap_mode='r' if mmap else None) for col in columns}
+
+
+def writeCohortPartition(table,mouseId,data,storeDir=None):
+    if storeDir is None:
+        storeDir = cohortStoreDir
+    partitionDir = os.path.join(storeDir,table,str(mouseId))
+    os.makedirs(partitionDir,exist_ok=True)
+    for col,vals in data.items():
+        filePath = os.path.join(partitionDir,col+'.npy')
+        tmpPath = filePath + '.tmp'
+        with open(tmpPath,'wb') as f:
+            np.save(f,vals)
+        os.replace(tmpPath,filePath)
+
+
+def loadCohortTable(table,columns=None,mouseIds=None,storeDir=None,mmap=True):
+    # returns a dict of column arrays for the selected mice (all mice by default)
+    # columns of a single mouse are memory-mapped; columns of several mice are concatenated
+    if storeDir is None:
+        storeDir = cohortStoreDir
     if mouseIds is None:
-        mouseIds = allMiceDf['mouse id']
+        mouseIds = sorted(os.listdir(os.path.join(storeDir,table)))
+    partitions = [loadCohortPartition(table,mouseId,storeDir,columns,mmap) for mouseId in mouseIds]
+    if len(partitions) == 1:
+        return partitions[0]
+    return {col: np.concatenate([p[col] for p in partitions]) for col in partitions[0]}
+
+
+def updateCohortStore(mouseIds=None,storeDir=None,workers=None):
+    # add new or modified sessions to the cohort tables; only mice with changed sessions are rewritten
+    if storeDir is None:
+        storeDir = cohortStoreDir
+    dataDir = os.path.join(baseDir,'Data')
+    if mouseIds is None:
+        mouseIds = [d for d in os.listdir(dataDir) if re.fullmatch('[0-9]{6}',d)]
+    mouseIds = [str(mouseId) for mouseId in mouseIds]
+    updateSessionManifest([os.path.join(dataDir,mouseId) for mouseId in mouseIds])
+    sessionFiles = getSessionFiles(mouseIds,taskName='DynamicRouting1',dirPath=dataDir,recursive=True)
+    filesToLoad = {}
+    sessionsToKeep = {}
     for mouseId in mouseIds:
-        mouseInd = np.where(allMiceDf['mouse id']==mouseId)[0][0]
-        if not replaceData and not allMiceDf.loc[mouseInd,'alive']:
-            continue
-        mouseId = str(mouseId)
-        mouseDir = os.path.join(baseDir,'Data',mouseId)
-        if not os.path.isdir(mouseDir):
+        mouseDir = os.path.join(dataDir,mouseId)
+        fileInfo = {f: (size,modTime) for f,d,taskName,size,modTime in sessionFiles[['filePath','dirPath','taskName','fileSize','fileModTime']].itertuples(index=False)
+                    if d == mouseDir and taskName == 'DynamicRouting1'}
+        behavFiles = list(fileInfo)
+        if os.path.isdir(os.path.join(storeDir,'sessions',mouseId)):
+            stored = loadCohortPartition('sessions',mouseId,storeDir,mmap=False)
+            unchanged = {f: session for f,size,modTime,session in zip(stored['filePath'],stored['fileSize'],stored['fileModTime'],stored['session'])
+                         if fileInfo.get(f) == (size,modTime)}
+        else:
+            stored = None
+            unchanged = {}
+        newFiles = [f for f in behavFiles if f not in unchanged]
+        if len(newFiles) > 0 or (stored is not None and len(unchanged) < len(stored['session'])):
+            filesToLoad[mouseId] = newFiles
+            sessionsToKeep[mouseId] = list(unchanged.values())
+
+    exps = loadSessions([f for files in filesToLoad.values() for f in files],workers=workers,engagedThresh=10,skipErrors=True)
+    for mouseId,files in filesToLoad.items():
+        tables = {table: [] for table in cohortTables}
+        for obj in exps:
+            if obj.behavDataPath in files:
+                try:
+                    for table,data in getCohortTables(obj).items():
+                        tables[table].append(data)
+                except Exception as err:
+                    print('\nerror processing '+str(obj.behavDataPath)+'\n')
+                    print(repr(err))
+        for table in cohortTables:
+            if len(sessionsToKeep[mouseId]) > 0:
+                stored = loadCohortPartition(table,mouseId,storeDir,mmap=False)
+                keep = np.isin(stored['session'],sessionsToKeep[mouseId])
+                tables[table].insert(0,{col: vals[keep] for col,vals in stored.items()})
+            if len(tables[table]) == 0:
+                continue
+            data = {col: np.concatenate([d[col] for d in tables[table]]) for col in tables[table][0]}
+            order = np.argsort(data['session'],kind='stable')
+            writeCohortPartition(table,mouseId,{col: vals[order] for col,vals in data.items()},storeDir)
+
+
+def openSessionIndex(indexPath=None,readOnly=False):
+    # the index is on the network share, where sqlite's file locking is unreliable, so only one process may write to it:
+    # writers (the training summary, cohort store and manifest updates) hold lockSessionIndex and lookups open it read only
+    if indexPath is None:
+        indexPath = sessionIndexPath
+    if readOnly:
+        uriPath = str(indexPath).replace('\\','/')
+        if not uriPath.startswith('/'):
+            uriPath = '/' + uriPath # drive letter
+        return sqlite3.connect('file://' + urllib.parse.quote(uriPath,safe='/:') + '?mode=ro',uri=True)
+    conn = sqlite3.connect(indexPath,timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS processedFiles (summary TEXT, filePath TEXT, mouseId TEXT, startTime TEXT, fileSize INTEGER, fileModTime REAL, PRIMARY KEY (summary,filePath))')
+    conn.execute('CREATE TABLE IF NOT EXISTS scannedDirs (summary TEXT, dirPath TEXT, modTime REAL, PRIMARY KEY (summary,dirPath))')
+    conn.execute('CREATE TABLE IF NOT EXISTS sessionFiles (filePath TEXT PRIMARY KEY, dirPath TEXT, taskName TEXT, mouseId TEXT, startTime TEXT, '
+                 'taskVersion TEXT, rigName TEXT, fileSize INTEGER, fileModTime REAL, complete INTEGER, '
+                 'nTrials INTEGER, nResponses INTEGER, nRewards INTEGER, nQuiescentViolations INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS sessionFilesMouse ON sessionFiles (mouseId,startTime)')
+    return conn
+
+
+@contextlib.contextmanager
+def lockSessionIndex(indexPath=None):
+    # exclusive lock for writing to the session index; the lock file is created atomically, also over SMB
+    lockPath = str(sessionIndexPath if indexPath is None else indexPath) + '.lock'
+    try:
+        fd = os.open(lockPath,os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with open(lockPath,'r') as f:
+            holder = f.read()
+        raise RuntimeError('the session index is being updated by ' + holder + '; if that update is no longer running, delete ' + lockPath)
+    try:
+        with os.fdopen(fd,'w') as f:
+            f.write(socket.gethostname() + ' (pid ' + str(os.getpid()) + ', since ' + time.strftime('%Y-%m-%d %H:%M:%S') + ')')
+        yield
+    finally:
+        os.remove(lockPath)
+
+
+def getProcessedFiles(conn,summary):
+    return set(row[0] for row in conn.execute('SELECT filePath FROM processedFiles WHERE summary=?',(summary,)))
+
+
+def addProcessedFiles(conn,summary,files):
+    # the processed files decide what the next incremental update loads, so only write them while holding lockSessionIndex
+    rows = []
+    for f in files:
+        st = os.stat(f)
+        mouseId,startTime = re.search('.*_([0-9]{6})_([0-9]{8}_[0-9]{6})',os.path.basename(f)).groups()
+        rows.append((summary,f,mouseId,startTime,st.st_size,st.st_mtime))
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO processedFiles VALUES (?,?,?,?,?,?)',rows)
+
+
+def getScannedDirs(conn,summary):
+    return dict(conn.execute('SELECT dirPath,modTime FROM scannedDirs WHERE summary=?',(summary,)))
+
+
+def addScannedDirs(conn,summary,dirModTimes):
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO scannedDirs VALUES (?,?,?)',[(summary,d,t) for d,t in dirModTimes.items()])
+
+
+def readSessionFileInfo(filePath):
+    # manifest row for a session file; task name, mouse id and start time come from the file name
+    taskName,mouseId,startTime = sessionFileRegex.search(os.path.basename(filePath)).groups()
+    st = os.stat(filePath)
+    info = {'filePath': filePath,'dirPath': os.path.normpath(os.path.dirname(filePath)),'taskName': taskName,'mouseId': mouseId,'startTime': startTime,
+            'taskVersion': None,'rigName': None,'fileSize': st.st_size,'fileModTime': st.st_mtime,'complete': 0,
+            'nTrials': None,'nResponses': None,'nRewards': None,'nQuiescentViolations': None}
+    try:
+        with h5py.File(filePath,'r') as d:
+            for key in ('taskVersion','rigName'):
+                if key in d and d[key].dtype == 'O':
+                    info[key] = d[key].asstr()[()]
+            if 'trialEndFrame' in d:
+                info['nTrials'] = d['trialEndFrame'].size
+                if 'trialResponse' in d:
+                    info['nResponses'] = int(d['trialResponse'][:info['nTrials']].sum())
+            if 'rewardFrames' in d:
+                info['nRewards'] = d['rewardFrames'].size
+            if 'quiescentViolationFrames' in d:
+                info['nQuiescentViolations'] = d['quiescentViolationFrames'].size
+            # files streamed during a session (see TaskControl.streamSessionData) get lastFrame when the session ends
+            info['complete'] = int('lastFrame' in d or 'streamSessionData' not in d)
+    except Exception:
+        # e.g. a file that is still being written; it is read again when it changes
+        pass
+    return info
+
+
+def updateSessionManifest(dirs=None,recursive=False,conn=None):
+    # add new and changed session files (<taskName>_<mouseId>_<startTime>.hdf5) in dirs to the sessionFiles table
+    # of the session index, and remove files that no longer exist; dirs defaults to every mouse directory in baseDir/Data
+    # a directory is only listed if its modification time changed since the previous scan, and a file is only
+    # read if it is new or changed (or, in an unchanged directory, if it was incomplete when last read)
+    # run periodically (the training summary and cohort store updates do this for their mice) so that getSessionFiles
+    # never needs a directory listing; pass conn if the caller already holds lockSessionIndex
+    if conn is None:
+        with lockSessionIndex():
+            sessionIndex = openSessionIndex()
+            try:
+                return updateSessionManifest(dirs,recursive,sessionIndex)
+            finally:
+                sessionIndex.close()
+    sessionIndex = conn
+    if dirs is None:
+        dirs = [os.path.join(baseDir,'Data')]
+        recursive = True
+    dirs = [os.path.normpath(d) for d in dirs]
+    scannedDirs = getScannedDirs(sessionIndex,'sessionFiles')
+    subDirs = {}
+    for d in scannedDirs:
+        subDirs.setdefault(os.path.dirname(d),[]).append(d)
+    knownFiles = {}
+    query = []
+    params = []
+    for d in dirs:
+        query.append('dirPath = ?')
+        params.append(d)
+        if recursive:
+            query.append('substr(dirPath,1,?) = ?')
+            params.extend((len(os.path.join(d,'')),os.path.join(d,'')))
+    sql = 'SELECT filePath,dirPath,fileSize,fileModTime,complete FROM sessionFiles WHERE ' + ' OR '.join(query)
+    for f,d,fileSize,fileModTime,complete in (sessionIndex.execute(sql,params) if len(dirs) > 0 else []):
+        knownFiles.setdefault(d,{})[f] = (fileSize,fileModTime,complete)
+    rows = []
+    removedFiles = []
+    dirModTimes = {}
+    dirsToScan = list(dirs)
+    while len(dirsToScan) > 0:
+        d = dirsToScan.pop()
+        try:
+            modTime = os.stat(d).st_mtime
+        except OSError:
             continue
-        behavFiles = glob.glob(os.path.join(mouseDir,'DynamicRouting*.hdf5'))
+        known = knownFiles.get(d,{})
+        if scannedDirs.get(d) == modTime:
+            if recursive:
+                dirsToScan.extend(subDirs.get(d,[]))
+            files = [f for f,(_,_,complete) in known.items() if not complete]
+        else:
+            entries = list(os.scandir(d))
+            if recursive:
+                dirsToScan.extend(e.path for e in entries if e.is_dir())
+            files = [e.path for e in entries if e.is_file() and sessionFileRegex.search(e.name)]
+            removedFiles.extend(set(known) - set(files))
+            dirModTimes[d] = modTime
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                removedFiles.append(f)
+                continue
+            if f not in known or known[f][:2] != (st.st_size,st.st_mtime):
+                rows.append(readSessionFileInfo(f))
+    with sessionIndex:
+        sessionIndex.executemany('INSERT OR REPLACE INTO sessionFiles VALUES (:filePath,:dirPath,:taskName,:mouseId,:startTime,:taskVersion,:rigName,'
+                                 ':fileSize,:fileModTime,:complete,:nTrials,:nResponses,:nRewards,:nQuiescentViolations)',rows)
+        sessionIndex.executemany('DELETE FROM sessionFiles WHERE filePath=?',[(f,) for f in removedFiles])
+    addScannedDirs(sessionIndex,'sessionFiles',dirModTimes)
+    return len(rows),len(removedFiles)
+
+
+def getSessionFiles(mouseIds=None,startTime=None,taskName='DynamicRouting',dirPath=None,recursive=False,conn=None):
+    # session files in the manifest (see updateSessionManifest) as a DataFrame sorted by mouse and start time
+    # startTime and taskName match as prefixes (e.g. startTime='20220817' for every session that day);
+    # dirPath limits the files to that directory (and its subdirectories if recursive)
+    query = []
+    params = []
+    if mouseIds is not None:
+        mouseIds = [str(mouseIds)] if isinstance(mouseIds,(str,int,np.integer)) else [str(m) for m in mouseIds]
+        query.append('mouseId IN (' + ','.join('?'*len(mouseIds)) + ')')
+        params.extend(mouseIds)
+    if startTime is not None:
+        if not isinstance(startTime,str):
+            startTime = startTime.strftime('%Y%m%d_%H%M%S')
+        query.append('substr(startTime,1,?) = ?')
+        params.extend((len(startTime),startTime))
+    if taskName is not None:
+        query.append('substr(taskName,1,?) = ?')
+        params.extend((len(taskName),taskName))
+    if dirPath is not None and recursive:
+        dirPath = os.path.join(dirPath,'')
+        query.append('substr(filePath,1,?) = ?')
+        params.extend((len(dirPath),dirPath))
+    elif dirPath is not None:
+        query.append('dirPath = ?')
+        params.append(os.path.normpath(dirPath))
+    sql = 'SELECT * FROM sessionFiles' + (' WHERE ' + ' AND '.join(query) if len(query) > 0 else '') + ' ORDER BY mouseId,startTime'
+    sessionIndex = openSessionIndex(readOnly=True) if conn is None else conn
+    df = pd.read_sql_query(sql,sessionIndex,params=params)
+    if conn is None:
+        sessionIndex.close()
+    return df
+
+
+def findSessionFiles(mouseId,dirPath,startTime=None,taskName='DynamicRouting'):
+    # paths of a mouse's session files in dirPath, looked up in the session manifest without writing to the index;
+    # if the manifest has nothing for them (e.g. the directory has not been scanned yet), dirPath is listed instead
+    try:
+        files = list(getSessionFiles(mouseId,startTime,taskName,dirPath)['filePath'])
+    except sqlite3.Error:
+        files = []
+    if len(files) == 0:
+        fileName = taskName + '*_' + str(mouseId) + '_' + ('' if startTime is None else startTime) + '*.hdf5'
+        files = sorted(glob.glob(os.path.join(dirPath,fileName)))
+    return files
+
+
+@lockSessionIndex()
+def updateTrainingSummary(mouseIds=None,replaceData=False):
+    # only files not yet in the session index are loaded and only sheets of mice with new sessions are written
+    # holds the session index lock, so it cannot run concurrently with another training summary or manifest update
+    # session files are found in the session manifest, which is updated for the summarized mice first
+    excelPath = os.path.join(baseDir,'DynamicRoutingTraining.xlsx')
+    summaryName = os.path.basename(excelPath)
+    sessionIndex = openSessionIndex()
+    processedFiles = getProcessedFiles(sessionIndex,summaryName)
+    with pd.ExcelFile(excelPath) as xl:
+        allMiceDf = xl.parse('all mice')
+        if mouseIds is None:
+            mouseIds = allMiceDf['mouse id']
+        mouseDirs = {}
+        for mouseId in mouseIds:
+            mouseInd = np.where(allMiceDf['mouse id']==mouseId)[0][0]
+            if not replaceData and not allMiceDf.loc[mouseInd,'alive']:
+                continue
+            mouseDirs[str(mouseId)] = (mouseInd,os.path.join(baseDir,'Data',str(mouseId)))
+        updateSessionManifest([mouseDir for _,mouseDir in mouseDirs.values()],conn=sessionIndex)
+        newFiles = {}
+        for mouseId,(mouseInd,mouseDir) in mouseDirs.items():
+            behavFiles = getSessionFiles(mouseId,dirPath=mouseDir,conn=sessionIndex)['filePath']
+            newFiles[mouseId] = (mouseInd,[f for f in behavFiles if replaceData or f not in processedFiles])
+        sheets = {mouseId: xl.parse(mouseId) for mouseId,(_,files) in newFiles.items() if len(files) > 0 and mouseId in xl.sheet_names}
+    allMiceDfOriginal = allMiceDf.copy()
+
+    # find new sessions for every mouse and load them together
+    filesToLoad = {}
+    summarizedFiles = [] # files with rows in the workbook
+    for mouseId,(mouseInd,files) in newFiles.items():
         df = sheets[mouseId] if mouseId in sheets else None
-        exps = []
-        for f in behavFiles:
+        filesToLoad[mouseId] = (mouseInd,[])
+        for f in files:
             startTime = re.search('.*_([0-9]{8}_[0-9]{6})',f).group(1)
             startTime = pd.to_datetime(startTime,format='%Y%m%d_%H%M%S')
             if replaceData or df is None or np.sum(df['start time']==startTime)==0:
+                filesToLoad[mouseId][1].append(f)
+            else:
+                summarizedFiles.append(f)
+    sessions = loadSessions([f for _,files in filesToLoad.values() for f in files],engagedThresh=10,skipErrors=True)
+    if len(sessions) > 0:
+        writer =  pd.ExcelWriter(excelPath,mode='a',engine='openpyxl',if_sheet_exists='replace',datetime_format='%Y%m%d_%H%M%S')
+        for mouseId,(mouseInd,files) in filesToLoad.items():
+            df = sheets[mouseId] if mouseId in sheets else None
+            exps = [obj for obj in sessions if obj.behavDataPath in files]
+            if len(exps) < 1:
+                continue
+            for obj in exps:
                 try:
-                    obj = DynRoutData()
-                    obj.loadBehavData(f,engagedThresh=10)
-                    exps.append(obj)
-                except Exception as err:
-                    print('\nerror loading '+f+'\n')
-                    print(repr(err))
-        if len(exps) < 1:
-            continue
-        exps = sortExps(exps)
-        for obj in exps:
-            try:
-                data = {'start time': pd.to_datetime(obj.startTime,format='%Y%m%d_%H%M%S'),
-                        'rig name': obj.rigName,
-                        'task version': obj.taskVersion,
-                        'hits': obj.hitCount,
-                        'd\' same modality': np.round(obj.dprimeSameModal,2),
-                        'd\' other modality go stim': np.round(obj.dprimeOtherModalGo,2),
-                        'quiescent violations': obj.quiescentViolationFrames.size,
-                        'pass': 0,
-                        'ignore': 0,
-                        'hab': 0,
-                        'ephys': 0,
-                        'muscimol': 0}  
-                if df is None:
-                    df = pd.DataFrame(data)
-                    sessionInd = 0
-                else:
-                    if 'rig name' not in df.columns:
-                        df.insert(1,'rig name','')
-                    sessionInd = df['start time'] == data['start time']
-                    sessionInd = np.where(sessionInd)[0][0] if sessionInd.sum()>0 else df.shape[0]
-                    df.loc[sessionInd] = list(data.values())
-                
-                if 'stage' in obj.taskVersion and 'templeton' not in obj.taskVersion:
-                    regimen = int(allMiceDf.loc[mouseInd,'regimen'])
-                    hitThresh = 150 if regimen==1 else 100
-                    dprimeThresh = 1.5
-                    lowRespThresh = 10
-                    task = df.loc[sessionInd,'task version']
-                    prevTask = df.loc[sessionInd-1,'task version'] if sessionInd>0 else ''
-                    passStage = 0
-                    handOff = False
-                    if 'stage 0' in task:
-                        passStage = 1
-                        nextTask = 'stage 1 AMN' if regimen > 4 else 'stage 1'
+                    data = {'start time': pd.to_datetime(obj.startTime,format='%Y%m%d_%H%M%S'),
+                            'rig name': obj.rigName,
+                            'task version': obj.taskVersion,
+                            'hits': obj.hitCount,
+                            'd\' same modality': np.round(obj.dprimeSameModal,2),
+                            'd\' other modality go stim': np.round(obj.dprimeOtherModalGo,2),
+                            'quiescent violations': obj.quiescentViolationFrames.size,
+                            'pass': 0,
+                            'ignore': 0,
+                            'hab': 0,
+                            'ephys': 0,
+                            'muscimol': 0}  
+                    if df is None:
+                        df = pd.DataFrame(data)
+                        sessionInd = 0
                     else:
-                        if sessionInd > 0:
-                            hits,dprimeSame,dprimeOther = getPerformanceStats(df,(sessionInd-1,sessionInd))
-                        if 'stage 1' in task:
-                            if 'stage 1' in prevTask and all(h[0] < lowRespThresh for h in hits):
-                                passStage = -1
-                                nextTask = 'stage 0'
-                            elif 'stage 1' in prevTask and all(h[0] >= hitThresh for h in hits) and all(d[0] >= dprimeThresh for d in dprimeSame):
-                                passStage = 1
-                                nextTask = 'stage 2 AMN' if regimen > 4 else 'stage 2'
-                            else:
-                                nextTask = 'stage 1 AMN' if regimen > 4 else 'stage 1'
-                        elif 'stage 2' in task:
-                            if 'stage 2' in prevTask and all(h[0] >= hitThresh for h in hits) and all(d[0] >= dprimeThresh for d in dprimeSame):
-                                passStage = 1
-                                if regimen>6:
-                                    nextTask = 'stage 5 ori AMN'
-                                elif regimen in (5,6):
-                                    nextTask = 'stage variable ori AMN'
+                        if 'rig name' not in df.columns:
+                            df.insert(1,'rig name','')
+                        sessionInd = df['start time'] == data['start time']
+                        sessionInd = np.where(sessionInd)[0][0] if sessionInd.sum()>0 else df.shape[0]
+                        df.loc[sessionInd] = list(data.values())
+                
+                    if 'stage' in obj.taskVersion and 'templeton' not in obj.taskVersion:
+                        regimen = int(allMiceDf.loc[mouseInd,'regimen'])
+                        hitThresh = 150 if regimen==1 else 100
+                        dprimeThresh = 1.5
+                        lowRespThresh = 10
+                        task = df.loc[sessionInd,'task version']
+                        prevTask = df.loc[sessionInd-1,'task version'] if sessionInd>0 else ''
+                        passStage = 0
+                        handOff = False
+                        if 'stage 0' in task:
+                            passStage = 1
+                            nextTask = 'stage 1 AMN' if regimen > 4 else 'stage 1'
+                        else:
+                            if sessionInd > 0:
+                                hits,dprimeSame,dprimeOther = getPerformanceStats(df,(sessionInd-1,sessionInd))
+                            if 'stage 1' in task:
+                                if 'stage 1' in prevTask and all(h[0] < lowRespThresh for h in hits):
+                                    passStage = -1
+                                    nextTask = 'stage 0'
+                                elif 'stage 1' in prevTask and all(h[0] >= hitThresh for h in hits) and all(d[0] >= dprimeThresh for d in dprimeSame):
+                                    passStage = 1
+                                    nextTask = 'stage 2 AMN' if regimen > 4 else 'stage 2'
                                 else:
-                                    nextTask = 'stage 3 ori'
-                            else:
-                                nextTask = 'stage 2 AMN' if regimen > 4 else 'stage 2'
-                        elif 'stage 3' in task:
-                            remedial = any('stage 4' in s for s in df['task version'])
-                            if ('stage 3' in prevTask
-                                 and ((regimen==1 and all(all(h >= hitThresh for h in hc) for hc in hits) and all(all(d >= dprimeThresh for d in dp) for dp in dprimeSame))
-                                      or (regimen>1 and all(all(h >= hitThresh/2 for h in hc) for hc in hits) and all(all(d >= dprimeThresh for d in dp) for dp in dprimeSame+dprimeOther)))):
-                                passStage = 1
-                                if regimen==2 and not any('stage 3 tone' in s for s in df['task version']):
-                                    nextTask = 'stage 3 tone'
+                                    nextTask = 'stage 1 AMN' if regimen > 4 else 'stage 1'
+                            elif 'stage 2' in task:
+                                if 'stage 2' in prevTask and all(h[0] >= hitThresh for h in hits) and all(d[0] >= dprimeThresh for d in dprimeSame):
+                                    passStage = 1
+                                    if regimen>6:
+                                        nextTask = 'stage 5 ori AMN'
+                                    elif regimen in (5,6):
+                                        nextTask = 'stage variable ori AMN'
+                                    else:
+                                        nextTask = 'stage 3 ori'
+                                else:
+                                    nextTask = 'stage 2 AMN' if regimen > 4 else 'stage 2'
+                            elif 'stage 3' in task:
+                                remedial = any('stage 4' in s for s in df['task version'])
+                                if ('stage 3' in prevTask
+                                     and ((regimen==1 and all(all(h >= hitThresh for h in hc) for hc in hits) and all(all(d >= dprimeThresh for d in dp) for dp in dprimeSame))
+                                          or (regimen>1 and all(all(h >= hitThresh/2 for h in hc) for hc in hits) and all(all(d >= dprimeThresh for d in dp) for dp in dprimeSame+dprimeOther)))):
+                                    passStage = 1
+                                    if regimen==2 and not any('stage 3 tone' in s for s in df['task version']):
+                                        nextTask = 'stage 3 tone'
+                                    elif regimen==3:
+                                        nextTask = 'stage 4 ori tone ori'
+                                    elif regimen==4:
+                                        nextTask = 'stage 5 ori tone'
+                                    else:
+                                        nextTask = 'stage 4 tone ori' if remedial and 'tone' in task else 'stage 4 ori tone'
+                                else:
+                                    if remedial:
+                                        nextTask = 'stage 3 ori' if 'ori' in task else 'stage 3 tone'
+                                    elif (regimen==2 and not any('stage 3 tone' in s for s in df['task version'])) or regimen>2:
+                                        nextTask = 'stage 3 ori'
+                                    else:
+                                        nextTask = 'stage 3 tone' if 'ori' in task else 'stage 3 ori'
+                            elif 'stage 4' in task:
+                                if 'stage 4' in prevTask:
+                                    lowRespOri = (('stage 4 ori' in prevTask and hits[0][0] < lowRespThresh and hits[1][1] < lowRespThresh)
+                                                  or ('stage 4 tone' in prevTask and hits[0][1] < lowRespThresh and hits[1][0] < lowRespThresh))
+                                    lowRespTone = (('stage 4 tone' in prevTask and hits[0][0] < lowRespThresh and hits[1][1] < lowRespThresh)
+                                                   or ('stage 4 ori' in prevTask and hits[0][1] < lowRespThresh and hits[1][0] < lowRespThresh))
+                                if 'stage 4' in prevTask and (lowRespOri or lowRespTone):
+                                    passStage = -1
+                                    nextTask = 'stage 3 ori' if lowRespOri else 'stage 3 tone'
+                                elif 'stage 4' in prevTask and all(all(d >= dprimeThresh for d in dp) for dp in dprimeSame+dprimeOther):
+                                    passStage = 1
+                                    nextTask = 'stage 5 ori tone'
                                 elif regimen==3:
                                     nextTask = 'stage 4 ori tone ori'
-                                elif regimen==4:
-                                    nextTask = 'stage 5 ori tone'
                                 else:
-                                    nextTask = 'stage 4 tone ori' if remedial and 'tone' in task else 'stage 4 ori tone'
-                            else:
-                                if remedial:
-                                    nextTask = 'stage 3 ori' if 'ori' in task else 'stage 3 tone'
-                                elif (regimen==2 and not any('stage 3 tone' in s for s in df['task version'])) or regimen>2:
-                                    nextTask = 'stage 3 ori'
-                                else:
-                                    nextTask = 'stage 3 tone' if 'ori' in task else 'stage 3 ori'
-                        elif 'stage 4' in task:
-                            if 'stage 4' in prevTask:
-                                lowRespOri = (('stage 4 ori' in prevTask and hits[0][0] < lowRespThresh and hits[1][1] < lowRespThresh)
-                                              or ('stage 4 tone' in prevTask and hits[0][1] < lowRespThresh and hits[1][0] < lowRespThresh))
-                                lowRespTone = (('stage 4 tone' in prevTask and hits[0][0] < lowRespThresh and hits[1][1] < lowRespThresh)
-                                               or ('stage 4 ori' in prevTask and hits[0][1] < lowRespThresh and hits[1][0] < lowRespThresh))
-                            if 'stage 4' in prevTask and (lowRespOri or lowRespTone):
-                                passStage = -1
-                                nextTask = 'stage 3 ori' if lowRespOri else 'stage 3 tone'
-                            elif 'stage 4' in prevTask and all(all(d >= dprimeThresh for d in dp) for dp in dprimeSame+dprimeOther):
-                                passStage = 1
-                                nextTask = 'stage 5 ori tone'
-                            elif regimen==3:
-                                nextTask = 'stage 4 ori tone ori'
-                            else:
-                                nextTask = 'stage 4 ori tone' if 'stage 4 tone' in task else 'stage 4 tone ori'
-                        elif 'stage 5' in task:
-                            if 'stage 5' in prevTask and np.all(np.sum((np.array(dprimeSame) >= dprimeThresh) & (np.array(dprimeOther) >= dprimeThresh),axis=1) > 3):
-                                passStage = 1
-                                handOff = True
-                            if regimen==8 and 'stage 5' in prevTask and 'repeats' not in prevTask:
-                                handOff = True
-                            if 'AMN' in task:
-                                nextTask = 'stage 5 AMN ori' if 'stage 5 ori' in task else 'stage 5 ori AMN'
-                            else:
-                                nextTask = 'stage 5 tone ori' if 'stage 5 ori' in task else 'stage 5 ori tone'
-                        elif 'stage variable' in task:
-                            if not np.any(np.isnan(obj.dprimeOtherModalGo)):
-                                passStage = 1
+                                    nextTask = 'stage 4 ori tone' if 'stage 4 tone' in task else 'stage 4 tone ori'
+                            elif 'stage 5' in task:
+                                if 'stage 5' in prevTask and np.all(np.sum((np.array(dprimeSame) >= dprimeThresh) & (np.array(dprimeOther) >= dprimeThresh),axis=1) > 3):
+                                    passStage = 1
+                                    handOff = True
+                                if regimen==8 and 'stage 5' in prevTask and 'repeats' not in prevTask:
+                                    handOff = True
                                 if 'AMN' in task:
                                     nextTask = 'stage 5 AMN ori' if 'stage 5 ori' in task else 'stage 5 ori AMN'
                                 else:
                                     nextTask = 'stage 5 tone ori' if 'stage 5 ori' in task else 'stage 5 ori tone'
-                            else:
-                                if 'AMN' in task:
-                                    nextTask = 'stage variable AMN ori' if 'stage variable ori' in task else 'stage variable ori AMN'
+                            elif 'stage variable' in task:
+                                if not np.any(np.isnan(obj.dprimeOtherModalGo)):
+                                    passStage = 1
+                                    if 'AMN' in task:
+                                        nextTask = 'stage 5 AMN ori' if 'stage 5 ori' in task else 'stage 5 ori AMN'
+                                    else:
+                                        nextTask = 'stage 5 tone ori' if 'stage 5 ori' in task else 'stage 5 ori tone'
                                 else:
-                                    nextTask = 'stage variable tone ori' if 'stage variable ori' in task else 'stage variable ori tone'
-                    if 'stage 3' in nextTask and regimen>1:
-                        nextTask += ' distract'
-                    if regimen>3 and 'stage 2' not in nextTask and nextTask != 'hand off':
-                        nextTask += ' moving'
-                    if not handOff and allMiceDf.loc[mouseInd,'timeouts'] and 'stage 0' not in nextTask and ((regimen>3 and 'timeouts' in task) or 'stage 5' not in nextTask):
-                        nextTask += ' timeouts'
-                    if regimen==8 and not handOff and 'stage 5' in nextTask and ('stage 5' not in task or 'repeats' in task):
-                        nextTask += ' repeats'
-                    if regimen==3 and ('stage 1' in nextTask or 'stage 2' in nextTask):
-                        nextTask += ' long'
-                    df.loc[sessionInd,'pass'] = passStage
+                                    if 'AMN' in task:
+                                        nextTask = 'stage variable AMN ori' if 'stage variable ori' in task else 'stage variable ori AMN'
+                                    else:
+                                        nextTask = 'stage variable tone ori' if 'stage variable ori' in task else 'stage variable ori tone'
+                        if 'stage 3' in nextTask and regimen>1:
+                            nextTask += ' distract'
+                        if regimen>3 and 'stage 2' not in nextTask and nextTask != 'hand off':
+                            nextTask += ' moving'
+                        if not handOff and allMiceDf.loc[mouseInd,'timeouts'] and 'stage 0' not in nextTask and ((regimen>3 and 'timeouts' in task) or 'stage 5' not in nextTask):
+                            nextTask += ' timeouts'
+                        if regimen==8 and not handOff and 'stage 5' in nextTask and ('stage 5' not in task or 'repeats' in task):
+                            nextTask += ' repeats'
+                        if regimen==3 and ('stage 1' in nextTask or 'stage 2' in nextTask):
+                            nextTask += ' long'
+                        df.loc[sessionInd,'pass'] = passStage
                     
-                    if df.shape[0] in (1,sessionInd+1):
-                        allMiceDf.loc[mouseInd,'next task version'] = nextTask
-            except:
-                print('error processing '+mouseId+', '+obj.startTime+'\n')
-                traceback.print_exc()
+                        if df.shape[0] in (1,sessionInd+1):
+                            allMiceDf.loc[mouseInd,'next task version'] = nextTask
+                    summarizedFiles.append(obj.behavDataPath)
+                except:
+                    print('error processing '+mouseId+', '+obj.startTime+'\n')
+                    traceback.print_exc()
         
-        df.to_excel(writer,sheet_name=obj.subjectName,index=False)
-        sheet = writer.sheets[obj.subjectName]
-        for col in ('ABCDEFGHIJK'):
-            if col in ('H','I','J','K','L'):
-                w = 10
-            elif col in ('B','G'):
-                w = 15
-            elif col=='C':
-                w = 40
-            else:
-                w = 30
-            sheet.column_dimensions[col].width = w
+            df.to_excel(writer,sheet_name=obj.subjectName,index=False)
+            sheet = writer.sheets[obj.subjectName]
+            for col in ('ABCDEFGHIJK'):
+                if col in ('H','I','J','K','L'):
+                    w = 10
+                elif col in ('B','G'):
+                    w = 15
+                elif col=='C':
+                    w = 40
+                else:
+                    w = 30
+                sheet.column_dimensions[col].width = w
        
-    allMiceDf.to_excel(writer,sheet_name='all mice',index=False)
-    sheet = writer.sheets['all mice']
-    for col in ('ABCDEFGHIJKLMNOPQR'):
-        if col == 'G':
-            w = 20
-        elif col == 'R':
-            w = 30
-        else:
-            w = 12
-        sheet.column_dimensions[col].width = w
-    writer.save()
-    writer.close()
+        if not allMiceDf.equals(allMiceDfOriginal):
+            allMiceDf.to_excel(writer,sheet_name='all mice',index=False)
+            sheet = writer.sheets['all mice']
+            for col in ('ABCDEFGHIJKLMNOPQR'):
+                if col == 'G':
+                    w = 20
+                elif col == 'R':
+                    w = 30
+                else:
+                    w = 12
+                sheet.column_dimensions[col].width = w
+        writer.save()
+        writer.close()
+
+    # update the index after the workbook is saved
+    addProcessedFiles(sessionIndex,summaryName,summarizedFiles)
+    sessionIndex.close()
     
     
+@lockSessionIndex()
 def updateTrainingSummaryNSB():
+    # only files not yet in the session index are loaded and only sheets of mice with new sessions are written
+    # holds the session index lock, so it cannot run concurrently with another training summary or manifest update
     excelPath = os.path.join(baseDir,'DynamicRoutingTrainingNSB.xlsx')
-    sheets = pd.read_excel(excelPath,sheet_name=None)
-    writer =  pd.ExcelWriter(excelPath,mode='a',engine='openpyxl',if_sheet_exists='replace',datetime_format='%Y%m%d_%H%M%S')
-    allMiceDf = sheets['all mice']
+    summaryName = os.path.basename(excelPath)
+    sessionIndex = openSessionIndex()
+    processedFiles = getProcessedFiles(sessionIndex,summaryName)
+    with pd.ExcelFile(excelPath) as xl:
+        allMiceDf = xl.parse('all mice')
 
-    mouseIds = allMiceDf['mouse id']
-    for mouseId in mouseIds:
-        mouseInd = np.where(allMiceDf['mouse id']==mouseId)[0][0]
-        if not allMiceDf.loc[mouseInd,'alive']:
-            continue
-        mouseId = str(mouseId)
-        mouseDir = allMiceDf.loc[mouseInd,'data path']
-        behavFiles = glob.glob(os.path.join(mouseDir,'**','DynamicRouting*.hdf5'))
-        behavFiles += glob.glob(os.path.join(baseDir,'Data',mouseId,'DynamicRouting*.hdf5'))
+        mouseIds = allMiceDf['mouse id']
+        mouseDirs = {}
+        for mouseId in mouseIds:
+            mouseInd = np.where(allMiceDf['mouse id']==mouseId)[0][0]
+            if not allMiceDf.loc[mouseInd,'alive']:
+                continue
+            mouseDirs[str(mouseId)] = (allMiceDf.loc[mouseInd,'data path'],os.path.join(baseDir,'Data',str(mouseId)))
+        # data path subdirectories hold the sessions
+        updateSessionManifest([dataPath for dataPath,_ in mouseDirs.values()],recursive=True,conn=sessionIndex)
+        updateSessionManifest([mouseDir for _,mouseDir in mouseDirs.values()],conn=sessionIndex)
+        newFiles = {}
+        for mouseId,(dataPath,mouseDir) in mouseDirs.items():
+            behavFiles = getSessionFiles(mouseId,dirPath=dataPath,recursive=True,conn=sessionIndex)['filePath'].tolist()
+            behavFiles += getSessionFiles(mouseId,dirPath=mouseDir,conn=sessionIndex)['filePath'].tolist()
+            files = [f for f in set(behavFiles) if f not in processedFiles]
+            if len(files) > 0:
+                newFiles[mouseId] = files
+        sheets = {mouseId: xl.parse(mouseId) for mouseId in newFiles if mouseId in xl.sheet_names}
+
+    # find new sessions for every mouse and load them together
+    filesToLoad = {}
+    summarizedFiles = [] # files with rows in the workbook
+    for mouseId,files in newFiles.items():
         df = sheets[mouseId] if mouseId in sheets else None
-        exps = []
-        for f in set(behavFiles):
+        filesToLoad[mouseId] = []
+        for f in files:
             startTime = re.search('.*_([0-9]{8}_[0-9]{6})',f).group(1)
             startTime = pd.to_datetime(startTime,format='%Y%m%d_%H%M%S')
             if df is None or np.sum(df['start time']==startTime) < 1:
+                filesToLoad[mouseId].append(f)
+            else:
+                summarizedFiles.append(f)
+    sessions = loadSessions([f for files in filesToLoad.values() for f in files],engagedThresh=10,skipErrors=True)
+    if len(sessions) > 0:
+        writer =  pd.ExcelWriter(excelPath,mode='a',engine='openpyxl',if_sheet_exists='replace',datetime_format='%Y%m%d_%H%M%S')
+        for mouseId,files in filesToLoad.items():
+            df = sheets[mouseId] if mouseId in sheets else None
+            exps = [obj for obj in sessions if obj.behavDataPath in files]
+            if len(exps) < 1:
+                continue
+            for obj in exps:
                 try:
-                    obj = DynRoutData()
-                    obj.loadBehavData(f,engagedThresh=10)
-                    exps.append(obj)
-                except Exception as err:
-                    print('\nerror loading '+f+'\n')
-                    print(repr(err))
-        if len(exps) < 1:
-            continue
-        exps = sortExps(exps)
-        for obj in exps:
-            try:
-                data = {'start time': pd.to_datetime(obj.startTime,format='%Y%m%d_%H%M%S'),
-                        'rig name': obj.rigName,
-                        'computer name': obj.computerName,
-                        'task version': obj.taskVersion,
-                        'hits': obj.hitCount,
-                        'd\' same modality': np.round(obj.dprimeSameModal,2),
-                        'd\' other modality go stim': np.round(obj.dprimeOtherModalGo,2),
-                        'quiescent violations': obj.quiescentViolationFrames.size,
-                        'ignore': 0,
-                        'hab': 0,
-                        'ephys': 0,
-                        'muscimol': 0}  
-                if df is None:
-                    df = pd.DataFrame(data)
-                    sessionInd = 0
-                else:
-                    sessionInd = df['start time'] == data['start time']
-                    sessionInd = np.where(sessionInd)[0][0] if sessionInd.sum()>0 else df.shape[0]
-                    df.loc[sessionInd] = list(data.values())
-            except:
-                print('error processing '+mouseId+', '+obj.startTime+'\n')
-                traceback.print_exc()
+                    data = {'start time': pd.to_datetime(obj.startTime,format='%Y%m%d_%H%M%S'),
+                            'rig name': obj.rigName,
+                            'computer name': obj.computerName,
+                            'task version': obj.taskVersion,
+                            'hits': obj.hitCount,
+                            'd\' same modality': np.round(obj.dprimeSameModal,2),
+                            'd\' other modality go stim': np.round(obj.dprimeOtherModalGo,2),
+                            'quiescent violations': obj.quiescentViolationFrames.size,
+                            'ignore': 0,
+                            'hab': 0,
+                            'ephys': 0,
+                            'muscimol': 0}  
+                    if df is None:
+                        df = pd.DataFrame(data)
+                        sessionInd = 0
+                    else:
+                        sessionInd = df['start time'] == data['start time']
+                        sessionInd = np.where(sessionInd)[0][0] if sessionInd.sum()>0 else df.shape[0]
+                        df.loc[sessionInd] = list(data.values())
+                    summarizedFiles.append(obj.behavDataPath)
+                except:
+                    print('error processing '+mouseId+', '+obj.startTime+'\n')
+                    traceback.print_exc()
         
-        df.to_excel(writer,sheet_name=obj.subjectName,index=False)
-        sheet = writer.sheets[obj.subjectName]
-        for col in ('ABCDEFGHIJK'):
-            if col in ('I','J','K','L'):
-                w = 10
-            elif col in ('B','C','H'):
-                w = 15
-            elif col=='D':
-                w = 40
-            else:
-                w = 30
-            sheet.column_dimensions[col].width = w
+            df.to_excel(writer,sheet_name=obj.subjectName,index=False)
+            sheet = writer.sheets[obj.subjectName]
+            for col in ('ABCDEFGHIJK'):
+                if col in ('I','J','K','L'):
+                    w = 10
+                elif col in ('B','C','H'):
+                    w = 15
+                elif col=='D':
+                    w = 40
+                else:
+                    w = 30
+                sheet.column_dimensions[col].width = w
     
-    writer.save()
-    writer.close()
+        writer.save()
+        writer.close()
+
+    # update the index after the workbook is saved
+    addProcessedFiles(sessionIndex,summaryName,summarizedFiles)
+    sessionIndex.close()
 
 
 def fitCurve(func,x,y,initGuess=None,bounds=None):
@@ -6,6 +6,8 @@ Created on Wed Oct 19 14:37:16 2022
 """
 
 import argparse
+import concurrent.futures
+import hashlib
 import itertools
 import os
 import pathlib
@@ -14,6 +16,7 @@ import numpy as np
 import pandas as pd
 import scipy.optimize
 import scipy.stats
+from scipy.optimize._differentialevolution import DifferentialEvolutionSolver
 import sklearn.metrics
 import psytrack
 import ssm
@@ -61,15 +64,62 @@ def calcLogisticProb(q,beta,bias,lapse):
     return (1 - lapse) / (1 + np.exp(-beta * (q - 0.5 + bias)))
 
 
+class TrialTensor():
+    # compact, array-only trial data for one session consumed by runModel and runModelBatch;
+    # compiled once per session (compileTrialTensor) and cheap to pickle to worker processes
+    
+    stimNames = ('vis1','vis2','sound1','sound2')
+    
+    def optoMask(self,optoLabel):
+        return np.isin(self.trialOptoLabelIndex,[i for i,lbl in enumerate(self.optoLabels) if lbl in optoLabel])
+# end TrialTensor
+
+
+def compileTrialTensor(obj):
+    if any(stim != 'catch' and stim not in TrialTensor.stimNames for stim in obj.trialStim):
+        raise ValueError('RL model does not support multimodal stimuli: ' + obj.subjectName + ' ' + obj.startTime)
+    tensor = TrialTensor()
+    tensor.subjectName = obj.subjectName
+    tensor.startTime = obj.startTime
+    tensor.nTrials = obj.nTrials
+    tensor.trialResponse = np.array(obj.trialResponse,dtype=bool)
+    
+    # stimulus index into stimNames (-1 for catch) and modality (0 vis, 1 aud) carried forward through catch trials
+    tensor.stimIndex = np.array([TrialTensor.stimNames.index(stim) if stim != 'catch' else -1 for stim in obj.trialStim],dtype=np.int8)
+    tensor.modality = np.zeros(obj.nTrials,dtype=np.int8)
+    modality = 0
+    for trial,stimInd in enumerate(tensor.stimIndex):
+        if stimInd >= 0:
+            modality = stimInd // 2
+        tensor.modality[trial] = modality
+    
+    tensor.rewarded = np.array([stim == rew for stim,rew in zip(obj.trialStim,obj.rewardedStim)],dtype=bool)
+    tensor.autoReward = np.array(obj.autoRewardScheduled,dtype=bool)
+    
+    tensor.stimStartTimes = np.array(obj.stimStartTimes,dtype=float)
+    tensor.iti = np.append(np.diff(tensor.stimStartTimes),np.nan)
+    blockStartTimes = {blk: tensor.stimStartTimes[np.where(obj.trialBlock==blk)[0][0]] for blk in np.unique(obj.trialBlock)}
+    tensor.blockStartTimes = np.array([blockStartTimes[blk] for blk in obj.trialBlock])
+    
+    trialOptoLabel = obj.trialOptoLabel if hasattr(obj,'trialOptoLabel') else np.full(obj.nTrials,'no opto')
+    optoLabels,tensor.trialOptoLabelIndex = np.unique(np.array(trialOptoLabel,dtype=str),return_inverse=True)
+    tensor.optoLabels = tuple(optoLabels)
+    tensor.trialOptoLabelIndex = tensor.trialOptoLabelIndex.astype(np.int8)
+    return tensor
+
+
 def runModel(obj,betaAction,biasAction,lapseRate,biasAttention,visConfidence,audConfidence,
              wContext,alphaContext,alphaContextNeg,decayContext,blockTiming,blockTimingShape,
              alphaReinforcement,alphaReinforcementNeg,wPerseveration,alphaPerseveration,tauPerseveration,
              rewardBias,rewardBiasTau,noRewardBias,noRewardBiasTau,
              betaActionOpto,biasActionOpto,optoLabel=None,useChoiceHistory=True,nReps=1):
 
-    stimNames = ('vis1','vis2','sound1','sound2')
+    if not isinstance(obj,TrialTensor):
+        obj = compileTrialTensor(obj)
+    isOpto = np.zeros(obj.nTrials,dtype=bool) if optoLabel is None else obj.optoMask(optoLabel)
+
+    stimNames = TrialTensor.stimNames
     stimConfidence = [visConfidence,audConfidence]
-    modality = 0
 
     pContext = 0.5 + np.zeros((nReps,obj.nTrials,2))
     qContext = np.array([visConfidence,1-visConfidence,audConfidence,1-audConfidence])
@@ -91,18 +141,19 @@ def runModel(obj,betaAction,biasAction,lapseRate,biasAttention,visConfidence,aud
     
     for i in range(nReps):
         lastRewardTime = 0
-        for trial,stim in enumerate(obj.trialStim):
-            if optoLabel is not None and obj.trialOptoLabel[trial] in optoLabel:
+        for trial in range(obj.nTrials):
+            stimInd = obj.stimIndex[trial]
+            modality = obj.modality[trial]
+            if isOpto[trial]:
                 betaAct = betaActionOpto if betaActionOpto is not None else betaAction
                 biasAct = biasActionOpto if biasActionOpto is not None else biasAction
             else:
                 betaAct = betaAction
                 biasAct = biasAction 
 
-            if stim != 'catch':
-                modality = 0 if 'vis' in stim else 1
+            if stimInd >= 0:
                 pStim = np.zeros(len(stimNames))
-                pStim[[stim[:-1] in s for s in stimNames]] = [stimConfidence[modality],1-stimConfidence[modality]] if '1' in stim else [1-stimConfidence[modality],stimConfidence[modality]]
+                pStim[2*modality:2*modality+2] = [stimConfidence[modality],1-stimConfidence[modality]] if stimInd % 2 == 0 else [1-stimConfidence[modality],stimConfidence[modality]]
                 if biasAttention > 0:
                     pStim[-2:] *= 1 - biasAttention
                 else:
@@ -136,12 +187,12 @@ def runModel(obj,betaAction,biasAction,lapseRate,biasAttention,visConfidence,aud
                 qReward[i,trial+1] = qReward[i,trial]
                 qNoReward[i,trial+1] = qNoReward[i,trial]
                 
-                outcome = (action[i,trial] and stim == obj.rewardedStim[trial]) or obj.autoRewardScheduled[trial]
-                resp = action[i,trial] or obj.autoRewardScheduled[trial]
+                outcome = (action[i,trial] and obj.rewarded[trial]) or obj.autoReward[trial]
+                resp = action[i,trial] or obj.autoReward[trial]
                 if outcome:
                     lastRewardTime = obj.stimStartTimes[trial]
                 
-                if stim != 'catch':
+                if stimInd >= 0:
                     if resp:
                         if not np.isnan(alphaContext):
                             if outcome:
@@ -162,13 +213,13 @@ def runModel(obj,betaAction,biasAction,lapseRate,biasAttention,visConfidence,aud
                         qPerseveration[i,trial+1] += alphaPerseveration * pStim * (action[i,trial] - qPerseveration[i,trial])
                         qPerseveration[i,trial+1] = np.clip(qPerseveration[i,trial+1],0,1)
                 
-                iti = obj.stimStartTimes[trial+1] - obj.stimStartTimes[trial]
+                iti = obj.iti[trial]
 
                 decay = 0
                 if not np.isnan(decayContext):
                     decay += (1 - np.exp(-iti/decayContext)) * (0.5 - pContext[i,trial+1,modality])
                 if not np.isnan(blockTiming):
-                    blockTime = obj.stimStartTimes[trial+1] - obj.stimStartTimes[np.where(obj.trialBlock==obj.trialBlock[trial])[0][0]]
+                    blockTime = obj.stimStartTimes[trial+1] - obj.blockStartTimes[trial]
                     if blockTime > 600 / blockTimingShape / 2:
                         blockTimeAmp = (np.cos((2 * np.pi * blockTimingShape * (600 - blockTime)) / 600) + 1) / 2
                         decay += (blockTiming * blockTimeAmp) * (0.5 - pContext[i,trial+1,modality])
@@ -192,10 +243,147 @@ def runModel(obj,betaAction,biasAction,lapseRate,biasAttention,visConfidence,aud
     return pContext, qReinforcement, qPerseveration, qReward, qTotal, pAction, action
 
 
+def runModelBatch(obj,params,optoLabel=None):
+    # evaluates a population of parameter vectors (nParams x nCandidates) against one session
+    # using the choice history; steps through trials once, vectorized over candidates
+    # returns pAction (nCandidates x nTrials), identical to runModel(...)[-2][0] for each candidate
+    if not isinstance(obj,TrialTensor):
+        obj = compileTrialTensor(obj)
+    (betaAction,biasAction,lapseRate,biasAttention,visConfidence,audConfidence,
+     wContext,alphaContext,alphaContextNeg,decayContext,blockTiming,blockTimingShape,
+     alphaReinforcement,alphaReinforcementNeg,wPerseveration,alphaPerseveration,tauPerseveration,
+     rewardBias,rewardBiasTau,noRewardBias,noRewardBiasTau,
+     betaActionOpto,biasActionOpto) = np.asarray(params,dtype=float)
+    nCandidates = betaAction.size
+
+    isOpto = np.zeros(obj.nTrials,dtype=bool) if optoLabel is None else obj.optoMask(optoLabel)
+
+    hasContext = ~np.isnan(wContext)
+    hasAlphaContext = ~np.isnan(alphaContext)
+    hasAlphaContextNeg = ~np.isnan(alphaContextNeg)
+    hasDecayContext = ~np.isnan(decayContext)
+    hasBlockTiming = ~np.isnan(blockTiming)
+    hasAlphaReinforcement = ~np.isnan(alphaReinforcement)
+    hasAlphaReinforcementNeg = ~np.isnan(alphaReinforcementNeg)
+    hasPerseveration = ~np.isnan(wPerseveration)
+    hasTauPerseveration = ~np.isnan(tauPerseveration)
+    hasRewardBias = ~np.isnan(rewardBias)
+    hasNoRewardBias = ~np.isnan(noRewardBias)
+    contextOnly = ~hasContext & hasAlphaContext
+
+    stimConfidence = np.stack((visConfidence,audConfidence),axis=1)
+    qContext = np.stack((visConfidence,1-visConfidence,audConfidence,1-audConfidence),axis=1)
+
+    pContext = np.full((nCandidates,2),0.5)
+    qReinforcement = qContext.copy()
+    qPerseveration = np.zeros((nCandidates,4))
+    qReward = np.zeros(nCandidates)
+    qNoReward = np.zeros(nCandidates)
+    pAction = np.zeros((nCandidates,obj.nTrials))
+
+    lastRewardTime = 0
+    for trial in range(obj.nTrials):
+        stimInd = obj.stimIndex[trial]
+        modality = obj.modality[trial]
+        if isOpto[trial]:
+            betaAct = betaActionOpto
+            biasAct = biasActionOpto
+        else:
+            betaAct = betaAction
+            biasAct = biasAction
+
+        if stimInd >= 0:
+            conf = stimConfidence[:,modality]
+            pStim = np.zeros((nCandidates,4))
+            if stimInd % 2 == 0:
+                pStim[:,2*modality] = conf
+                pStim[:,2*modality+1] = 1 - conf
+            else:
+                pStim[:,2*modality] = 1 - conf
+                pStim[:,2*modality+1] = conf
+            pStim[:,2:] *= np.where(biasAttention > 0,1 - biasAttention,1)[:,None]
+            pStim[:,:2] *= np.where(biasAttention > 0,1,1 + biasAttention)[:,None]
+
+            pContextStim = np.repeat(pContext,2,axis=1)
+            valueReinforcement = np.sum(qReinforcement * pStim,axis=1)
+            expectedValue = np.where(hasContext,
+                                     (wContext * np.sum(qContext * pStim * pContextStim,axis=1)) + ((1-wContext) * valueReinforcement),
+                                     np.where(hasAlphaContext,np.sum(qReinforcement * pStim * pContextStim,axis=1),valueReinforcement))
+            qTotal = np.where(hasPerseveration,
+                              ((1 - wPerseveration) * expectedValue) + (wPerseveration * np.sum(qPerseveration * pStim,axis=1)),
+                              expectedValue)
+            qTotal += qReward + qNoReward
+            pAction[:,trial] = calcLogisticProb(qTotal,betaAct,biasAct,lapseRate)
+            action = bool(obj.trialResponse[trial])
+        else:
+            action = False
+
+        if trial+1 < obj.nTrials:
+            pContextNext = pContext.copy()
+            qReinforcementNext = qReinforcement.copy()
+            qPerseverationNext = qPerseveration.copy()
+
+            outcome = bool((action and obj.rewarded[trial]) or obj.autoReward[trial])
+            resp = action or bool(obj.autoReward[trial])
+            if outcome:
+                lastRewardTime = obj.stimStartTimes[trial]
+
+            if stimInd >= 0:
+                if resp:
+                    if outcome:
+                        contextError = 1 - pContext[:,modality]
+                        alphaC = alphaContext
+                        alphaR = alphaReinforcement
+                    else:
+                        contextError = -pContext[:,modality] * pStim[:,2*modality]
+                        alphaC = np.where(hasAlphaContextNeg,alphaContextNeg,alphaContext)
+                        alphaR = np.where(hasAlphaReinforcementNeg,alphaReinforcementNeg,alphaReinforcement)
+                    pContextNext[:,modality] = np.where(hasAlphaContext,
+                                                        np.clip(pContextNext[:,modality] + contextError * alphaC,0,1),
+                                                        pContextNext[:,modality])
+
+                    predictionError = pStim * (outcome - qReinforcement)
+                    predictionError = np.where(contextOnly[:,None],predictionError * pContextStim,predictionError)
+                    qReinforcementNext = np.where(hasAlphaReinforcement[:,None],
+                                                  np.clip(qReinforcementNext + predictionError * alphaR[:,None],0,1),
+                                                  qReinforcementNext)
+
+                qPerseverationNext = np.where(hasPerseveration[:,None],
+                                              np.clip(qPerseverationNext + alphaPerseveration[:,None] * pStim * (action - qPerseveration),0,1),
+                                              qPerseverationNext)
+
+            iti = obj.iti[trial]
+
+            decay = np.where(hasDecayContext,(1 - np.exp(-iti/decayContext)) * (0.5 - pContextNext[:,modality]),0)
+            blockTime = obj.stimStartTimes[trial+1] - obj.blockStartTimes[trial]
+            blockTimeAmp = (np.cos((2 * np.pi * blockTimingShape * (600 - blockTime)) / 600) + 1) / 2
+            decay += np.where(hasBlockTiming & (blockTime > 600 / blockTimingShape / 2),
+                              (blockTiming * blockTimeAmp) * (0.5 - pContextNext[:,modality]),0)
+            pContextNext[:,modality] += decay
+            pContextNext[:,(1 if modality==0 else 0)] = 1 - pContextNext[:,modality]
+
+            qPerseverationNext = np.where(hasTauPerseveration[:,None],qPerseverationNext * np.exp(-iti/tauPerseveration)[:,None],qPerseverationNext)
+
+            qReward = np.where(hasRewardBias,(qReward + (rewardBias if outcome else 0)) * np.exp(-iti/rewardBiasTau),qReward)
+
+            if outcome:
+                qNoReward = np.where(hasNoRewardBias,0,qNoReward)
+            else:
+                qNoReward = np.where(hasNoRewardBias,noRewardBias * np.exp((obj.stimStartTimes[trial+1] - lastRewardTime)/noRewardBiasTau),qNoReward)
+
+            pContext = pContextNext
+            qReinforcement = qReinforcementNext
+            qPerseveration = qPerseverationNext
+
+    return pAction
+
+
 def insertFixedParamVals(fitParams,fixedInd,fixedVal):
+    # fitParams can be 1d or nFitParams x nCandidates (differential_evolution vectorized=True)
+    fitParams = np.asarray(fitParams)
     nParams = len(fitParams) + len(fixedInd)
-    params = np.full(nParams,np.nan)
-    params[fixedInd] = fixedVal
+    params = np.full((nParams,)+fitParams.shape[1:],np.nan)
+    params[fixedInd] = np.reshape(fixedVal,(len(fixedInd),)+(1,)*(fitParams.ndim-1))
     params[[i for i in range(nParams) if i not in fixedInd]] = fitParams
     return params
 
@@ -259,6 +447,8 @@ def evalModel(params,*args):
     trainData,trainingPhase,trainDataTrialCluster,clust,fixedInd,fixedVal,modelType,modelTypeDict = args
     if fixedInd is not None:
         params = insertFixedParamVals(params,fixedInd,fixedVal)
+    if np.ndim(params) > 1 and modelType in ('psytrack','glmhmm'):
+        return np.array([evalModel(prms,trainData,trainingPhase,trainDataTrialCluster,clust,None,None,modelType,modelTypeDict) for prms in params.T])
     if modelType == 'psytrack':
         d,weights,hyper,optList = getModelRegressors(modelType,modelTypeDict,params,trainData)
         try:
@@ -278,21 +468,125 @@ def evalModel(params,*args):
         return -fitLL[-1]
     else:
         response = np.concatenate([obj.trialResponse for obj in trainData])
-        prediction = np.concatenate([runModel(obj,*params,**modelTypeDict)[-2][0] for obj in trainData])
         if clust is not None:
             trials = np.concatenate(trainDataTrialCluster) == clust
         elif 'optoLabel' in modelTypeDict and modelTypeDict['optoLabel'] is not None:
-            trials = np.concatenate([np.in1d(obj.trialOptoLabel,('no opto',)+modelTypeDict['optoLabel']) for obj in trainData])
+            trials = np.concatenate([obj.optoMask(('no opto',)+modelTypeDict['optoLabel']) for obj in trainData])
         else:
             trials = np.ones(response.size,dtype=bool)
         response = response[trials]
+        if np.ndim(params) > 1:
+            # population of candidates from differential_evolution(vectorized=True)
+            prediction = np.concatenate([runModelBatch(obj,params,**modelTypeDict) for obj in trainData],axis=1)
+            return np.array([sklearn.metrics.log_loss(response,p[trials]) for p in prediction])
+        prediction = np.concatenate([runModel(obj,*params,**modelTypeDict)[-2][0] for obj in trainData])
         prediction = prediction[trials]
         logLoss = sklearn.metrics.log_loss(response,prediction)
         # logLoss += -np.log(calcPrior(params))
         return logLoss
 
 
-def fitModel(mouseId,trainingPhase,testData,trainData):
+def getPooledObjective(executor,nChunks):
+    # split each vectorized population evaluation into chunks of candidates evaluated in parallel
+    def evalModelPooled(params,*args):
+        if params.ndim == 1:
+            return evalModel(params,*args)
+        chunks = np.array_split(params,min(nChunks,params.shape[1]),axis=1)
+        futures = [executor.submit(evalModel,chunk,*args) for chunk in chunks]
+        return np.concatenate([f.result() for f in futures])
+    return evalModelPooled
+
+
+def saveCheckpoint(filePath,**kwargs):
+    # write to a temporary file first so a job killed mid-write leaves the previous checkpoint intact
+    tmpPath = filePath + '.tmp'
+    with open(tmpPath,'wb') as f:
+        np.savez(f,**kwargs)
+    os.replace(tmpPath,filePath)
+
+
+def getCheckpointPath(filePath,fixedPrms,clust,bounds):
+    # checkpoint file for one fit, named by what is fitted so a checkpoint is never applied to a different fit
+    fitKey = repr((sorted(fixedPrms),clust,[tuple(float(b) for b in bnds) for bnds in bounds]))
+    return filePath[:-4] + '_checkpoint_' + hashlib.sha1(fitKey.encode()).hexdigest()[:16] + '.npz'
+
+
+def runDifferentialEvolution(func,bounds,args,fitFuncParams,checkpointPath=None):
+    # differential_evolution that saves the population, energies and rng state after every generation
+    # and continues from the last saved generation if the checkpoint file already exists
+    # resuming sets private solver attributes, so an unfinished checkpoint saved by a different scipy version is not used
+    if checkpointPath is None:
+        return scipy.optimize.differential_evolution(func,bounds,args=args,**fitFuncParams)
+
+    checkpoint = None
+    if os.path.exists(checkpointPath):
+        with np.load(checkpointPath,allow_pickle=True) as f:
+            checkpoint = dict(f)
+        if 'x' in checkpoint:
+            return scipy.optimize.OptimizeResult(x=checkpoint['x'],fun=float(checkpoint['fun']),message=str(checkpoint['message']))
+        if 'scipyVersion' not in checkpoint or str(checkpoint['scipyVersion']) != scipy.__version__:
+            print('\n' + 'could not resume from ' + checkpointPath + ' (saved with a different scipy version); starting over')
+            checkpoint = None
+
+    nit = 0 if checkpoint is None else int(checkpoint['nit'])
+    solverRef = []
+    def saveState(*args,**kwargs):
+        nonlocal nit
+        nit += 1
+        solver = solverRef[0]
+        rng = solver.random_number_generator
+        rngState = rng.bit_generator.state if isinstance(rng,np.random.Generator) else rng.get_state(legacy=False)
+        state = {'population': solver.population,'populationEnergies': solver.population_energies,'nfev': solver._nfev,'nit': nit,
+                 'rngState': np.array(rngState,dtype=object),'scipyVersion': scipy.__version__}
+        if hasattr(solver,'_random_population_index'):
+            # the solver shuffles this index in place when selecting samples
+            state['randomPopulationIndex'] = solver._random_population_index
+        saveCheckpoint(checkpointPath,**state)
+
+    solverParams = dict(fitFuncParams,maxiter=fitFuncParams.get('maxiter',1000)-nit,callback=saveState)
+    if solverParams.get('rng') is not None:
+        # differential_evolution passes rng through np.random.default_rng before creating the solver
+        solverParams['rng'] = np.random.default_rng(solverParams['rng'])
+    with DifferentialEvolutionSolver(func,bounds,args=args,**solverParams) as solver:
+        solverRef.append(solver)
+        if checkpoint is not None:
+            solver.population = checkpoint['population']
+            solver.population_energies = checkpoint['populationEnergies']
+            solver._nfev = int(checkpoint['nfev'])
+            if 'randomPopulationIndex' in checkpoint:
+                solver._random_population_index = checkpoint['randomPopulationIndex']
+            rng = solver.random_number_generator
+            if isinstance(rng,np.random.Generator):
+                rng.bit_generator.state = checkpoint['rngState'].item()
+            else:
+                rng.set_state(checkpoint['rngState'].item())
+        fit = solver.solve()
+    saveCheckpoint(checkpointPath,x=fit.x,fun=fit.fun,message=fit.message)
+    return fit
+
+
+def runFits(fits,fitFuncParams,nWorkers=1,checkpointPaths=None):
+    # fits is a list of (bounds,args) for differential_evolution or None
+    # checkpointPaths is an optional list of files (one per fit) for saving and resuming the optimizer state
+    # with nWorkers > 1, fits run concurrently and share one process pool for evaluating the population
+    if checkpointPaths is None:
+        checkpointPaths = [None] * len(fits)
+    toFit = [fit for fit in fits if fit is not None]
+    if nWorkers > 1 and len(toFit) > 0:
+        with concurrent.futures.ProcessPoolExecutor(nWorkers) as executor, concurrent.futures.ThreadPoolExecutor(len(toFit)) as fitExecutor:
+            if fitFuncParams.get('vectorized',False):
+                func = getPooledObjective(executor,nWorkers)
+                funcParams = fitFuncParams
+            else:
+                func = evalModel
+                funcParams = dict(fitFuncParams,workers=executor.map,updating='deferred')
+            futures = [None if fit is None else fitExecutor.submit(runDifferentialEvolution,func,fit[0],fit[1],funcParams,checkpointPath) for fit,checkpointPath in zip(fits,checkpointPaths)]
+            return [None if f is None else f.result() for f in futures]
+    else:
+        return [None if fit is None else runDifferentialEvolution(evalModel,fit[0],fit[1],fitFuncParams,checkpointPath) for fit,checkpointPath in zip(fits,checkpointPaths)]
+
+
+def fitModel(mouseId,trainingPhase,testData,trainData,nWorkers=1):
 
     modelParams = {'betaAction': {'bounds': (1,40), 'fixedVal': np.nan},
                    'biasAction': {'bounds': (-1,1), 'fixedVal': 0},
@@ -319,6 +613,9 @@ def fitModel(mouseId,trainingPhase,testData,trainData):
                    'biasActionOpto': {'bounds': (-1,1), 'fixedVal': np.nan}}
     modelParamNames = list(modelParams.keys())
 
+    # compile trial data once per session; the model kernels only see these arrays
+    trainData = [compileTrialTensor(obj) for obj in trainData]
+
     modelTypeParams = ('optoLabel',)
     modelTypes,modelTypeParamVals = zip(
                                         ('basicRL', (None,)),
@@ -342,7 +639,8 @@ def fitModel(mouseId,trainingPhase,testData,trainData):
         clustIds = (None,)
 
     # fitFuncParams = {'eps': 1e-3,'maxfun': None,'maxiter': int(1e3),'locally_biased': False,'vol_tol': 1e-16,'len_tol': 1e-6}
-    fitFuncParams = {'mutation': (0.5,1),'recombination': 0.7,'popsize': 16,'strategy': 'best1bin', 'init': 'sobol'}
+    fitFuncParams = {'mutation': (0.5,1),'recombination': 0.7,'popsize': 16,'strategy': 'best1bin', 'init': 'sobol',
+                     'vectorized': True, 'updating': 'deferred'} # evaluate whole population per call with runModelBatch
 
     for modelType,modelTypeVals in zip(modelTypes,modelTypeParamVals):
         fileName = str(mouseId)+'_'+testData.startTime+'_'+trainingPhase+'_'+modelType+'.npz'
@@ -377,13 +675,37 @@ def fitModel(mouseId,trainingPhase,testData,trainData):
                             'betaActionOpto','biasActionOpto'] +
                             prms for prms in ([],)]
         modelTypeDict = {p: v for p,v in zip(modelTypeParams,modelTypeVals)}
+        fits = [] # (bounds,args) for each fixed param variant and cluster, or None if there is nothing to fit
+        checkpointPaths = [] # each fit is checkpointed so a restarted job continues where it stopped
+        for fixedPrms in fixedParams:
+            fixedParamIndices = [modelParamNames.index(prm) for prm in fixedPrms]
+            fixedParamValues = [modelParams[prm]['fixedVal'] for prm in fixedPrms]
+            bounds = tuple(modelParams[prm]['bounds'] for prm in modelParamNames if prm not in fixedPrms)
+            for clust in clustIds:
+                checkpointPaths.append(getCheckpointPath(filePath,fixedPrms,clust,bounds))
+                if clust is None:
+                    trData = trainData
+                    trClust = trainDataTrialCluster
+                else:
+                    trainSessionsWithClust = [(obj,trialCluster) for obj,trialCluster in zip(trainData,trainDataTrialCluster) if np.any(trialCluster==clust)]
+                    if np.any(testDataTrialCluster==clust) and len(trainSessionsWithClust) > 0:
+                        trData,trClust = zip(*trainSessionsWithClust)
+                    else:
+                        fits.append(None)
+                        continue
+                fits.append((bounds,(trData,trainingPhase,trClust,clust,fixedParamIndices,fixedParamValues,modelType,modelTypeDict)))
+        
+        # fit with direct or differential_evolution
+        fits = runFits(fits,fitFuncParams,nWorkers,checkpointPaths)
+
+        # collect results in the same order as the serial fits so the saved file layout is unchanged
         params = []
         logLoss = []
         terminationMessage = []
+        fitIter = iter(fits)
         for fixedPrms in fixedParams:
             fixedParamIndices = [modelParamNames.index(prm) for prm in fixedPrms]
             fixedParamValues = [modelParams[prm]['fixedVal'] for prm in fixedPrms]
-            bounds = tuple(modelParams[prm]['bounds'] for prm in modelParamNames if prm not in fixedPrms)
             if trainingPhase == 'clusters':
                 params.append([])
                 logLoss.append([])
@@ -396,27 +718,21 @@ def fitModel(mouseId,trainingPhase,testData,trainData):
                 nll = logLoss
                 tm = terminationMessage
             for clust in clustIds:
-                if clust is None:
-                    trData = trainData
-                    trClust = trainDataTrialCluster
+                fit = next(fitIter)
+                if fit is None:
+                    prms.append(np.full(len(modelParams),np.nan))
+                    nll.append(np.nan)
+                    tm.append('')
                 else:
-                    trainSessionsWithClust = [(obj,trialCluster) for obj,trialCluster in zip(trainData,trainDataTrialCluster) if np.any(trialCluster==clust)]
-                    if np.any(testDataTrialCluster==clust) and len(trainSessionsWithClust) > 0:
-                        trData,trClust = zip(*trainSessionsWithClust)
-                    else:
-                        prms.append(np.full(len(modelParams),np.nan))
-                        nll.append(np.nan)
-                        tm.append('')
-                        continue
-                
-                # fit with direct or differential_evolution
-                fit = scipy.optimize.differential_evolution(evalModel,bounds,args=(trData,trainingPhase,trClust,clust,fixedParamIndices,fixedParamValues,modelType,modelTypeDict),**fitFuncParams)
-                prms.append(insertFixedParamVals(fit.x,fixedParamIndices,fixedParamValues))
-                nll.append(fit.fun)
-                tm.append(fit.message)
+                    prms.append(insertFixedParamVals(fit.x,fixedParamIndices,fixedParamValues))
+                    nll.append(fit.fun)
+                    tm.append(fit.message)
 
         np.savez(filePath,params=params,logLoss=logLoss,terminationMessage=terminationMessage,
                  trainSessions=[obj.startTime for obj in trainData],**modelTypeDict) 
+        for checkpointPath in checkpointPaths:
+            if os.path.exists(checkpointPath):
+                os.remove(checkpointPath)
         
 
 if __name__ == "__main__":
@@ -424,8 +740,9 @@ if __name__ == "__main__":
     parser.add_argument('--mouseId',type=int)
     parser.add_argument('--sessionIndex',type=int)
     parser.add_argument('--trainingPhase',type=str)
+    parser.add_argument('--nWorkers',type=int,default=1)
     args = parser.parse_args()
     trainingPhase = args.trainingPhase.replace('_',' ')
     crossValMethod = 'sessions' # 'sessions' or 'blocks'
     testData,trainData = getSessionsToFit(args.mouseId,trainingPhase,args.sessionIndex,crossValMethod)
-    fitModel(args.mouseId,trainingPhase,testData,trainData)
+    fitModel(args.mouseId,trainingPhase,testData,trainData,args.nWorkers)
@@ -13,7 +13,7 @@ import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.rcParams['pdf.fonttype'] = 42
-from DynamicRoutingAnalysisUtils import DynRoutData
+from DynamicRoutingAnalysisUtils import loadBehavDataCached,findSessionFiles
 
 
 baseDir = r"\\allen\programs\mindscope\workgroups\dynamicrouting"
@@ -44,10 +44,9 @@ areaNames = np.unique(df['area'])
 
 def getSessionObj(df,sessionInd):
     sessionName = np.array(df['session'])[sessionInd]
-    fileName = 'DynamicRouting1_' + sessionName.replace('-','') + '*.hdf5'
-    filePath = glob.glob(os.path.join(baseDir,'DynamicRoutingTask','Data',sessionName[:6],fileName))
-    obj = DynRoutData()
-    obj.loadBehavData(filePath[0])
+    mouseDir = os.path.join(baseDir,'DynamicRoutingTask','Data',sessionName[:6])
+    filePath = findSessionFiles(sessionName[:6],mouseDir,startTime=sessionName[7:].replace('-',''),taskName='DynamicRouting1')
+    obj = loadBehavDataCached(filePath[0])
     return obj
 
 
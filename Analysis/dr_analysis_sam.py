@@ -17,7 +17,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.rcParams['pdf.fonttype'] = 42
 import fileIO
-from DynamicRoutingAnalysisUtils import DynRoutData,sortExps,updateTrainingSummary,updateTrainingSummaryNSB
+from DynamicRoutingAnalysisUtils import DynRoutData,sortExps,updateTrainingSummary,updateTrainingSummaryNSB,findSessionFiles
 from DynamicRoutingAnalysisUtils import fitCurve,calcLogisticDistrib,calcWeibullDistrib,inverseLogistic,inverseWeibull
 
 
@@ -2287,11 +2287,13 @@ for mid in mouseIds:
         mouseDir = os.path.join(baseDir,'Data',mid)
         if not os.path.isdir(mouseDir):
             continue
-        behavFiles = glob.glob(os.path.join(mouseDir,'*.hdf5'))
+        behavFiles = findSessionFiles(mid,mouseDir,taskName='')
         exps = []
         for f in behavFiles:
             obj = DynRoutData()
-            obj.loadBehavData(f)
+            obj.loadBehavData(f,lazy=True)
+            obj.startTime # read session info for sorting, then close the file until more is needed
+            obj.closeBehavDataFile()
             exps.append(obj)
         exps = sortExps(exps)
         for obj in exps:
@@ -2301,6 +2303,7 @@ for mid in mouseIds:
                 regimenNum.append(regimen[mouseInd])
                 timeoutDur.append(obj.incorrectTimeoutFrames/obj.frameRate)
                 falseAlarms.append(obj.falseAlarmTrials.sum())
+                obj.closeBehavDataFile()
 stageNum = np.array(stageNum)
 regimenNum = np.array(regimenNum)
 timeoutDur = np.array(timeoutDur)
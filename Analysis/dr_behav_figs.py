@@ -13,7 +13,7 @@ import scipy
 import matplotlib
 import matplotlib.pyplot as plt
 matplotlib.rcParams['pdf.fonttype'] = 42
-from DynamicRoutingAnalysisUtils import getPerformanceStats,getFirstExperimentSession,getSessionsToPass,getSessionData,pca,cluster,calcDprime
+from DynamicRoutingAnalysisUtils import getPerformanceStats,getFirstExperimentSession,getSessionsToPass,getSessionData,getSessionFilePath,loadSessions,pca,cluster,calcDprime
 
 
 baseDir = r"\\allen\programs\mindscope\workgroups\dynamicrouting"
@@ -452,9 +452,9 @@ for mid in mice:
         ephysMice.append(mid)
         sessions = np.array(['stage 5' in task for task in df['task version']]) & ~np.array(df['ignore'].astype(bool))
         firstHab = np.where(df[sessions]['hab'])[0][0]
-        preHabSessions.append([getSessionData(mid,startTime) for startTime in df.loc[np.where(sessions)[0][firstHab-nSessions:firstHab],'start time']])
-        habSessions.append([getSessionData(mid,startTime) for startTime in df[np.array(df['hab']).astype(bool)]['start time']])
-        ephysSessions.append([getSessionData(mid,startTime) for startTime in df[np.array(df['ephys']).astype(bool)]['start time']])
+        preHabSessions.append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df.loc[np.where(sessions)[0][firstHab-nSessions:firstHab],'start time']],workers=1,useCache=True))
+        habSessions.append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df[np.array(df['hab']).astype(bool)]['start time']],workers=1,useCache=True))
+        ephysSessions.append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df[np.array(df['ephys']).astype(bool)]['start time']],workers=1,useCache=True))
 
 
 xticks = np.arange(nSessions*2)
@@ -691,7 +691,7 @@ for mid in mice:
                 dprime[comp]['sound'][-1].append(dp[0:6:2])
                 dprime[comp]['vis'][-1].append(dp[1:6:2])
     sessionsToPass.append(getSessionsToPass(mid,df,sessions,stage=5))
-    sessionData.append([getSessionData(mid,startTime) for startTime in df.loc[sessions,'start time']])
+    sessionData.append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df.loc[sessions,'start time']],workers=1,useCache=True))
                 
 mouseClrs = plt.cm.tab20(np.linspace(0,1,len(sessionsToPass)))
 
@@ -3499,7 +3499,7 @@ for lbl,mouseIds in mice.items():
     for mid in mouseIds:
         df = drSheets[str(mid)] if str(mid) in drSheets else nsbSheets[str(mid)]
         sessions = np.array([lbl in task for task in df['task version']]) & ~np.array(df['ignore'].astype(bool))
-        sessionDataVariants[lbl].append([getSessionData(mid,startTime) for startTime in df.loc[sessions,'start time']])
+        sessionDataVariants[lbl].append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df.loc[sessions,'start time']],workers=1,useCache=True))
         for task in df['task version']:
             if 'stage 5' in task and any(key in task for key in mice):
                 isFirstExpType[lbl].append(lbl in task)
@@ -4302,7 +4302,7 @@ sessionDataNoRew = []
 for mid in mice:
     df = drSheets[str(mid)] if str(mid) in drSheets else nsbSheets[str(mid)]
     sessions = np.array(['no reward' in task for task in df['task version']]) & ~np.array(df['ignore'].astype(bool))
-    sessionDataNoRew.append([getSessionData(mid,startTime) for startTime in df.loc[sessions,'start time']])
+    sessionDataNoRew.append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df.loc[sessions,'start time']],workers=1,useCache=True))
 
 # block switch plot, target stimuli only
 for blockRewarded,title in zip((True,False),('switch to rewarded block','switch to unrewarded block')):
@@ -4505,7 +4505,7 @@ sessionDataExtinct = []
 for mid in mice:
     df = drSheets[str(mid)] if str(mid) in drSheets else nsbSheets[str(mid)]
     sessions = np.array(['extinction' in task for task in df['task version']]) & ~np.array(df['ignore'].astype(bool))
-    sessionDataExtinct.append([getSessionData(mid,startTime) for startTime in df.loc[sessions,'start time']])
+    sessionDataExtinct.append(loadSessions([getSessionFilePath(mid,startTime) for startTime in df.loc[sessions,'start time']],workers=1,useCache=True))
 
 # block switch plot, target stimuli only
 smoothSigma = None
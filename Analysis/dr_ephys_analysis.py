@@ -18,6 +18,7 @@ import h5py
 from sync import sync
 import probeSync
 import ecephys
+from DynamicRoutingAnalysisUtils import TrialSoundArrays
 
 
 def getSdf(spikes,startTimes,windowDur,sampInt=0.001,filt='exponential',filtWidth=0.005,avg=True):
@@ -50,7 +51,7 @@ stimStartFrame = d['trialStimStartFrame'][:nTrials]
 trialStim = d['trialStim'].asstr()[:nTrials]
 trialVisStimFrames = d['trialVisStimFrames'][:nTrials]
 trialSoundDur = d['trialSoundDur'][:nTrials]
-trialSoundArray = d['trialSoundArray'][:nTrials]
+trialSoundArray = TrialSoundArrays(behavPath)
 soundSampleRate = d['soundSampleRate'][()]
 soundType = d['soundType'].asstr()[()]
 if soundType == 'tone':
@@ -71,7 +72,7 @@ rfStimStartFrame = d['stimStartFrame'][()]
 rfTrialVisXY = d['trialVisXY'][()]
 rfTrialGratingOri = d['trialGratingOri'][()]
 rfTrialSoundFreq = d['trialSoundFreq'][()]
-rfTrialSoundArray = d['trialSoundArray'][()]
+rfTrialSoundArray = TrialSoundArrays(rfMappingPath)
 
 d.close()
 
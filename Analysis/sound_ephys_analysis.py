@@ -18,6 +18,7 @@ import h5py
 from sync import sync
 import probeSync
 import ecephys
+from DynamicRoutingAnalysisUtils import TrialSoundArrays
 
 
 def getSdf(spikes,startTimes,windowDur,sampInt=0.001,filt='exponential',filtWidth=0.005,avg=True):
@@ -50,7 +51,7 @@ stimStartFrame = d['trialStimStartFrame'][:nTrials]
 trialStim = d['trialStim'].asstr()[:nTrials]
 trialVisStimFrames = d['trialVisStimFrames'][:nTrials]
 trialSoundDur = d['trialSoundDur'][:nTrials]
-trialSoundArray = d['trialSoundArray'][:nTrials]
+trialSoundArray = TrialSoundArrays(behavPath)
 soundSampleRate = d['soundSampleRate'][()]
 soundType = {key: d['soundType'][key].asstr()[()] for key in d['soundType']}
 soundParam = {key: d[param][key][()] for param in ('toneFreq','linearSweepFreq','logSweepFreq','noiseFiltFreq','ampModFreq')
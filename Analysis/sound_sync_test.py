@@ -12,6 +12,7 @@ import h5py
 from sync import sync
 import probeSync
 import ecephys
+from DynamicRoutingAnalysisUtils import TrialSoundArrays
 
 
 # file paths
@@ -69,7 +70,7 @@ stimStartFrame = d['trialStimStartFrame'][:nTrials]
 trialStim = d['trialStim'][:nTrials]
 trialVisStimFrames = d['trialVisStimFrames'][:nTrials]
 trialSoundDur = d['trialSoundDur'][:nTrials]
-trialSoundArray = d['trialSoundArray'][:nTrials]
+trialSoundArray = TrialSoundArrays(behavPath)
 soundSampleRate = d['soundSampleRate'][()]
 
 d.close()
@@ -6,7 +6,8 @@ Created on Wed Feb 20 15:41:48 2019
 """
 
 from __future__ import division
-import itertools, json, sys
+import collections, itertools, json, sys
+from concurrent.futures import ThreadPoolExecutor
 import random
 import numpy as np
 from psychopy import visual
@@ -99,6 +100,7 @@ class DynamicRouting1(TaskControl):
         self.logSweepFreq = {'sound1':[3,2.5],'sound2':[3,3.5]} # log2(kHz)
         self.noiseFiltFreq = {'sound1':[4000,8000],'sound2':[8000,16000]} # Hz
         self.ampModFreq = {'sound1':12,'sound2':70} # Hz
+        self.soundNoiseVariants = None # None for a new noise waveform every trial; or number of seeded noise waveforms precomputed for each noise sound and reused
             
         # opto params
         self.optoLabel = 'opto'
@@ -488,22 +490,44 @@ class DynamicRouting1(TaskControl):
             raise ValueError(taskVersion + ' is not a recognized task version')
 
 
+    def resetVariableBlockResponses(self):
+        # ring buffers of responses to the last n go and nogo trials of the current block
+        n = self.variableBlockThresholdTrials
+        self._blockGoResponses = collections.deque(maxlen=n)
+        self._blockNogoResponses = collections.deque(maxlen=n)
+        self._blockHitCount = 0
+        self._blockFalseAlarmCount = 0
+
+
+    def updateVariableBlockResponses(self,stim,rewardedStim,autoRewarded,response):
+        # called at the end of each trial of the current block
+        if autoRewarded or stim == 'catch':
+            return
+        if stim == rewardedStim:
+            responses = self._blockGoResponses
+        elif stim in ('vis1','sound1'):
+            responses = self._blockNogoResponses
+        else:
+            return
+        dropped = responses[0] if len(responses) == responses.maxlen else False
+        responses.append(response)
+        change = int(response) - int(dropped)
+        if responses is self._blockGoResponses:
+            self._blockHitCount += change
+        else:
+            self._blockFalseAlarmCount += change
+
+
     def variableBlockThresholdPassed(self,blockNumber,blockFrameCount):
         if blockFrameCount >= self.variableBlockMaxFrames:
             return True
         elif blockFrameCount < self.variableBlockMinFrames:
             return False
         else:
-            trialStim = np.array(self.trialStim)
-            blockTrials = (np.array(self.trialBlock) == blockNumber) & (~np.array(self.trialAutoRewarded)) & (trialStim != 'catch')
-            rewardedStim = self.blockStimRewarded[blockNumber-1]
-            goTrials = blockTrials & (trialStim == rewardedStim)
-            nogoTrials = blockTrials & ~goTrials & np.in1d(trialStim,('vis1','sound1'))
             n = self.variableBlockThresholdTrials
-            trialResponse = np.array(self.trialResponse)
-            if (goTrials.sum() < n or nogoTrials.sum() < n or
-                trialResponse[goTrials][-n:].sum() < self.variableBlockHitThreshold * n or
-                trialResponse[nogoTrials][-n:].sum() > self.variableBlockFalseAlarmThreshold * n):
+            if (len(self._blockGoResponses) < n or len(self._blockNogoResponses) < n or
+                self._blockHitCount < self.variableBlockHitThreshold * n or
+                self._blockFalseAlarmCount > self.variableBlockFalseAlarmThreshold * n):
                 return False
             else:
                 return True
@@ -513,8 +537,65 @@ class DynamicRouting1(TaskControl):
         if self.rewardSound == 'device':
             self._rewardSound = True
         elif self.rewardSound is not None:
-            self.loadSound(self.rewardSoundArray)
+            self.loadSound(self._rewardSoundOutput,filtered=True)
             self._sound = True
+
+
+    def getSoundParams(self,soundName):
+        soundType = self.soundType[soundName] if isinstance(self.soundType,dict) else self.soundType
+        soundFreq = [np.nan]*2
+        soundAM = np.nan
+        if soundType == 'tone':
+            soundFreq = self.toneFreq[soundName]
+        elif soundType == 'linear sweep':
+            soundFreq = self.linearSweepFreq[soundName]
+        elif soundType == 'log sweep':
+            soundFreq = self.logSweepFreq[soundName]
+        elif soundType == 'noise':
+            soundFreq = self.noiseFiltFreq[soundName]
+        elif soundType == 'AM noise':
+            soundFreq = (2000,20000)
+            soundAM = self.ampModFreq[soundName]
+        return soundType,soundFreq,soundAM
+
+
+    def getSoundCacheKey(self,soundType,soundDur,soundFreq,soundAM,soundSeed):
+        return (soundType,soundDur,tuple(np.ravel(soundFreq)),None if np.isnan(soundAM) else soundAM,soundSeed if 'noise' in soundType else None)
+
+
+    def makeSoundCache(self):
+        # precompute unit volume waveforms (and filtered output) for every sound the session can present
+        # if soundNoiseVariants is set, noise waveforms are made for a fixed set of seeds that trials choose from;
+        # otherwise each trial's noise is made from its own seed on a background thread during the pre stim interval
+        self._soundCache = {}
+        self.soundNoiseSeeds = None if self.soundNoiseVariants is None else [random.randrange(2**32) for _ in range(self.soundNoiseVariants)]
+        stimNames = [stim for blockStim in self.blockStim for stim in blockStim] + [stim for stim in self.blockStimRewarded]
+        if self.firstBlockNogoStim is not None:
+            stimNames.append(self.firstBlockNogoStim)
+        soundNames = set(name for stim in stimNames for name in stim.split('+') if 'sound' in name)
+        for soundName in sorted(soundNames):
+            soundType,soundFreq,soundAM = self.getSoundParams(soundName)
+            if 'noise' in soundType:
+                if self.soundNoiseSeeds is None:
+                    continue
+                seeds = self.soundNoiseSeeds
+            else:
+                seeds = [None]
+            for soundDur,soundSeed in itertools.product(set(self.soundDur),seeds):
+                key = self.getSoundCacheKey(soundType,soundDur,soundFreq,soundAM,soundSeed)
+                soundArray = TaskUtils.makeSoundArray(soundType,self.soundSampleRate,soundDur,self.soundHanningDur,1,soundFreq,soundAM,soundSeed)
+                self._soundCache[key] = (soundArray,self.filterSound(soundArray))
+
+
+    def getSoundArray(self,soundType,soundDur,soundVolume,soundFreq,soundAM,soundSeed):
+        # returns sound array and filtered output array scaled to soundVolume
+        key = self.getSoundCacheKey(soundType,soundDur,soundFreq,soundAM,soundSeed)
+        if key in self._soundCache:
+            soundArray,soundOutput = self._soundCache[key]
+            return soundArray * soundVolume, soundOutput * soundVolume
+        else:
+            soundArray = TaskUtils.makeSoundArray(soundType,self.soundSampleRate,soundDur,self.soundHanningDur,soundVolume,soundFreq,soundAM,soundSeed)
+            return soundArray, self.filterSound(soundArray)
         
 
     def taskFlow(self):
@@ -545,6 +626,7 @@ class DynamicRouting1(TaskControl):
                                                              hanningDur=self.soundHanningDur,
                                                              vol=self.rewardSoundVolume,
                                                              freq=self.rewardSoundFreq)
+            self._rewardSoundOutput = self.filterSound(self.rewardSoundArray)
         if self.incorrectSound is not None:
             self.incorrectSoundArray = TaskUtils.makeSoundArray(soundType=self.incorrectSound,
                                                                 sampleRate=self.soundSampleRate,
@@ -552,6 +634,13 @@ class DynamicRouting1(TaskControl):
                                                                 hanningDur=self.soundHanningDur,
                                                                 vol=self.incorrectSoundVolume,
                                                                 freq=self.incorrectSoundFreq)
+            self._incorrectSoundOutput = self.filterSound(self.incorrectSoundArray)
+
+        # precompute trial sounds and preallocate streaming daq output for the longest one
+        self.makeSoundCache()
+        soundSizes = [np.arange(0,dur,1/self.soundSampleRate).size for dur in self.soundDur]
+        soundSizes += [getattr(self,attr).size for attr in ('rewardSoundArray','incorrectSoundArray') if hasattr(self,attr)]
+        self.setSoundBufferSize(max(soundSizes))
         
         # opto params
         if self.importOptoParams:
@@ -574,6 +663,7 @@ class DynamicRouting1(TaskControl):
         self.trialSoundAM = []
         self.trialSoundSeed = []
         self.trialSoundArray = []
+        self.trialSoundArrayIndex = []
         self.trialResponse = []
         self.trialResponseFrame = []
         self.trialRewarded = []
@@ -604,6 +694,11 @@ class DynamicRouting1(TaskControl):
         blockAutoRewardCount = 0
         missTrialCount = 0
         incorrectRepeatCount = 0
+        if self.variableBlocks:
+            self.resetVariableBlockResponses()
+        
+        soundExecutor = ThreadPoolExecutor(1)
+        soundFuture = None # trial sound being made on soundExecutor
         
         # run loop for each frame presented on the monitor
         while self._continueSession:
@@ -620,7 +715,7 @@ class DynamicRouting1(TaskControl):
                 if self.trialRepeat[-1]:
                     self.trialStim.append(self.trialStim[-1])
                     if len(soundArray) > 0:
-                        self.loadSound(soundArray)
+                        self.loadSound(soundOutput,filtered=True)
                 else:
                     if (blockNumber == 0 or 
                         (blockNumber < len(self.blockStim) and
@@ -635,6 +730,8 @@ class DynamicRouting1(TaskControl):
                         blockAutoRewardCount = 0
                         missTrialCount = 0
                         incorrectRepeatCount = 0
+                        if self.variableBlocks:
+                            self.resetVariableBlockResponses()
                         blockStim = self.blockStim[blockNumber-1]
                         stimProb = None if self.blockStimProb is None else self.blockStimProb[blockNumber-1]
                         catchProb = self.blockCatchProb[blockNumber-1]
@@ -652,6 +749,7 @@ class DynamicRouting1(TaskControl):
                     soundAM = np.nan
                     soundSeed = random.randrange(2**32)
                     soundArray = np.array([])
+                    soundOutput = soundArray
                     customContrastVolume = False
                     isOptoTrial = False
                     isOptoFeedback = False
@@ -754,30 +852,18 @@ class DynamicRouting1(TaskControl):
                             visStim.ori = random.choice(self.gratingOri[visName])
                             visStim.phase = random.choice(self.gratingPhase)
                     if soundName is not None:
-                        soundType = self.soundType[soundName] if isinstance(self.soundType,dict) else self.soundType
+                        soundType,soundFreq,soundAM = self.getSoundParams(soundName)
                         soundDur = random.choice(self.soundDur)
                         if not customContrastVolume:
                             soundVolume = max(self.soundVolume) if blockTrialCount < self.newBlockGoTrials else random.choice(self.soundVolume)
-                        if soundType == 'tone':
-                            soundFreq = self.toneFreq[soundName]
-                        elif soundType == 'linear sweep':
-                            soundFreq = self.linearSweepFreq[soundName]
-                        elif soundType == 'log sweep':
-                            soundFreq = self.logSweepFreq[soundName]
-                        elif soundType == 'noise':
-                            soundFreq = self.noiseFiltFreq[soundName]
-                        elif soundType == 'AM noise':
-                            soundFreq = (2000,20000)
-                            soundAM = self.ampModFreq[soundName]
-                        soundArray = TaskUtils.makeSoundArray(soundType,
-                                                              self.soundSampleRate,
-                                                              soundDur,
-                                                              self.soundHanningDur,
-                                                              soundVolume,
-                                                              soundFreq,
-                                                              soundAM,
-                                                              soundSeed)
-                        self.loadSound(soundArray)
+                        if 'noise' in soundType and self.soundNoiseSeeds is not None:
+                            soundSeed = random.choice(self.soundNoiseSeeds)
+                        if self.getSoundCacheKey(soundType,soundDur,soundFreq,soundAM,soundSeed) in self._soundCache:
+                            soundArray,soundOutput = self.getSoundArray(soundType,soundDur,soundVolume,soundFreq,soundAM,soundSeed)
+                            self.loadSound(soundOutput,filtered=True)
+                        else:
+                            # loaded when ready (at the latest at stimulus onset)
+                            soundFuture = soundExecutor.submit(self.getSoundArray,soundType,soundDur,soundVolume,soundFreq,soundAM,soundSeed)
 
                 if blockNumber in self.optoFeedbackBlocks:
                     isOptoTrial = True
@@ -854,8 +940,8 @@ class DynamicRouting1(TaskControl):
                     self.trialSoundFreq.append(soundFreq)
                 self.trialSoundAM.append(soundAM)
                 self.trialSoundSeed.append(soundSeed)
-                if self.saveSoundArray:
-                    self.trialSoundArray.append(soundArray)
+                if self.saveSoundArray and soundFuture is None:
+                    self.addTrialSoundArray(soundArray)
                 
                 if self.blockStimRewarded[blockNumber-1] in self.trialStim[-1]:
                     isGo = True
@@ -906,6 +992,14 @@ class DynamicRouting1(TaskControl):
                 self._opto = True
                 optoTriggered = True
             
+            # load the trial sound made on the background thread
+            if soundFuture is not None and (soundFuture.done() or self._trialFrame >= self.trialPreStimFrames[-1]):
+                soundArray,soundOutput = soundFuture.result()
+                soundFuture = None
+                self.loadSound(soundOutput,filtered=True)
+                if self.saveSoundArray:
+                    self.addTrialSoundArray(soundArray)
+            
             # show/trigger stimulus
             if self._trialFrame == self.trialPreStimFrames[-1]:
                 self.trialStimStartFrame.append(self._sessionFrame)
@@ -915,7 +1009,9 @@ class DynamicRouting1(TaskControl):
                 and self.trialPreStimFrames[-1] <= self._trialFrame < self.trialPreStimFrames[-1] + visStimFrames):
                 if self.gratingTF > 0:
                     visStim.phase = visStim.phase + self.gratingTF/self.frameRate
+                self.markFramePhase('logic')
                 visStim.draw()
+                self.markFramePhase('draw')
             
             # trigger auto reward
             if autoRewardFrame is not None and not rewardDelivered and self._trialFrame == self.trialPreStimFrames[-1] + autoRewardFrame:
@@ -954,7 +1050,7 @@ class DynamicRouting1(TaskControl):
                 if self._trialFrame == self.trialPreStimFrames[-1] + self.responseWindow[1]:
                     self._win.color = self.incorrectTimeoutColor
                     if self.incorrectSound is not None:
-                        self.loadSound(self.incorrectSoundArray)
+                        self.loadSound(self._incorrectSoundOutput,filtered=True)
                         self._sound = True
                 elif self._trialFrame == self.trialPreStimFrames[-1] + self.responseWindow[1] + timeoutFrames:
                     self._win.color = self.monBackgroundColor
@@ -996,6 +1092,9 @@ class DynamicRouting1(TaskControl):
                 self._trialFrame = -1
                 blockTrialCount += 1
                 
+                if self.variableBlocks:
+                    self.updateVariableBlockResponses(self.trialStim[-1],self.blockStimRewarded[blockNumber-1],self.trialAutoRewarded[-1],self.trialResponse[-1])
+                
                 if (not isGo and self.trialStim[-1] != 'catch' and self.trialResponse[-1]  
                     and incorrectRepeatCount < self.incorrectTrialRepeats):
                     # repeat trial after response to unrewarded stimulus
@@ -1008,6 +1107,8 @@ class DynamicRouting1(TaskControl):
                 if len(self.trialStartFrame) == self.maxTrials:
                     self._continueSession = False
 
+                self._writeSessionData = True
+
                 self.publishAccumulatorInterface()
             
             blockFrameCount += 1
@@ -1016,6 +1117,8 @@ class DynamicRouting1(TaskControl):
                 self._continueSession = False
 
             self.showFrame()
+        
+        soundExecutor.shutdown()
 
 
 
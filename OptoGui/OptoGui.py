@@ -12,7 +12,7 @@ import numpy as np
 from PyQt5 import QtCore, QtWidgets
 
 sys.path.append(r"\\allen\programs\mindscope\workgroups\dynamicrouting\DynamicRoutingTask")
-from TaskUtils import getBregmaGalvoCalibrationData, galvoToBregma, bregmaToGalvo
+from TaskUtils import getBregmaGalvoCalibration
 from TaskUtils import getOptoPowerCalibrationData, powerToVolts, voltsToPower
 from TaskUtils import getOptoPulseWaveform, getGalvoWaveforms
 import TaskControl
@@ -353,11 +353,13 @@ class OptoGui():
             item.setEnabled(self.hasGalvos)
         if self.hasGalvos:
             try:
-                self.bregmaGalvoCalibrationData = getBregmaGalvoCalibrationData(rigName)
+                self.bregmaGalvoCalibration = getBregmaGalvoCalibration(rigName)
+                self.bregmaGalvoCalibrationData = self.bregmaGalvoCalibration.data
                 if not self.useBregma:
                     self.xEdit.setText(str(self.defaultGalvoXY[0]))
                     self.yEdit.setText(str(self.defaultGalvoXY[1]))
             except:
+                self.bregmaGalvoCalibration = None
                 self.bregmaGalvoCalibrationData = None
                 self.bregmaButton.setEnabled(False)
                 if self.useBregma:
@@ -396,8 +398,8 @@ class OptoGui():
             self.yEdit.setText(str(self.defaultGalvoXY[1]))
         else:
             xvals,yvals = [[float(val) for val in item.text().split(',')] for item in (self.xEdit,self.yEdit)]
-            func = galvoToBregma if self.useBregma else bregmaToGalvo
-            xvals,yvals = zip(*[func(self.bregmaGalvoCalibrationData,x,y) for x,y in zip(xvals,yvals)])
+            func = self.bregmaGalvoCalibration.galvoToBregma if self.useBregma else self.bregmaGalvoCalibration.bregmaToGalvo
+            xvals,yvals = func(np.array(xvals),np.array(yvals))
             self.xEdit.setText(','.join([str(round(x,3)) for x in xvals]))
             self.yEdit.setText(','.join([str(round(y,3)) for y in yvals]))
         for item in (self.bregmaOffsetXEdit,self.bregmaOffsetYEdit,self.addLocButton,self.useLocButton):
@@ -580,7 +582,7 @@ class OptoGui():
         if self.useBregma:
             offsetX = float(self.bregmaOffsetXEdit.text())
             offsetY = float(self.bregmaOffsetYEdit.text())
-            xvals,yvals = zip(*[bregmaToGalvo(self.bregmaGalvoCalibrationData,x,y,offsetX,offsetY) for x,y in zip(xvals,yvals)])
+            xvals,yvals = self.bregmaGalvoCalibration.bregmaToGalvo(np.array(xvals),np.array(yvals),offsetX,offsetY)
         return xvals,yvals
     
     def startTask(self):
@@ -747,7 +749,7 @@ class OptoGui():
                 xvals,yvals = [[float(val) for val in self.locTable.item(row,col).text().split(',')] for col in (xCol,yCol)]
                 offsetX = 0 if xOffsetCol is None else float(self.locTable.item(row,xOffsetCol).text())
                 offsetY = 0 if yOffsetCol is None else float(self.locTable.item(row,yOffsetCol).text())
-                xvals,yvals = zip(*[bregmaToGalvo(self.bregmaGalvoCalibrationData,x,y,offsetX,offsetY) for x,y in zip(xvals,yvals)])
+                xvals,yvals = self.bregmaGalvoCalibration.bregmaToGalvo(np.array(xvals),np.array(yvals),offsetX,offsetY)
                 if self.optotagCheckbox.isChecked():                        
                     galvoX = xvals[0]
                     galvoY = yvals[0]
@@ -787,7 +789,8 @@ class OptoGui():
                     if col < ncols-1:
                         f.write('\t')
         if self.calibrateXYCheckbox.isChecked():
-            self.bregmaGalvoCalibrationData = getBregmaGalvoCalibrationData(self.rigNameMenu.currentText())
+            self.bregmaGalvoCalibration = getBregmaGalvoCalibration(self.rigNameMenu.currentText())
+            self.bregmaGalvoCalibrationData = self.bregmaGalvoCalibration.data
         self.mainWin.setFocus()
                 
 
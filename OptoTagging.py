@@ -47,15 +47,17 @@ class OptoTagging(TaskControl):
         
         self.bregmaXY = [(x,y) for x,y in zip(self.optoTaggingLocs['bregmaX'],self.optoTaggingLocs['bregmaY'])]
         self.bregmaOffsetXY = [(x,y) for x,y in zip(self.optoTaggingLocs['bregma offset X'],self.optoTaggingLocs['bregma offset Y'])]
-        self.bregmaGalvoCalibrationData = TaskUtils.getBregmaGalvoCalibrationData(self.rigName)
-        self.galvoVoltage = [TaskUtils.bregmaToGalvo(self.bregmaGalvoCalibrationData,x,y,offsetX,offsetY) for (x,y),(offsetX,offsetY) in zip(self.bregmaXY,self.bregmaOffsetXY)]
+        bregmaGalvoCalibration = TaskUtils.getBregmaGalvoCalibration(self.rigName)
+        self.bregmaGalvoCalibrationData = bregmaGalvoCalibration.data
+        self.galvoVoltage = list(zip(*bregmaGalvoCalibration.bregmaToGalvo(self.optoTaggingLocs['bregmaX'],self.optoTaggingLocs['bregmaY'],
+                                                                          self.optoTaggingLocs['bregma offset X'],self.optoTaggingLocs['bregma offset Y'])))
         
         devNames = set(d for dev in self.optoTaggingLocs['device'] for d in dev)
         assert(len(devNames) == 1)
         self.optoDev = list(devNames)[0]
         self.optoPowerCalibrationData = TaskUtils.getOptoPowerCalibrationData(self.rigName,self.optoDev)
         self.optoOffsetVoltage = self.optoPowerCalibrationData['offsetV']
-        self.optoVoltage = [TaskUtils.powerToVolts(self.optoPowerCalibrationData,pwr) for pwr in self.optoPower]
+        self.optoVoltage = list(TaskUtils.powerToVolts(self.optoPowerCalibrationData,self.optoPower))
         
     
     def setDefaultParams(self,taskVersion):
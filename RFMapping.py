@@ -96,6 +96,7 @@ class RFMapping(TaskControl):
         self.trialToneFreq = []
         self.trialAMNoiseFreq = []
         self.trialSoundArray = []
+        self.trialSoundArrayIndex = []
         block = -1 # index of current block
         blockTrial = 0 # index of current trial in block
         
@@ -148,7 +149,7 @@ class RFMapping(TaskControl):
                 self.trialToneFreq.append(toneFreq)
                 self.trialAMNoiseFreq.append(amNoiseFreq)
                 if self.saveSoundArray:
-                    self.trialSoundArray.append(soundArray)
+                    self.addTrialSoundArray(soundArray)
 
             # show/trigger stimulus
             if self._trialFrame == 0 and soundArray.size > 0:
@@ -163,7 +164,9 @@ class RFMapping(TaskControl):
             
             if self._trialFrame < self.stimFrames and not np.isnan(ori):
                 gratingStim.phase = gratingStim.phase + self.gratingTF/self.frameRate
+                self.markFramePhase('logic')
                 gratingStim.draw()
+                self.markFramePhase('draw')
   
             # end trial after stimFrames and interStimFrames
             if self._trialFrame == self.stimFrames + self.interStimFrames:
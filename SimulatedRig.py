@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Hardware free rig for running tasks off a rig (e.g. benchmarking or regression testing task logic on Linux)
+
+Call install() before importing TaskControl or any task module; it puts simulated versions of
+nidaqmx, serial, psychtoolbox.audio and psychopy in sys.modules. Then run a task with rigName 'Simulated':
+
+    import SimulatedRig
+    rig = SimulatedRig.install(lickFrames=[f for f in range(36000) if f % 300 in (200,205,210)])
+    from DynamicRouting1 import DynamicRouting1
+    task = DynamicRouting1({'rigName':'Simulated','taskVersion':'stage 5 ori AMN','maxFrames':36000,'saveDir':saveDir})
+    task.start('000000') # 6 digit subject name so DynRoutData can load the file
+
+Frames are presented as fast as the task loop runs unless throttle=True.
+threadedInput samples inputs in real time, so use throttle=True with it.
+
+replaySession() reruns a recorded DynamicRouting1 session with its recorded lick line and encoder counts,
+e.g. to benchmark taskFlow: python SimulatedRig.py --replay DynamicRouting1_<subject>_<startTime>.hdf5
+"""
+
+import sys, time, types
+
+
+class SimulatedRigState():
+
+    # shared state of the simulated devices
+    # lick is None, a collection of frames where the lick line is high, or a function of frame returning bool
+    # encoder is None, a sequence of digital encoder counts per frame, or a function of frame returning int
+    # (nan or None for a failed encoder read)
+
+    def __init__(self,lick=None,encoder=None,frameRate=60,throttle=False):
+        self.lick = lick
+        if lick is not None and not callable(lick):
+            self.lick = frozenset(lick)
+        self.encoder = encoder
+        self.frameRate = frameRate
+        self.throttle = throttle
+        self.frame = 0 # index of the frame being prepared (number of flips so far)
+        self.soundStarts = [] # frames at which sound output started
+        self.optoStarts = []
+        self.digitalOutputs = [] # (frame,line,value)
+
+
+    def getLick(self,frame=None):
+        frame = self.frame if frame is None else frame
+        if self.lick is None:
+            return False
+        elif callable(self.lick):
+            return bool(self.lick(frame))
+        else:
+            return frame in self.lick
+
+
+    def getEncoderCount(self,frame=None):
+        frame = self.frame if frame is None else frame
+        if self.encoder is None:
+            return 0
+        elif callable(self.encoder):
+            count = self.encoder(frame)
+        else:
+            count = self.encoder[min(frame,len(self.encoder)-1)]
+        return None if count is None or count != count else int(count)
+
+
+class _Namespace():
+
+    # attribute container that accepts any attribute and returns None for missing ones
+
+    def __init__(self,**kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self,name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+class _Enum():
+
+    # stands in for a nidaqmx.constants enum; members are their names
+
+    def __init__(self,name):
+        self.name = name
+
+    def __getattr__(self,member):
+        if member.startswith('__'):
+            raise AttributeError(member)
+        return self.name + '.' + member
+
+
+def _getConstant(name):
+    if name.startswith('__'):
+        raise AttributeError(name)
+    return _Enum(name)
+
+
+class _Channels():
+
+    def __init__(self,task,kind):
+        self._task = task
+        self._kind = kind
+
+    def _addChannel(self,physicalChannel,**kwargs):
+        self._task.channels.append((self._kind,physicalChannel))
+
+    add_ai_voltage_chan = add_ao_voltage_chan = add_di_chan = add_do_chan = _addChannel
+
+
+class SimulatedNidaqTask():
+
+    # nidaqmx.Task with inputs driven by SimulatedRigState
+
+    def __init__(self,state):
+        self._state = state
+        self.channels = []
+        self.ai_channels = _Channels(self,'ai')
+        self.ao_channels = _Channels(self,'ao')
+        self.di_channels = _Channels(self,'di')
+        self.do_channels = _Channels(self,'do')
+        self.timing = _Namespace(samp_quant_samp_per_chan=1000,rate=None)
+        self.triggers = _Namespace(start_trigger=_Namespace(cfg_dig_edge_start_trig=lambda *args,**kwargs: None,
+                                                            disable_start_trig=lambda: None))
+        self.in_stream = _Namespace(total_samp_per_chan_acquired=0)
+        self.out_stream = _Namespace()
+        self._lastReadFrame = None
+        self.timing.cfg_samp_clk_timing = self._cfgSampClkTiming
+
+    def _cfgSampClkTiming(self,rate,source=None,sample_mode=None,samps_per_chan=1000):
+        self.timing.rate = rate
+        self.timing.samp_quant_samp_per_chan = samps_per_chan
+
+    def register_every_n_samples_acquired_into_buffer_event(self,n,callback):
+        # analog input is not simulated; the callback is never called
+        pass
+
+    def read(self,number_of_samples_per_channel=None):
+        if number_of_samples_per_channel is None:
+            return self._state.getLick()
+        # buffered digital input: one frame of samples at the sample rate per frame presented since the last read
+        frame = self._state.frame
+        first = frame if self._lastReadFrame is None else self._lastReadFrame + 1
+        self._lastReadFrame = frame
+        samplesPerFrame = (self.timing.rate if self.timing.rate else self._state.frameRate) / self._state.frameRate
+        data = [self._state.getLick(f) for f in range(first,frame+1) for _ in range(int(round((f+1)*samplesPerFrame)) - int(round(f*samplesPerFrame)))]
+        self.in_stream.total_samp_per_chan_acquired += len(data)
+        return data
+
+    def write(self,data,auto_start=True):
+        if len(self.channels) > 0 and self.channels[0][0] == 'do':
+            self._state.digitalOutputs.append((self._state.frame,self.channels[0][1],data))
+
+    def start(self):
+        if len(self.channels) > 0 and self.channels[0][0] == 'ao':
+            self._state.optoStarts.append(self._state.frame)
+
+    def stop(self):
+        pass
+
+    def control(self,action):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimulatedSerial():
+
+    # arduino digital encoder: answers the initialization commands and reports index and count for the current frame
+
+    responses = {'7': 'MDR0', '3': 'STR', '8': 'MDR0'}
+
+    def __init__(self,port=None,baudrate=9600,timeout=None,state=None):
+        self._state = state
+        self._response = None
+        self._index = 0
+
+    def write(self,message):
+        self._response = self.responses.get(message.decode('utf8'))
+
+    def readline(self):
+        if self._response is not None:
+            line = self._response
+            self._response = None
+        else:
+            self._index += 1
+            count = self._state.getEncoderCount()
+            line = '' if count is None else 'index:' + str(self._index) + ';count:' + str(count)
+        return (line + '\r\n').encode('utf-8')
+
+    def close(self):
+        pass
+
+
+class SimulatedAudioStream():
+
+    def __init__(self,state,**kwargs):
+        self._state = state
+
+    def fill_buffer(self,data):
+        pass
+
+    def start(self):
+        self._state.soundStarts.append(self._state.frame)
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimulatedWindow():
+
+    # psychopy.visual.Window without a display; each flip advances the simulated frame
+
+    def __init__(self,state,color=0,**kwargs):
+        self._state = state
+        self.color = color
+        self.monitorFramePeriod = 1 / state.frameRate
+        self.frameIntervals = []
+        self.recordFrameIntervals = False
+        self._lastFlipTime = None
+
+    def setRecordFrameIntervals(self,value=True):
+        self.recordFrameIntervals = value
+
+    def flip(self):
+        if self._state.throttle and self._lastFlipTime is not None:
+            time.sleep(max(0,self.monitorFramePeriod - (time.perf_counter() - self._lastFlipTime)))
+        self._lastFlipTime = time.perf_counter()
+        if self.recordFrameIntervals and self._state.frame > 0:
+            self.frameIntervals.append(self.monitorFramePeriod)
+        self._state.frame += 1
+
+    def close(self):
+        pass
+
+
+class SimulatedStim():
+
+    # any psychopy visual stimulus
+
+    def __init__(self,win=None,**kwargs):
+        self.win = win
+        self.contrast = 1
+        self.ori = 0
+        self.phase = 0
+        self.__dict__.update(kwargs)
+
+    def draw(self):
+        pass
+
+
+_state = None
+
+
+def install(lickFrames=None,encoderCounts=None,frameRate=60,throttle=False):
+    # lickFrames and encoderCounts are passed to SimulatedRigState as lick and encoder
+    global _state
+    state = _state = SimulatedRigState(lickFrames,encoderCounts,frameRate,throttle)
+
+    nidaqmx = types.ModuleType('nidaqmx')
+    nidaqmx.Task = lambda *args,**kwargs: SimulatedNidaqTask(state)
+    constants = types.ModuleType('nidaqmx.constants')
+    constants.__getattr__ = _getConstant
+    constants.READ_ALL_AVAILABLE = -1
+    nidaqmx.constants = constants
+    device = lambda name: _Namespace(name=name,dev_serial_num=0,
+                                     reserve_network_device=lambda override_reservation=False: None,
+                                     unreserve_network_device=lambda: None)
+    nidaqmx.system = _Namespace(system=_Namespace(System=lambda: _Namespace(devices=_Namespace(device_names=[]))),
+                                device=_Namespace(Device=device))
+
+    serial = types.ModuleType('serial')
+    serial.Serial = lambda *args,**kwargs: SimulatedSerial(*args,state=state,**kwargs)
+
+    psychtoolbox = types.ModuleType('psychtoolbox')
+    audio = types.ModuleType('psychtoolbox.audio')
+    audio.Stream = lambda **kwargs: SimulatedAudioStream(state,**kwargs)
+    psychtoolbox.audio = audio
+
+    psychopy = types.ModuleType('psychopy')
+    visual = types.ModuleType('psychopy.visual')
+    visual.Window = lambda **kwargs: SimulatedWindow(state,**kwargs)
+    visual.GratingStim = visual.Rect = visual.TextStim = visual.ImageStim = SimulatedStim
+    windowwarp = types.ModuleType('psychopy.visual.windowwarp')
+    windowwarp.Warper = lambda *args,**kwargs: None
+    visual.windowwarp = windowwarp
+    monitors = types.ModuleType('psychopy.monitors')
+    monitors.Monitor = lambda *args,**kwargs: _Namespace(setSizePix=lambda size: None,saveMon=lambda: None)
+    event = types.ModuleType('psychopy.event')
+    event.getKeys = lambda *args,**kwargs: []
+    psychopy.visual = visual
+    psychopy.monitors = monitors
+    psychopy.event = event
+
+    sys.modules.update({'nidaqmx': nidaqmx,
+                        'nidaqmx.constants': constants,
+                        'serial': serial,
+                        'psychtoolbox': psychtoolbox,
+                        'psychtoolbox.audio': audio,
+                        'psychopy': psychopy,
+                        'psychopy.visual': visual,
+                        'psychopy.visual.windowwarp': windowwarp,
+                        'psychopy.monitors': monitors,
+                        'psychopy.event': event})
+    return state
+
+
+def replaySession(filePath,saveDir=None,randomSeed=None,throttle=False):
+    # run DynamicRouting1 on the simulated rig with the lick line and digital encoder counts recorded in filePath
+    # the trial sequence matches the recording if it was run with a randomSeed (used unless randomSeed is given);
+    # the replay ends at the same frame as the recording
+    # returns the replayed task, the rig state and the time taken by task.start
+    import h5py
+    import numpy as np
+
+    with h5py.File(filePath,'r') as d:
+        def getParam(key):
+            if key not in d:
+                return None
+            val = d[key].asstr()[()] if d[key].dtype == object else d[key][()]
+            return None if np.isscalar(val) and not isinstance(val,str) and np.isnan(val) else val
+        taskVersion = getParam('taskVersion')
+        lastFrame = getParam('lastFrame')
+        nFrames = d['frameIntervals'].size + 1 if lastFrame is None else int(lastFrame) + 1
+        maxTrials = getParam('maxTrials')
+        soundCalibrationFit = getParam('soundCalibrationFit')
+        subjectName = getParam('subjectName')
+        if randomSeed is None:
+            randomSeed = getParam('randomSeed')
+            if randomSeed is None:
+                print('\n' + filePath + ' was not run with a randomSeed; trial sequence will not match\n')
+            else:
+                randomSeed = int(randomSeed)
+        lickLineFrames = d['lickDetectorFrames'][:] if 'lickDetectorFrames' in d else d['lickFrames'][:]
+        encoderCounts = d['rotaryEncoderCount'][:] if 'rotaryEncoderCount' in d and d['rotaryEncoderCount'].size > 0 else None
+
+    state = install() if _state is None else _state
+    state.lick = frozenset(lickLineFrames.tolist())
+    state.encoder = encoderCounts
+    state.throttle = throttle
+    state.frame = 0
+    state.soundStarts = []
+    state.optoStarts = []
+    state.digitalOutputs = []
+
+    from DynamicRouting1 import DynamicRouting1
+    params = {'rigName': 'Simulated','taskVersion': taskVersion,'maxFrames': nFrames,'randomSeed': randomSeed}
+    if maxTrials is not None:
+        params['maxTrials'] = int(maxTrials)
+    if soundCalibrationFit is not None:
+        params['soundCalibrationFit'] = tuple(soundCalibrationFit)
+    if saveDir is not None:
+        params['saveDir'] = saveDir
+    task = DynamicRouting1(params)
+    t = time.perf_counter()
+    task.start('000000' if subjectName is None else subjectName)
+    return task,state,time.perf_counter() - t
+
+
+def compareTrials(filePath,task,keys=('trialStim','trialBlock','trialStartFrame','trialResponse','trialRewarded','trialAutoRewarded')):
+    # compare trial data in a recorded session file with a replayed task
+    import h5py
+    import numpy as np
+    match = {}
+    with h5py.File(filePath,'r') as d:
+        for key in keys:
+            recorded = d[key].asstr()[:] if d[key].dtype == object else d[key][:]
+            replayed = np.array(getattr(task,key))
+            n = min(recorded.size,replayed.size)
+            match[key] = recorded.size == replayed.size and np.array_equal(recorded[:n],replayed[:n])
+    return match
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--taskVersion',default='stage 5 ori AMN')
+    parser.add_argument('--maxFrames',type=int,default=3600)
+    parser.add_argument('--saveDir',default=None)
+    parser.add_argument('--subjectName',default='000000')
+    parser.add_argument('--throttle',action='store_true')
+    parser.add_argument('--randomSeed',type=int,default=None)
+    parser.add_argument('--replay',default=None,help='recorded DynamicRouting1 hdf5 file to replay')
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        task,rig,elapsed = replaySession(args.replay,args.saveDir,args.randomSeed,args.throttle)
+        print(str(rig.frame) + ' frames in ' + str(round(elapsed,2)) + ' s (' + str(round(rig.frame / rig.frameRate / elapsed,1)) + 'x real time)')
+        for key,match in compareTrials(args.replay,task).items():
+            print(key + (' matches' if match else ' does not match'))
+        print(task.savePath)
+        sys.exit()
+
+    rig = install(throttle=args.throttle)
+    from DynamicRouting1 import DynamicRouting1
+    params = {'rigName': 'Simulated','taskVersion': args.taskVersion,'maxFrames': args.maxFrames,'randomSeed': args.randomSeed}
+    if args.saveDir is not None:
+        params['saveDir'] = args.saveDir
+    task = DynamicRouting1(params)
+
+    def lick(frame):
+        # lick 15 frames after the onset of rewarded stimuli and every fourth unrewarded stimulus
+        if len(task.trialStimStartFrame) == 0 or frame - task.trialStimStartFrame[-1] != 15:
+            return False
+        rewarded = task.blockStimRewarded[task.trialBlock[-1]-1] in task.trialStim[-1]
+        return rewarded or len(task.trialStimStartFrame) % 4 == 0
+    rig.lick = lick
+
+    t = time.perf_counter()
+    task.start(args.subjectName)
+    elapsed = time.perf_counter() - t
+    print(str(rig.frame) + ' frames in ' + str(round(elapsed,2)) + ' s (' + str(round(rig.frame / rig.frameRate / elapsed,1)) + 'x real time)')
+    print(task.savePath)
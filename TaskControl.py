@@ -4,8 +4,9 @@ Superclass for behavioral task control
 
 """
 
-import datetime, glob, json, math, os, sys, time
-from threading import Timer
+import datetime, glob, hashlib, json, math, os, random, sys, time
+from queue import Queue
+from threading import Thread, Timer
 import h5py
 import numpy as np
 from psychopy import monitors, visual, event
@@ -26,6 +27,12 @@ class TaskControl():
         self.maxFrames = None # max number of frames before task terminates
         self.saveParams = True # if True, saves all attributes not starting with underscore
         self.saveFrameIntervals = True
+        self.streamSessionData = True # if True, per frame and trial data are appended to the save file during the session
+        self.streamInterval = 3600 # frames between writes of per frame data (tasks also write at trial boundaries)
+        self.randomSeed = None # seeds random and numpy.random at the start of the session so it can be replayed
+        self.profileFrames = True # time each phase of each frame; saved as frameProfile and frameProfileSummary
+        self.frameProfileSize = 2**16 # number of most recent frames kept in frameProfile
+        self._frameProfiler = None
         self.monBackgroundColor = 0 # gray; can adjust this for luminance measurement
         self.minWheelAngleChange = 0 # radians per frame
         self.maxWheelAngleChange = 0.5 # radians per frame
@@ -58,6 +65,10 @@ class TaskControl():
         self.rewardSoundLine = None
         self.lickLine = None
         self.digitalSolenoidTrigger = True
+        self.threadedInput = False # if True, lick line and digital encoder are read continuously on background threads
+        self.lickSampleInterval = 0.001 # seconds between lick line reads if threadedInput
+        self.lickSampleRate = None # Hz; if not None, lick line is acquired by a hardware clocked buffered digital input task
+        self.lickSampleClockSource = None # e.g. '/Dev0/ai/SampleClock' for devices without a digital input sample clock
         self.solenoidOpenTime = 0.03
         self.rewardSoundDeviceOpenTime = 0.01
         self.microphoneCh = None
@@ -66,16 +77,21 @@ class TaskControl():
         self.acquisitionSignalLine = None
         self.rewardSyncLine = None
         self.soundMode = 'sound card' # 'sound card', or 'daq'
+        self.soundArrayStorage = 'unique' # 'unique' (each distinct waveform saved once in soundArrays, indexed by trialSoundArrayIndex) or 'trial' (trialSoundArray)
         self.soundNidaqDevice = None
         self.soundChannel = None
         self.optoNidaqDevice = None
         self.galvoChannels = None
         self.optoChannels = None
+        self.streamingDaqOutput = False # if True, sound and opto daq tasks stay committed with preallocated buffers
+        self.soundTriggerSource = None # terminal wired to frame signal (e.g. '/Dev1/PFI4'); used if streamingDaqOutput
+        self.optoTriggerSource = None # terminal wired to frame signal; used if streamingDaqOutput
         
         if params is not None:
             self.rigName = params['rigName']
             self.githubTaskScript = params['GHTaskScriptParams']['taskScript'] if 'GHTaskScriptParams' in params else None
             self.optoParamsPath = params['optoParamsPath'] if 'optoParamsPath' in params else None
+            self.randomSeed = params['randomSeed'] if 'randomSeed' in params else None
             if 'configPath' in params:
                 self.startTime = params['startTime']
                 self.saveDir = None
@@ -274,6 +290,15 @@ class TaskControl():
                     d = scipy.io.loadmat(soundFilterPath)
                     self.soundSampleRate = d['Fs'][0]
                     self.soundFilter = d['FILT'][0]
+                elif self.rigName == 'Simulated':
+                    # hardware free rig; call SimulatedRig.install() before importing TaskControl
+                    self.saveDir = params['saveDir'] if 'saveDir' in params else os.path.join(os.path.expanduser('~'),'DynamicRoutingTask','SimulatedData')
+                    self.behavNidaqDevice = 'SimDev1'
+                    self.rewardLine = (0,7)
+                    self.rewardSoundLine = (2,0)
+                    self.lickLine = (0,0)
+                    self.rotaryEncoderSerialPort = 'SIM'
+                    self.soundCalibrationFit = params['soundCalibrationFit'] if 'soundCalibrationFit' in params else None
                 else:
                     raise ValueError(self.rigName + ' is not a recognized rig name')
                 
@@ -287,6 +312,10 @@ class TaskControl():
             self.startTime = time.strftime('%Y%m%d_%H%M%S',startTime)
             print('start time was: ' + time.strftime('%I:%M',startTime))
         
+        if self.randomSeed is not None:
+            random.seed(self.randomSeed)
+            np.random.seed(self.randomSeed)
+        
         self.pixelsPerDeg = 0.5 * self.monSizePix[0] / math.degrees(math.atan(0.5 * self.monWidth / self.monDistance))
         
         if window:
@@ -301,14 +330,21 @@ class TaskControl():
         if self.rotaryEncoder == 'digital':
             self.initDigitalEncoder()
         
-        self.rotaryEncoderVolts = [] # rotary encoder analog input each frame
-        self.rotaryEncoderIndex = [] # rotary encoder digital input read index
-        self.rotaryEncoderCount = [] # rotary encoder digital input count
-        self.wheelPosRadians = []
-        self.deltaWheelPos = []
-        self.microphoneData = []
-        self.lickFrames = [] # frames where lick line switches high
-        self.lickDetectorFrames = [] # frames where lick line is high
+        # per frame data are kept in preallocated arrays sized for the whole session
+        nFrames = int(self.maxFrames) if self.maxFrames is not None else int(3600 * self.frameRate)
+        self.rotaryEncoderVolts = GrowableArray(nFrames) # rotary encoder analog input each frame
+        self.rotaryEncoderIndex = GrowableArray(nFrames) # rotary encoder digital input read index (nan if read failed)
+        self.rotaryEncoderCount = GrowableArray(nFrames) # rotary encoder digital input count (nan if read failed)
+        self.wheelPosRadians = GrowableArray(nFrames) # wheel angle (-pi to pi) for analog encoder
+        self.wheelSampleIndex = GrowableArray(nFrames) # index of last wheelPosRadiansSamples sample read each frame
+        self.deltaWheelPos = GrowableArray(nFrames)
+        self._wheelPositionPrevious = None
+        self.microphoneData = GrowableArray(nFrames)
+        self.lickFrames = GrowableArray(dtype=np.int64) # frames where lick line switches high
+        self.lickDetectorFrames = GrowableArray(dtype=np.int64) # frames where lick line is high
+        self.lickTimes = [] # lick onset times (seconds from start of input acquisition) if threadedInput or lickSampleRate
+        self.firstFrameTime = None # flip time of first frame (seconds from start of input acquisition) if threadedInput or lickSampleRate
+        self.lickFlipSampleCount = GrowableArray(nFrames,dtype=np.int64) # lick input samples acquired at each frame flip if lickSampleRate
         
         self._continueSession = True
         self._lick = False # True if lick line high current frame but not previous frame
@@ -322,6 +358,19 @@ class TaskControl():
         self._rewardSound = False # trigger reward device (external clicker) at next frame flip if True
         self._sound = False # sound triggered at next frame flip if True
         self._opto = False # False or galvo/opto voltage waveform applied next frame flip
+        self._writeSessionData = False # streamed data written after next frame flip if True
+
+        if self.threadedInput:
+            self.startInputAcquisition()
+
+        self._frameProfiler = FrameProfiler(self.frameProfileSize,1/self.frameRate) if self.profileFrames else None
+
+        self._soundArrays = [] # distinct trial sound waveforms
+        self._soundArrayIndex = {} # waveform hash: index in _soundArrays
+
+        self._sessionWriter = None
+        if self.saveParams and self.streamSessionData:
+            self.startSessionWriter()
 
         self.startAccumulatorInterface()
         
@@ -384,12 +433,23 @@ class TaskControl():
 
 
     def getInputData(self):
+        if self._sessionFrame == 0 and self._frameProfiler is not None:
+            self._frameProfiler.start()
         self.getNidaqData()
         if self.rotaryEncoder == 'digital':
             self.readDigitalEncoder()
+        self.markFramePhase('input')
+
+
+    def markFramePhase(self,phase):
+        # attribute the time since the previous mark to phase (see FrameProfiler.phases)
+        if self._frameProfiler is not None:
+            self._frameProfiler.mark(phase)
     
     
     def showFrame(self):
+        self.markFramePhase('logic')
+
         if self.syncNidaqDevice is not None:
             if self._sessionFrame == 0:
                 self._acquisitionSignalOutput.write(True)
@@ -403,12 +463,33 @@ class TaskControl():
         if (len(escape) > 0 and escape[0][1]['shift']) or (self.maxFrames is not None and self._sessionFrame == self.maxFrames - 1):   
             self._continueSession = False
 
+        # arm hardware triggered outputs to start on the frame signal at the flip
+        if self._sound and self._soundOutputBuffer is not None and self._soundOutputBuffer.triggerSource is not None:
+            self.startSound(triggered=True)
+            self._sound = False
+
+        if self._opto and self._optoOutputBuffer is not None and self._optoOutputBuffer.triggerSource is not None:
+            self.startOpto(triggered=True)
+            self._opto = False
+
         # show new frame
+        self.markFramePhase('other')
         if self.drawDiodeBox:
             if self._sessionFrame % self.diodeBoxFrameInterval == self.diodeBoxFrameInterval - 1:
                 self._diodeBox.fillColor = -self._diodeBox.fillColor
             self._diodeBox.draw()
+            self.markFramePhase('draw')
         self._win.flip()
+        self.markFramePhase('flip')
+
+        # the lick input sample clock drifts relative to the frame clock, so the sample count at every flip
+        # is saved to map lickTimes onto frame times; threaded input uses the same clock as the frames
+        if self.lickSampleRate is not None and hasattr(self,'_lickInput'):
+            self.lickFlipSampleCount.append(self._lickInput.in_stream.total_samp_per_chan_acquired)
+            if self._sessionFrame == 0:
+                self.firstFrameTime = self.lickFlipSampleCount[0] / self.lickSampleRate
+        elif self._sessionFrame == 0 and self.threadedInput:
+            self.firstFrameTime = time.perf_counter() - self._inputStartTime
 
         if self.syncNidaqDevice is not None:
             self._frameSignalOutput.write(False)
@@ -433,6 +514,17 @@ class TaskControl():
         if self._rewardSound:
             self.triggerRewardSound()
             self._rewardSound = False
+
+        if self._frameProfiler is not None:
+            self._frameProfiler.mark('triggers')
+            self._frameProfiler.endFrame(self._sessionFrame)
+
+        if self._sessionWriter is not None:
+            if self._writeSessionData:
+                self.writeSessionData()
+            elif self._sessionFrame % self.streamInterval == self.streamInterval - 1:
+                self.writeSessionData(self._frameDataKeys)
+        self._writeSessionData = False
         
         self.lastFrame = self._sessionFrame
         self._sessionFrame += 1
@@ -441,6 +533,7 @@ class TaskControl():
     
     def completeSession(self):
         try:
+            self.stopInputAcquisition()
             self.stopAccumulatorInterface()
             if self._win is not None:
                 self._win.close()
@@ -452,18 +545,74 @@ class TaskControl():
         except:
             raise
         finally:
-            if self.saveParams:
-                subjName = '' if self.subjectName is None else self.subjectName + '_'
-                if self.saveDir is not None:
-                    saveDir = os.path.join(self.saveDir,self.subjectName)
-                    if not os.path.exists(saveDir):
-                        os.makedirs(saveDir)
-                    self.savePath = os.path.join(saveDir,self.__class__.__name__ + '_' + subjName + self.startTime + '.hdf5')
-                with h5py.File(self.savePath,'w') as fileOut:
+            if getattr(self,'_sessionWriter',None) is not None:
+                self.completeSessionWriter()
+            elif self.saveParams:
+                with h5py.File(self.getSavePath(),'w') as fileOut:
                     saveParameters(fileOut,self.__dict__)
                     if self.saveFrameIntervals and self._win is not None:
                         fileOut.create_dataset('frameIntervals',data=self._win.frameIntervals)
+                    self.saveSoundArrays(fileOut)
+                    if getattr(self,'_frameProfiler',None) is not None:
+                        self._frameProfiler.save(fileOut)
             self.startTime = None
+
+
+    def getSavePath(self):
+        if self.saveDir is not None:
+            subjName = '' if self.subjectName is None else self.subjectName + '_'
+            saveDir = os.path.join(self.saveDir,self.subjectName)
+            if not os.path.exists(saveDir):
+                os.makedirs(saveDir)
+            self.savePath = os.path.join(saveDir,self.__class__.__name__ + '_' + subjName + self.startTime + '.hdf5')
+        return self.savePath
+
+
+    def startSessionWriter(self):
+        # write the parameters now and append list attributes that are empty or not yet created
+        # (per frame and trial data) to the save file as the session runs, so an exception or a crash of the
+        # task between writes loses at most the data since the last write; completeSessionWriter rewrites
+        # anything that was not streamed
+        self._frameDataKeys = ('rotaryEncoderIndex','rotaryEncoderCount','rotaryEncoderVolts','wheelPosRadians',
+                               'wheelPosRadiansSamples','wheelSampleIndex','deltaWheelPos','microphoneData',
+                               'lickFrames','lickDetectorFrames','lickTimes','lickFlipSampleCount','rewardFrames','manualRewardFrames','rewardSize')
+        savePath = self.getSavePath()
+        params = {key: val for key,val in self.__dict__.items() if not (isinstance(val,(list,GrowableArray)) and len(val) == 0)}
+        with h5py.File(savePath,'w') as fileOut:
+            saveParameters(fileOut,params)
+        self._sessionWriter = SessionWriter(savePath,params.keys())
+        self._sessionWriter.start()
+
+
+    def writeSessionData(self,keys=None):
+        # queue new items of streamed lists for the session writer (keys=None writes every streamed list)
+        # tasks set self._writeSessionData at trial boundaries, when the items are final
+        if keys is None:
+            keys = [key for key,val in self.__dict__.items() if key[0] != '_' and isinstance(val,(list,GrowableArray))]
+        data = {key: getattr(self,key) for key in keys if hasattr(self,key)}
+        if self.saveFrameIntervals and self._win is not None:
+            data['frameIntervals'] = self._win.frameIntervals
+        self._sessionWriter.write(data)
+
+
+    def completeSessionWriter(self):
+        self.writeSessionData()
+        self._sessionWriter.stop()
+        keep = set()
+        with h5py.File(self.savePath,'a') as fileOut:
+            for key in self._sessionWriter.keys:
+                val = self._win.frameIntervals if key == 'frameIntervals' else getattr(self,key,None)
+                if key in fileOut and self._sessionWriter.isComplete(fileOut[key],val):
+                    keep.add(key)
+            for key in list(fileOut.keys()):
+                if key not in keep:
+                    del fileOut[key]
+            saveParameters(fileOut,{key: val for key,val in self.__dict__.items() if key not in keep})
+            if self.saveFrameIntervals and self._win is not None and 'frameIntervals' not in keep:
+                fileOut.create_dataset('frameIntervals',data=self._win.frameIntervals)
+            self.saveSoundArrays(fileOut)
+            if self._frameProfiler is not None:
+                self._frameProfiler.save(fileOut)
         
     
     def startNidaqDevice(self):
@@ -478,6 +627,9 @@ class TaskControl():
             if self.rotaryEncoder == 'analog' or self.microphoneCh is not None:
                 aiSampleRate = 2000 if self._win.monitorFramePeriod < 0.0125 else 1000
                 aiBufferSize = 16
+                self.analogInputSampleRate = aiSampleRate
+                nSamples = int(aiSampleRate * (self.maxFrames / self.frameRate if self.maxFrames is not None else 3600))
+                self.wheelPosRadiansSamples = GrowableArray(nSamples if self.rotaryEncoder == 'analog' else 0) # unwrapped wheel position at each analog input sample
                 self._analogInput = nidaqmx.Task()
 
                 if self.rotaryEncoder == 'analog':
@@ -491,12 +643,33 @@ class TaskControl():
                                                              sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS,
                                                              samps_per_chan=aiBufferSize)
                                                     
+                # decode and unwrap wheel angle as samples arrive; the frame loop only reads the latest summary:
+                # (number of samples acquired, last encoder volts, mean unwrapped wheel position, microphone std)
                 def readAnalogInput(task_handle,every_n_samples_event_type,number_of_samples,callback_data):
-                    self._analogInputData = self._analogInput.read(number_of_samples_per_channel=number_of_samples)
+                    data = np.array(self._analogInput.read(number_of_samples_per_channel=number_of_samples))
+                    volts = position = micStd = np.nan
+                    if self.rotaryEncoder == 'analog':
+                        encoderData = data if self.microphoneCh is None else data[0]
+                        angle = encoderData * (2 * math.pi / 5)
+                        change = np.diff(angle,prepend=angle[0] if self._wheelAngle is None else self._wheelAngle)
+                        change = (change + math.pi) % (2 * math.pi) - math.pi
+                        positions = (angle[0] if self._wheelPosition is None else self._wheelPosition) + np.cumsum(change)
+                        self._wheelAngle = angle[-1]
+                        self._wheelPosition = positions[-1]
+                        self.wheelPosRadiansSamples.extend(positions)
+                        volts = encoderData[-1]
+                        position = positions.mean()
+                    if self.microphoneCh is not None:
+                        micStd = np.std(data[1] if self.rotaryEncoder == 'analog' else data)
+                    self._analogInputSampleCount += number_of_samples
+                    self._analogInputSummary = (self._analogInputSampleCount,volts,position,micStd)
                     return 0
                 
                 self._analogInput.register_every_n_samples_acquired_into_buffer_event(aiBufferSize,readAnalogInput)
-                self._analogInputData = None
+                self._wheelAngle = None
+                self._wheelPosition = None
+                self._analogInputSampleCount = 0
+                self._analogInputSummary = None
                 self._analogInput.start()
                 self._nidaqTasks.append(self._analogInput)
             
@@ -524,6 +697,14 @@ class TaskControl():
             self._lickInput = nidaqmx.Task()
             self._lickInput.di_channels.add_di_chan(self.behavNidaqDevice+'/port'+str(self.lickLine[0])+'/line'+str(self.lickLine[1]),
                                                     line_grouping=nidaqmx.constants.LineGrouping.CHAN_PER_LINE)
+            if self.lickSampleRate is not None:
+                # every lick line edge is timed by the sample clock; the frame loop reads all samples acquired since the previous frame
+                self._lickInput.timing.cfg_samp_clk_timing(self.lickSampleRate,
+                                                           source=self.lickSampleClockSource,
+                                                           sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS,
+                                                           samps_per_chan=int(self.lickSampleRate))
+                self._lickSamplesRead = 0
+                self._lickInput.start()
             self._nidaqTasks.append(self._lickInput)
         
         # frame and acquistion signals
@@ -566,26 +747,40 @@ class TaskControl():
     def getNidaqData(self):
         # analog
         if hasattr(self,'_analogInput'):
-            if self._analogInputData is None:
-                if self.rotaryEncoder == 'analog':
-                    self.rotaryEncoderVolts.append(np.nan)
-                    encoderAngle = np.nan
-                if self.microphoneCh is not None:
-                    self.microphoneData.append(np.nan)
-            else:
-                if self.rotaryEncoder == 'analog':
-                    encoderData = np.array(self._analogInputData) if self.microphoneCh is None else np.array(self._analogInputData[0])
-                if self.microphoneCh is not None:
-                    micData = self._analogInputData[1] if self.rotaryEncoder == 'analog' else self._analogInputData
-                    self.microphoneData.append(np.std(micData))
-                self.rotaryEncoderVolts.append(encoderData[-1])
-                encoderData *= 2 * math.pi / 5
-                encoderAngle = np.arctan2(np.mean(np.sin(encoderData)),np.mean(np.cos(encoderData)))
-            self.wheelPosRadians.append(encoderAngle)
-            self.deltaWheelPos.append(self.calculateWheelChange())
+            summary = self._analogInputSummary
+            sampleCount,volts,position,micStd = (0,np.nan,np.nan,np.nan) if summary is None else summary
+            if self.microphoneCh is not None:
+                self.microphoneData.append(micStd)
+            if self.rotaryEncoder == 'analog':
+                self.rotaryEncoderVolts.append(volts)
+                self.wheelPosRadians.append((position + math.pi) % (2 * math.pi) - math.pi)
+                self.wheelSampleIndex.append(sampleCount - 1)
+                self.deltaWheelPos.append(self.calculateWheelChange(position))
         
         # digital
-        if hasattr(self,'_lickInput'):
+        if hasattr(self,'_lickThread'):
+            lickSamples = self._lickThread.buffer.readNew()
+            lickOnsets = lickSamples[lickSamples[:,1] > 0,0]
+            self._lick = lickOnsets.size > 0
+            if self._lick:
+                self.lickFrames.append(self._sessionFrame)
+                self.lickTimes.extend(lickOnsets - self._inputStartTime)
+            latest = self._lickThread.buffer.latest()
+            if self._lick or (latest is not None and latest[1] > 0):
+                self.lickDetectorFrames.append(self._sessionFrame)
+        elif hasattr(self,'_lickInput') and self.lickSampleRate is not None:
+            lickData = np.array(self._lickInput.read(number_of_samples_per_channel=nidaqmx.constants.READ_ALL_AVAILABLE),dtype=bool)
+            lickOnsets = np.where(lickData & ~np.concatenate(([self._lickPrevious],lickData[:-1])))[0]
+            self._lick = lickOnsets.size > 0
+            if self._lick:
+                self.lickFrames.append(self._sessionFrame)
+                self.lickTimes.extend((self._lickSamplesRead + lickOnsets) / self.lickSampleRate)
+            if lickData.size > 0:
+                if lickData.any():
+                    self.lickDetectorFrames.append(self._sessionFrame)
+                self._lickPrevious = lickData[-1]
+                self._lickSamplesRead += lickData.size
+        elif hasattr(self,'_lickInput'):
             if self._lickInput.read():
                 if self._lickPrevious:
                     self._lick = False
@@ -599,21 +794,16 @@ class TaskControl():
                 self._lickPrevious = False
 
 
-    def calculateWheelChange(self):
-        # calculate angular change in wheel position
-        if len(self.wheelPosRadians) < 2 or np.isnan(self.wheelPosRadians[-1]):
-            angleChange = 0
-        else:
-            angleChange = self.wheelPosRadians[-1] - self.wheelPosRadians[-2]
-            if angleChange < -math.pi:
-                angleChange += 2 * math.pi
-            elif angleChange > math.pi:
-                angleChange -= 2 * math.pi
-            if self.minWheelAngleChange < abs(angleChange) < self.maxWheelAngleChange:
-                angleChange *= self.wheelPolarity
-            else:
-                angleChange = 0
-        return angleChange
+    def calculateWheelChange(self,position):
+        # calculate angular change in unwrapped wheel position since the previous frame
+        previous = self._wheelPositionPrevious
+        self._wheelPositionPrevious = position
+        if previous is None or np.isnan(previous) or np.isnan(position):
+            return 0
+        angleChange = position - previous
+        if self.minWheelAngleChange < abs(angleChange) < self.maxWheelAngleChange:
+            return angleChange * self.wheelPolarity
+        return 0
             
             
     def initDigitalEncoder(self):
@@ -643,6 +833,11 @@ class TaskControl():
 
     
     def readDigitalEncoder(self):
+        if hasattr(self,'_encoderThread'):
+            latest = self._encoderThread.buffer.latest()
+            self.rotaryEncoderIndex.append(np.nan if latest is None else int(latest[1]))
+            self.rotaryEncoderCount.append(np.nan if latest is None else int(latest[2]))
+            return
         try:
             r = self._digitalEncoder.readline()[:-2].decode('utf-8')
             self.rotaryEncoderIndex.append(int(r.split(';')[-2].split(':')[-1]))
@@ -652,6 +847,37 @@ class TaskControl():
             self.rotaryEncoderCount.append(np.nan)
 
 
+    def startInputAcquisition(self):
+        # read inputs on background threads so a slow read never stalls the frame loop
+        # the frame loop takes the samples acquired since the previous frame from each thread's ring buffer
+        self._inputStartTime = time.perf_counter()
+        if hasattr(self,'_lickInput') and self.lickSampleRate is None:
+            lickState = [False]
+            def readLick():
+                state = self._lickInput.read()
+                if state != lickState[0]:
+                    lickState[0] = state
+                    return (state,)
+            self._lickThread = InputAcquisitionThread(readLick,1,self.lickSampleInterval)
+            self._lickThread.start()
+        if hasattr(self,'_digitalEncoder'):
+            def readEncoder():
+                try:
+                    r = self._digitalEncoder.readline()[:-2].decode('utf-8')
+                    return (int(r.split(';')[-2].split(':')[-1]),int(r.split(';')[-1].split(':')[-1]))
+                except:
+                    return None
+            self._encoderThread = InputAcquisitionThread(readEncoder,2)
+            self._encoderThread.start()
+
+
+    def stopInputAcquisition(self):
+        for attr in ('_lickThread','_encoderThread'):
+            if hasattr(self,attr):
+                getattr(self,attr).stop()
+                delattr(self,attr)
+
+
     def initSolenoid(self):
         self._solenoid = nidaqmx.Task()
         if self.digitalSolenoidTrigger:
@@ -716,6 +942,7 @@ class TaskControl():
 
 
     def initSound(self):
+        self._soundOutputBuffer = None
         if self.soundMode == 'sound card':
             self._audioStream = psychtoolbox.audio.Stream(latency_class=[3],
                                                           freq=self.soundSampleRate,
@@ -733,11 +960,21 @@ class TaskControl():
             self._soundOutput.write(output)
             self._soundOutput.timing.cfg_samp_clk_timing(self.soundSampleRate)
             self._nidaqTasks.append(self._soundOutput)
+            if self.streamingDaqOutput:
+                self._soundOutputBuffer = DaqOutputBuffer(self._soundOutput,len(output) if isinstance(output,list) else 1,self.soundTriggerSource)
                 
     
-    def loadSound(self,soundArray):
+    def filterSound(self,soundArray):
         if self.soundFilter is not None:
             soundArray = np.convolve(soundArray, self.soundFilter, 'same')
+        return soundArray
+
+
+    def loadSound(self,soundArray,filtered=False):
+        # set filtered=True if soundArray has already been passed through filterSound
+        self.markFramePhase('logic')
+        if not filtered:
+            soundArray = self.filterSound(soundArray)
         
         if self.soundMode == 'sound card':
             self._audioStream.fill_buffer(soundArray)
@@ -748,17 +985,54 @@ class TaskControl():
                 output = np.zeros((2,soundArray.size))
                 output[0] = soundArray * 10
                 output[1,:-1] = 5
-            self._soundOutput.stop()
-            self._soundOutput.control(nidaqmx.constants.TaskMode.TASK_UNRESERVE)
-            self._soundOutput.timing.samp_quant_samp_per_chan = soundArray.size
-            self._soundOutput.write(output,auto_start=False)
+            if self._soundOutputBuffer is not None:
+                self._soundOutputBuffer.write(output)
+            else:
+                self._soundOutput.stop()
+                self._soundOutput.control(nidaqmx.constants.TaskMode.TASK_UNRESERVE)
+                self._soundOutput.timing.samp_quant_samp_per_chan = soundArray.size
+                self._soundOutput.write(output,auto_start=False)
+        self.markFramePhase('load')
+
+
+    def addTrialSoundArray(self,soundArray):
+        # record the sound waveform of the current trial (subclasses create trialSoundArray and trialSoundArrayIndex)
+        if self.soundArrayStorage == 'trial':
+            self.trialSoundArray.append(soundArray)
+        else:
+            key = hashlib.sha1(np.ascontiguousarray(soundArray)).hexdigest()
+            if key not in self._soundArrayIndex:
+                self._soundArrayIndex[key] = len(self._soundArrays)
+                self._soundArrays.append(soundArray)
+            self.trialSoundArrayIndex.append(self._soundArrayIndex[key])
+
+
+    def saveSoundArrays(self,fileOut):
+        # each distinct waveform is saved once as a compressed dataset in group soundArrays, named by its index
+        soundArrays = getattr(self,'_soundArrays',[])
+        if len(soundArrays) > 0:
+            group = fileOut.create_group('soundArrays')
+            for i,soundArray in enumerate(soundArrays):
+                if soundArray.size > 0:
+                    group.create_dataset(str(i),data=soundArray,compression='gzip',shuffle=True)
+                else:
+                    group.create_dataset(str(i),data=soundArray)
+    
+    
+    def setSoundBufferSize(self,nSamples):
+        # preallocate streaming sound output for the longest sound a task will load
+        if self._soundOutputBuffer is not None:
+            self._soundOutputBuffer.allocate(nSamples)
 
 
-    def startSound(self):
+    def startSound(self,triggered=False):
         if self.soundMode == 'sound card':
             self._audioStream.start()
         elif self.soundMode == 'daq':
-            self._soundOutput.start()
+            if self._soundOutputBuffer is not None:
+                self._soundOutputBuffer.start(triggered)
+            else:
+                self._soundOutput.start()
 
 
     def stopSound(self):
@@ -769,6 +1043,7 @@ class TaskControl():
     
     
     def initOpto(self):
+        self._optoOutputBuffer = None
         if self.optoNidaqDevice is not None:
             self.optoNidaqDeviceSerialNum = nidaqmx.system.device.Device(self.optoNidaqDevice).dev_serial_num
             self._optoOutput = nidaqmx.Task()
@@ -781,6 +1056,8 @@ class TaskControl():
             self._optoOutput.write(self._optoOutputVoltage)
             self._optoOutput.timing.cfg_samp_clk_timing(self.optoSampleRate)
             self._nidaqTasks.append(self._optoOutput)
+            if self.streamingDaqOutput:
+                self._optoOutputBuffer = DaqOutputBuffer(self._optoOutput,self._nOptoChannels,self.optoTriggerSource)
 
 
     def getOptoParams(self,allowMultipleValsPerDev=False):
@@ -812,19 +1089,15 @@ class TaskControl():
             self.optoParams['galvoX'] = np.full((len(self.optoParams['label']),1),np.nan)
             self.optoParams['galvoY'] = self.optoParams['galvoX'].copy()
         else:
-            self.bregmaGalvoCalibrationData = TaskUtils.getBregmaGalvoCalibrationData(self.rigName)
+            bregmaGalvoCalibration = TaskUtils.getBregmaGalvoCalibration(self.rigName)
+            self.bregmaGalvoCalibrationData = bregmaGalvoCalibration.data
             self.optoParams['galvoX'] = []
             self.optoParams['galvoY'] = []
             for bregmaX,bregmaY,offsetX,offsetY in zip(self.optoParams['bregmaX'],self.optoParams['bregmaY'],
                                                        self.optoParams['bregma offset X'],self.optoParams['bregma offset Y']):
-                x = []
-                y = []
-                for bx,by in zip(bregmaX,bregmaY):
-                    gx,gy = TaskUtils.bregmaToGalvo(self.bregmaGalvoCalibrationData,bx,by,offsetX,offsetY)
-                    x.append(gx)
-                    y.append(gy)
-                self.optoParams['galvoX'].append(np.array(x))
-                self.optoParams['galvoY'].append(np.array(y))
+                x,y = bregmaGalvoCalibration.bregmaToGalvo(bregmaX,bregmaY,offsetX,offsetY)
+                self.optoParams['galvoX'].append(x)
+                self.optoParams['galvoY'].append(y)
         
         devNames = set(d for dev in self.optoParams['device'] for d in dev)
         self.optoPowerCalibrationData = {dev: TaskUtils.getOptoPowerCalibrationData(self.rigName,dev) for dev in devNames}
@@ -852,10 +1125,8 @@ class TaskControl():
 
 
     def loadOptoWaveform(self,optoDevices,optoWaveforms,galvoX=None,galvoY=None):
-        self._optoOutput.stop()
-        self._optoOutput.control(nidaqmx.constants.TaskMode.TASK_UNRESERVE)
+        self.markFramePhase('logic')
         nSamples = max(w.size for w in optoWaveforms)
-        self._optoOutput.timing.samp_quant_samp_per_chan = nSamples
         output = np.zeros((self._nOptoChannels,nSamples))
         if self.galvoChannels is not None:
             output[self.galvoChannels[0]] = self._optoOutputVoltage[self.galvoChannels[0]] if galvoX is None else galvoX
@@ -867,12 +1138,22 @@ class TaskControl():
             output[channels[0],:waveform.size] = waveform
             if not np.isnan(channels[1]):
                 output[channels[1],output[channels[0]]>0] = 5
-        self._optoOutput.write(output,auto_start=False)
+        if self._optoOutputBuffer is not None:
+            self._optoOutputBuffer.write(output)
+        else:
+            self._optoOutput.stop()
+            self._optoOutput.control(nidaqmx.constants.TaskMode.TASK_UNRESERVE)
+            self._optoOutput.timing.samp_quant_samp_per_chan = nSamples
+            self._optoOutput.write(output,auto_start=False)
         self._optoOutputVoltage = output[:,-1]
+        self.markFramePhase('load')
 
 
-    def startOpto(self):
-        self._optoOutput.start()
+    def startOpto(self,triggered=False):
+        if self._optoOutputBuffer is not None:
+            self._optoOutputBuffer.start(triggered)
+        else:
+            self._optoOutput.start()
 
 
     def initAccumulatorInterface(self,params):
@@ -1045,6 +1326,377 @@ class LickTest(TaskControl):
             self.showFrame()
 
 
+class FrameProfiler():
+    
+    # time spent in each phase of each frame, kept for the most recent size frames
+    # mark(phase) adds the time since the previous mark to phase for the current frame
+    # a frame is over budget if it takes longer than 1.2 frame periods (psychopy's dropped frame threshold);
+    # the phase that took longest is counted as its cause
+    
+    phases = ('input','logic','load','draw','other','flip','triggers')
+    
+    def __init__(self,size,frameBudget):
+        self.size = size
+        self.frameBudget = frameBudget
+        self.phaseIndex = {phase: i for i,phase in enumerate(self.phases)}
+        self.frames = np.zeros(size,dtype=np.int64)
+        self.times = np.zeros((size,len(self.phases)),dtype=np.float32)
+        self.phaseTimes = np.zeros(len(self.phases))
+        self.count = 0
+        self.overBudgetFrames = []
+        self.overBudgetPhase = []
+        self.lastMark = time.perf_counter()
+        
+        
+    def start(self):
+        # call at the start of the first frame so session setup is not counted as frame time
+        self.lastMark = time.perf_counter()
+        
+        
+    def mark(self,phase):
+        t = time.perf_counter()
+        self.phaseTimes[self.phaseIndex[phase]] += t - self.lastMark
+        self.lastMark = t
+        
+        
+    def endFrame(self,frame):
+        i = self.count % self.size
+        self.frames[i] = frame
+        self.times[i] = self.phaseTimes
+        if self.phaseTimes.sum() > 1.2 * self.frameBudget:
+            self.overBudgetFrames.append(frame)
+            self.overBudgetPhase.append(self.phases[self.phaseTimes.argmax()])
+        self.phaseTimes[:] = 0
+        self.count += 1
+        
+        
+    def getProfile(self):
+        # structured array of phase times (seconds) for the frames in the buffer, oldest first
+        n = min(self.count,self.size)
+        i = np.arange(self.count-n,self.count) % self.size
+        profile = np.zeros(n,dtype=[('frame',np.int64)] + [(phase,np.float32) for phase in self.phases])
+        profile['frame'] = self.frames[i]
+        for j,phase in enumerate(self.phases):
+            profile[phase] = self.times[i,j]
+        return profile
+    
+    
+    def getSummary(self):
+        summary = {'frameBudget': self.frameBudget,
+                   'nFrames': self.count,
+                   'overBudgetFrames': self.overBudgetFrames,
+                   'overBudgetPhase': self.overBudgetPhase}
+        summary['overBudgetCount'] = {phase: self.overBudgetPhase.count(phase) for phase in self.phases}
+        return summary
+    
+    
+    def save(self,fileOut):
+        fileOut.create_dataset('frameProfile',data=self.getProfile(),compression='gzip')
+        summary = self.getSummary()
+        saveParameters(fileOut.create_group('frameProfileSummary'),summary)
+        nOver = len(self.overBudgetFrames)
+        if nOver > 0:
+            print(str(nOver) + ' of ' + str(self.count) + ' frames over budget: ' +
+                  ', '.join(phase + ' ' + str(n) for phase,n in summary['overBudgetCount'].items() if n > 0))
+
+
+class SessionWriter(Thread):
+    
+    # appends new items of lists to chunked, resizable datasets of an hdf5 file on a background thread
+    # the file is flushed after each write so the data written so far survives the task stopping between writes;
+    # the file is not opened in SWMR mode (datasets are created and retyped as data arrive), so a process that is
+    # killed while a write is in progress can leave the file unreadable
+    # lists of numbers, strings or equal shape arrays are streamed; other lists are left for saveParameters
+    
+    def __init__(self,filePath,excludeKeys=(),chunkSize=1024):
+        Thread.__init__(self,daemon=True)
+        self.filePath = filePath
+        self.excludeKeys = set(excludeKeys)
+        self.chunkSize = chunkSize
+        self.queue = Queue()
+        self.keys = [] # keys written at least once
+        self.count = {} # key: (id of list, number of items queued)
+        self.unsupported = set()
+        
+        
+    def write(self,data):
+        # called from the task thread; data is a dict of key: list or GrowableArray
+        batch = []
+        for key,val in data.items():
+            if key in self.excludeKeys:
+                continue
+            listId,n = self.count.get(key,(id(val),0))
+            if listId != id(val) or len(val) < n:
+                # list was replaced; start over
+                listId,n = id(val),0
+                batch.append((key,None))
+            if len(val) > n or key not in self.count:
+                # empty lists are written as empty datasets, as saveParameters would
+                # (count what was sliced; arrays filled by acquisition callbacks may grow meanwhile)
+                items = val[n:]
+                batch.append((key,items))
+                if key not in self.count:
+                    self.keys.append(key)
+                self.count[key] = (listId,n + len(items))
+        if len(batch) > 0:
+            self.queue.put(batch)
+        
+        
+    def run(self):
+        with h5py.File(self.filePath,'a') as fileOut:
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                for key,items in batch:
+                    try:
+                        self.append(fileOut,key,items)
+                    except Exception as err:
+                        print('\n' + 'could not stream ' + key)
+                        print(repr(err))
+                        self.unsupported.add(key)
+                fileOut.flush()
+                
+                
+    def append(self,fileOut,key,items):
+        if items is None:
+            if key in fileOut:
+                del fileOut[key]
+            self.unsupported.discard(key)
+            return
+        if key in self.unsupported:
+            return
+        data = None
+        if isinstance(items,np.ndarray):
+            data = items
+            dtype = data.dtype
+        elif len(items) > 0 and all(isinstance(item,str) for item in items):
+            data = np.array(items,dtype=object)
+            dtype = h5py.string_dtype()
+        else:
+            try:
+                data = np.array(items)
+            except ValueError:
+                pass
+            if data is not None and data.dtype.kind in 'biuf' and data.ndim > 0:
+                dtype = data.dtype
+            else:
+                data = None
+        ds = fileOut[key] if key in fileOut else None
+        if ds is not None and ds.shape[0] == 0:
+            del fileOut[key]
+            ds = None
+        if data is None or (ds is not None and (ds.shape[1:] != data.shape[1:] or (ds.dtype.kind == 'O') != (data.dtype.kind == 'O'))):
+            # ragged, mixed or changing items; left for saveParameters
+            self.unsupported.add(key)
+            if ds is not None:
+                del fileOut[key]
+            return
+        if ds is None:
+            self.createDataset(fileOut,key,data,dtype)
+            return
+        if ds.dtype.kind != 'O' and dtype != ds.dtype:
+            # e.g. ints followed by nan; rewrite with the promoted type
+            old = ds[:]
+            del fileOut[key]
+            ds = self.createDataset(fileOut,key,old,np.result_type(old.dtype,dtype))
+        n = ds.shape[0]
+        ds.resize(n + len(data),axis=0)
+        ds[n:] = data
+            
+            
+    def createDataset(self,fileOut,key,data,dtype):
+        compression = {} if np.dtype(dtype).kind == 'O' else {'compression': 'gzip','compression_opts': 1,'shuffle': True}
+        return fileOut.create_dataset(key,data=data,dtype=dtype,maxshape=(None,)+data.shape[1:],chunks=(self.chunkSize,)+data.shape[1:],**compression)
+            
+            
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+        
+        
+    def isComplete(self,ds,val):
+        # True if the streamed dataset holds exactly what saveParameters would write for val
+        if ds.name.lstrip('/') in self.unsupported or not isinstance(val,(list,GrowableArray)) or ds.shape[0] != len(val):
+            return False
+        if ds.dtype.kind == 'O':
+            return list(ds.asstr()[:]) == val
+        data = np.array(val)
+        return data.dtype == ds.dtype and np.array_equal(ds[:],data,equal_nan=data.dtype.kind == 'f')
+
+
+class GrowableArray():
+    
+    # numpy array with list style append, len and indexing for data added every frame
+    # capacity doubles when full; np.asarray (and saving) gives a view of the filled part without copying
+    
+    def __init__(self,size=4096,dtype=np.float64):
+        self.data = np.zeros(max(size,1),dtype=dtype)
+        self.count = 0
+        
+        
+    def append(self,val):
+        if self.count == self.data.size:
+            self.data = np.concatenate((self.data,np.zeros_like(self.data)))
+        self.data[self.count] = val
+        self.count += 1
+        
+        
+    def extend(self,vals):
+        n = self.count + len(vals)
+        if n > self.data.size:
+            data = np.zeros(max(n,2 * self.data.size),dtype=self.data.dtype)
+            data[:self.count] = self.data[:self.count]
+            self.data = data
+        self.data[self.count:n] = vals
+        self.count = n
+        
+        
+    def __len__(self):
+        return self.count
+    
+    
+    def __getitem__(self,index):
+        return self.data[:self.count][index]
+    
+    
+    def __iter__(self):
+        return iter(self.data[:self.count])
+    
+    
+    def __array__(self,dtype=None,copy=None):
+        data = self.data[:self.count]
+        if dtype is not None and dtype != data.dtype:
+            return data.astype(dtype)
+        return data.copy() if copy else data
+
+
+class InputRingBuffer():
+    
+    # single producer/single consumer ring buffer of timestamped samples
+    # the producer writes a row before advancing count, so the consumer never needs a lock
+    
+    def __init__(self,nColumns,size=4096):
+        self.size = size
+        self.data = np.full((size,nColumns),np.nan)
+        self.count = 0
+        self.readCount = 0
+        
+        
+    def append(self,*vals):
+        self.data[self.count % self.size] = vals
+        self.count += 1
+        
+        
+    def readNew(self):
+        # rows appended since the previous call (at most the last size rows)
+        count = self.count
+        n = min(count - self.readCount,self.size)
+        self.readCount = count
+        return self.data[np.arange(count-n,count) % self.size]
+    
+    
+    def latest(self):
+        count = self.count
+        return None if count == 0 else self.data[(count-1) % self.size].copy()
+
+
+class InputAcquisitionThread(Thread):
+    
+    # calls readFunc repeatedly and appends each sample it returns (None to skip)
+    # to a ring buffer with a time.perf_counter timestamp in the first column
+    
+    def __init__(self,readFunc,nColumns,interval=0):
+        Thread.__init__(self,daemon=True)
+        self.readFunc = readFunc
+        self.interval = interval
+        self.buffer = InputRingBuffer(nColumns+1)
+        self.running = True
+        
+        
+    def run(self):
+        while self.running:
+            sample = self.readFunc()
+            if sample is not None:
+                self.buffer.append(time.perf_counter(),*sample)
+            if self.interval > 0:
+                time.sleep(self.interval)
+                
+                
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class DaqOutputBuffer():
+    
+    # keeps a finite analog output task committed with a preallocated buffer
+    # waveforms are padded with their last sample to the buffer size, so loading one is
+    # a stop (back to the committed state) and a write instead of unreserving and resizing the task
+    # if triggerSource is not None, start(triggered=True) arms the task to start on
+    # the falling edge of the frame signal (written just after each flip)
+    
+    def __init__(self,task,nChannels,triggerSource=None):
+        self.task = task
+        self.nChannels = nChannels
+        self.triggerSource = triggerSource
+        self.triggered = False
+        self.buffer = None
+        self.allocate(self.task.timing.samp_quant_samp_per_chan)
+        
+        
+    def allocate(self,nSamples):
+        # only called outside of the frame loop or when a waveform exceeds the buffer
+        if self.buffer is not None and nSamples <= self.buffer.shape[1]:
+            return
+        self.task.stop()
+        self.task.control(nidaqmx.constants.TaskMode.TASK_UNRESERVE)
+        self.task.timing.samp_quant_samp_per_chan = nSamples
+        self.task.out_stream.relative_to = nidaqmx.constants.WriteRelativeTo.FIRST_SAMPLE
+        self.task.out_stream.offset = 0
+        self.task.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+        buffer = np.zeros((self.nChannels,nSamples))
+        if self.buffer is not None:
+            buffer[:,:self.buffer.shape[1]] = self.buffer
+            buffer[:,self.buffer.shape[1]:] = self.buffer[:,-1:]
+        self.buffer = buffer
+        
+        
+    def write(self,output):
+        output = np.reshape(output,(self.nChannels,-1))
+        nSamples = output.shape[1]
+        self.allocate(nSamples)
+        self.buffer[:,:nSamples] = output
+        self.buffer[:,nSamples:] = output[:,-1:]
+        self.task.stop()
+        self.writeBuffer()
+        
+        
+    def writeBuffer(self):
+        self.task.write(self.buffer[0] if self.nChannels == 1 else self.buffer,auto_start=False)
+        
+        
+    def setTrigger(self,triggered):
+        # reconfiguring the trigger recommits the task, so rewrite the buffer
+        self.task.stop()
+        self.task.control(nidaqmx.constants.TaskMode.TASK_UNRESERVE)
+        if triggered:
+            self.task.triggers.start_trigger.cfg_dig_edge_start_trig(self.triggerSource,trigger_edge=nidaqmx.constants.Edge.FALLING)
+        else:
+            self.task.triggers.start_trigger.disable_start_trig()
+        self.task.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+        self.writeBuffer()
+        self.triggered = triggered
+        
+        
+    def start(self,triggered=False):
+        # untriggered starts (e.g. optoOff at the end of a session) start immediately
+        triggered = triggered and self.triggerSource is not None
+        if triggered != self.triggered:
+            self.setTrigger(triggered)
+        self.task.start()
+
+
 def measureSound(params,soundVol,soundDur,soundInterval,nidaqDevName):
     
     from nidaqmx.stream_readers import AnalogMultiChannelReader
@@ -1188,27 +1840,44 @@ def measureSound(params,soundVol,soundDur,soundInterval,nidaqDevName):
     h5File.close()
 
 
-def saveParameters(group,paramDict):
+def saveParameters(group,paramDict,compressionThreshold=2**16):
+    # saves items not starting with underscore (dicts as groups) without modifying them:
+    #   strings and string sequences -> vlen str datasets (nested sequences as their str representation)
+    #   variable length numeric sequences -> group with flat 'values' and 'offsets' datasets (attrs['layout'] = 'ragged')
+    #   everything else -> fixed dtype datasets (None, also within sequences, as nan)
+    # datasets larger than compressionThreshold bytes are chunked and compressed
     for key,val in paramDict.items():
         if key[0] != '_':
             if isinstance(val,dict):
-                saveParameters(group.create_group(key),val)
+                saveParameters(group.create_group(key),val,compressionThreshold)
             else:
-                if val is None:
-                    val = np.nan
                 try:
-                    if isStringSequence(val):
-                        if not all(isinstance(v,str) for v in val):
-                            for i,v in enumerate(val):
-                                val[i] = str(v)
-                        group.create_dataset(key,data=np.array(val,dtype=object),dtype=h5py.special_dtype(vlen=str)) 
+                    if isinstance(val,str):
+                        group.create_dataset(key,data=val)
+                    elif isStringSequence(val):
+                        data = np.array([v if isinstance(v,str) else str(v) for v in val],dtype=object)
+                        group.create_dataset(key,data=data,dtype=h5py.string_dtype())
                     elif isVariableLengthSequence(val):
-                        group.create_dataset(key,data=np.array(val,dtype=object),dtype=h5py.special_dtype(vlen=float))
+                        ragged = group.create_group(key)
+                        ragged.attrs['layout'] = 'ragged'
+                        values = np.concatenate([np.asarray(v,dtype=float).ravel() for v in val])
+                        saveArray(ragged,'values',values,compressionThreshold)
+                        ragged.create_dataset('offsets',data=np.cumsum([0] + [np.size(v) for v in val]))
                     else:
-                        group.create_dataset(key,data=val)
+                        data = np.asarray(np.nan if val is None else val)
+                        if data.dtype == object:
+                            data = np.array([np.nan if v is None else v for v in data.ravel()],dtype=float).reshape(data.shape)
+                        saveArray(group,key,data,compressionThreshold)
                 except Exception as err:
                     print('\n' + 'could not save ' + key)
-                    print(repr(err))  
+                    print(repr(err))
+
+
+def saveArray(group,key,data,compressionThreshold=2**16):
+    if data.nbytes > compressionThreshold:
+        group.create_dataset(key,data=data,chunks=True,compression='gzip',compression_opts=1,shuffle=True)
+    else:
+        group.create_dataset(key,data=data)
 
 
 def isStringSequence(obj):
@@ -2,7 +2,7 @@ import os
 import pathlib
 import numpy as np
 import scipy.signal
-from scipy.interpolate import interpn, LinearNDInterpolator
+from scipy.interpolate import LinearNDInterpolator, RegularGridInterpolator
 
 
 # opto utils
@@ -22,46 +22,91 @@ def getBregmaGalvoCalibrationData(rigName):
     return d
 
 
-def _bregmaToGalvoInterpolation(px,py,vx,vy,bregmaX,bregmaY):
-    return [interpn((px,py),v,(bregmaX,bregmaY),bounds_error=False,fill_value=None)[0] for v in (vx,vy)]
+class BregmaGalvoCalibration():
+    
+    # bregma <-> galvo voltage conversion for one calibration table
+    # the interpolators are built once and evaluate arrays of points in one call
+    # bregma -> galvo is linear interpolation (and extrapolation) on the regular bregma grid;
+    # galvo -> bregma is linear interpolation on a triangulation of the calibrated galvo voltages (nan outside)
+    def __init__(self,calibrationData):
+        self.data = calibrationData
+        bregmaX,bregmaY,galvoX,galvoY = [np.asarray(calibrationData[key],dtype=float) for key in ('bregmaX','bregmaY','galvoX','galvoY')]
+        px,i = np.unique(bregmaX,return_inverse=True)
+        py,j = np.unique(bregmaY,return_inverse=True)
+        v = np.zeros((len(px),len(py),2))
+        v[i,j] = np.stack((galvoX,galvoY),axis=1)
+        self._toGalvo = RegularGridInterpolator((px,py),v,bounds_error=False,fill_value=None)
+        self._toBregma = LinearNDInterpolator(np.stack((galvoX,galvoY),axis=1),np.stack((bregmaX,bregmaY),axis=1))
+        self._galvoOrigin = self._interpolateGalvo(0,0)
+    
+    def _interpolateGalvo(self,bregmaX,bregmaY):
+        x,y = np.broadcast_arrays(bregmaX,bregmaY)
+        return self._toGalvo(np.stack((x.ravel(),y.ravel()),axis=1)).reshape(x.shape + (2,))
+    
+    def bregmaToGalvo(self,bregmaX,bregmaY,offsetX=0,offsetY=0):
+        # offsets are in bregma coordinates and shift the galvo voltage by the change between bregma and the offset
+        galvo = self._interpolateGalvo(bregmaX,bregmaY)
+        if np.any(np.asarray(offsetX) != 0) or np.any(np.asarray(offsetY) != 0):
+            galvo = galvo + self._interpolateGalvo(offsetX,offsetY) - self._galvoOrigin
+        return galvo[...,0][()],galvo[...,1][()]
+    
+    def galvoToBregma(self,galvoX,galvoY):
+        bregma = self._toBregma(*np.broadcast_arrays(galvoX,galvoY))
+        return bregma[...,0][()],bregma[...,1][()]
+
+
+_bregmaGalvoCalibrationCache = {}
+
+def getBregmaGalvoCalibration(rigName):
+    # the calibration is rebuilt only when the calibration file changes
+    bregmaGalvoFile = os.path.join(optoBaseDir,rigName,rigName + '_bregma_galvo.txt')
+    st = os.stat(bregmaGalvoFile)
+    fileVersion = (st.st_mtime_ns,st.st_size)
+    if rigName not in _bregmaGalvoCalibrationCache or _bregmaGalvoCalibrationCache[rigName][0] != fileVersion:
+        _bregmaGalvoCalibrationCache[rigName] = (fileVersion,BregmaGalvoCalibration(getBregmaGalvoCalibrationData(rigName)))
+    return _bregmaGalvoCalibrationCache[rigName][1]
   
   
 def bregmaToGalvo(calibrationData,bregmaX,bregmaY,offsetX=0,offsetY=0):
-    px = np.unique(calibrationData['bregmaX'])
-    py = np.unique(calibrationData['bregmaY'])
-    vx = np.zeros((len(px),len(py)))
-    vy = vx.copy()
-    for x,y,zx,zy in zip(calibrationData['bregmaX'],calibrationData['bregmaY'],calibrationData['galvoX'],calibrationData['galvoY']):
-      i = np.where(px==x)[0][0]
-      j = np.where(py==y)[0][0]
-      vx[i,j] = zx
-      vy[i,j] = zy
-    galvoX,galvoY = _bregmaToGalvoInterpolation(px,py,vx,vy,bregmaX,bregmaY)
-    if offsetX != 0 or offsetY != 0:
-        x0,y0 = _bregmaToGalvoInterpolation(px,py,vx,vy,0,0)
-        xOff,yOff = _bregmaToGalvoInterpolation(px,py,vx,vy,offsetX,offsetY)
-        galvoX += xOff - x0
-        galvoY += yOff - y0
-    return galvoX,galvoY
+    return BregmaGalvoCalibration(calibrationData).bregmaToGalvo(bregmaX,bregmaY,offsetX,offsetY)
 
 
 def galvoToBregma(calibrationData,galvoX,galvoY):
-    points = np.stack((calibrationData['galvoX'],calibrationData['galvoY']),axis=1)
-    bregmaX,bregmaY = [float(LinearNDInterpolator(points,calibrationData[b])(galvoX,galvoY)) for b in ('bregmaX','bregmaY')]
-    return bregmaX,bregmaY
+    return BregmaGalvoCalibration(calibrationData).galvoToBregma(galvoX,galvoY)
 
 
+_optoPowerCalibrationCache = {}
+
 def getOptoPowerCalibrationData(rigName,devName):
+    # the quadratic fit is cached per rig and device and redone only when the calibration file changes
     f = os.path.join(optoBaseDir,rigName,rigName + '_' + devName + '_power.txt')
-    d = _txtToDict(f)
-    p = np.polyfit(d['input (V)'],d['power (mW)'],2)
-    d['poly coefficients'] = p
-    d['offsetV'] = min(np.roots(p))
-    return d
+    st = os.stat(f)
+    fileVersion = (st.st_mtime_ns,st.st_size)
+    key = (rigName,devName)
+    if key not in _optoPowerCalibrationCache or _optoPowerCalibrationCache[key][0] != fileVersion:
+        d = _txtToDict(f)
+        p = np.polyfit(d['input (V)'],d['power (mW)'],2)
+        d['poly coefficients'] = p
+        d['offsetV'] = _minQuadraticRoot(p,0)
+        _optoPowerCalibrationCache[key] = (fileVersion,d)
+    return _optoPowerCalibrationCache[key][1]
+
+
+def _minQuadraticRoot(p,y):
+    # smaller real root of p[0]*x**2 + p[1]*x + p[2] = y (nan if there is none)
+    a,b,c = p
+    c = c - np.asarray(y,dtype=float)
+    if a == 0:
+        return (-c / b)[()]
+    with np.errstate(invalid='ignore'):
+        sqrtDisc = np.sqrt(b**2 - 4 * a * c)
+    return np.minimum((-b - sqrtDisc) / (2 * a),(-b + sqrtDisc) / (2 * a))[()]
 
 
 def powerToVolts(calibrationData,power):
-    return min((np.poly1d(calibrationData['poly coefficients']) - power).roots) if power > 0 else 0
+    # power can be a scalar or an array; zero power is 0 V
+    power = np.asarray(power,dtype=float)
+    return np.where(power > 0,_minQuadraticRoot(calibrationData['poly coefficients'],power),0)[()]
 
 
 def voltsToPower(calibrationData,volts):